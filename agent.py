@@ -1,9 +1,6 @@
-from groq import Groq
-from langchain_groq import ChatGroq
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough, RunnableMap, RunnableLambda
-import pickle
 import re
 
 from langgraph.graph import StateGraph, START, END
@@ -11,25 +8,32 @@ from typing import Dict, Any, TypedDict, Annotated
 from operator import add
 
 from agent_helper import *
-from IPython.display import Image
+import llm_cache
+from instrumentation import timed_node
+from kb_store import kb
+from column_index import column_index
+from startup import lazy
 
 from dotenv import load_dotenv
 
 import re
+import os
 import ast  # safer than eval for simple Python literals
+import asyncio
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 
 
 load_dotenv()
 
-with open('kb.pkl', 'rb') as f:
-    loaded_dict = pickle.load(f)
-
 d_store = {
     "dim" : ['brand_master', 'cost_center_hierarchy','cost_element_hierarchy','functional_area_hierarchy','functional_area_metric_map','key_figure_metric_map','profit_center_hierarchy'],
     "sales" : ['sales_data'],
     "expense": ["income_expense_reporting"]
 }
 
+# Max number of concurrent chain_column_extractor calls per sub-graph run (1 = serial)
+COLUMN_SELECTION_MAX_WORKERS = int(os.getenv("COLUMN_SELECTION_MAX_WORKERS", "4"))
+
 class overallstate(TypedDict):
     user_query: str
     table_lst: list[str]
@@ -38,12 +42,12 @@ class overallstate(TypedDict):
 
 
 
-def agent_subquestion(q, v):
+def _parse_subquestions(response):
     """
-    Invoke the LLM chain for a subquestion, extract the resulting list of lists, and return as Python object.
+    Extract the list of [subquestion, table] lists from the subquestion chain output.
     """
-    response = chain_subquestion.invoke({"tables": v, "user_query": q}).replace('```', '')
-    
+    response = response.replace('```', '')
+
     # Regex to find the list-of-lists structure
     match = re.search(r"\[\s*\[.*?\]\s*(,\s*\[.*?\]\s*)*\]", response, re.DOTALL)
     
@@ -61,36 +65,43 @@ def agent_subquestion(q, v):
         return []
 
 
+def agent_subquestion(q, v):
+    """
+    Invoke the LLM chain for a subquestion, extract the resulting list of lists, and return as Python object.
+    """
+    return _parse_subquestions(chain_subquestion.invoke({"tables": v, "user_query": q}))
+
+
+async def aagent_subquestion(q, v):
+    """Async variant of agent_subquestion."""
+    return _parse_subquestions(await chain_subquestion.ainvoke({"tables": v, "user_query": q}))
+
+
+def _table_descriptions(lst):
+    """
+    Render the table -> description mapping passed to the subquestion chain.
+    """
+    return kb.descriptions_prompt(lst)
+
+
 def solve_subquestion(q, lst):
     """
     For a given question `q` and list of table names `lst`,
     return the LLM-extracted subquestions as a Python list.
     """
-    final = []
-    for tab in lst:
-        desc = loaded_dict[tab]['table_description']   # get table description
-        final.append([tab, desc])
-
-    # Create dictionary mapping table -> description
-    result_dict = {item[0]: item[1] for item in final}
-
-    # Call agent_subquestion and get list directly
-    subquestion_list = agent_subquestion(q, str(result_dict))
-    
-    return subquestion_list
+    return agent_subquestion(q, _table_descriptions(lst))
 
 
+async def asolve_subquestion(q, lst):
+    """Async variant of solve_subquestion."""
+    return await aagent_subquestion(q, _table_descriptions(lst))
 
 
-def agent_column_selection(main_q, q, c):
+def _parse_columns(response):
     """
-    Call the column extraction LLM chain, and safely return list-of-lists.
+    Extract the list of [column, description] lists from the column extractor output.
     """
-    response = chain_column_extractor.invoke({
-        "columns": c,
-        "query": q,
-        "main_question": main_q
-    }).replace('```', '')
+    response = response.replace('```', '')
 
     # Regex to extract list-of-lists pattern
     match = re.search(r"\[\s*\[.*?\]\s*(,\s*\[.*?\]\s*)*\]", response, re.DOTALL)
@@ -106,26 +117,100 @@ def agent_column_selection(main_q, q, c):
         return [[]]  # fallback empty list
 
 
+def agent_column_selection(main_q, q, c):
+    """
+    Call the column extraction LLM chain, and safely return list-of-lists.
+    """
+    return _parse_columns(chain_column_extractor.invoke({
+        "columns": c,
+        "query": q,
+        "main_question": main_q
+    }))
+
+
+async def aagent_column_selection(main_q, q, c):
+    """Async variant of agent_column_selection."""
+    return _parse_columns(await chain_column_extractor.ainvoke({
+        "columns": c,
+        "query": q,
+        "main_question": main_q
+    }))
+
+
+def _select_columns_for_table(main_q, tab):
+    """
+    Run column selection for a single [subquestion, table] pair and tag each
+    selected column with its table name. Only the columns pre-ranked by
+    column_index (top-k plus join keys) are offered to the LLM.
+    """
+    table_name = tab[1]
+    question = tab[0]
+
+    def select():
+        return agent_column_selection(main_q, question, column_index.columns_prompt(table_name, question, main_q))
+
+    if llm_cache.step_memo is None:
+        out_column = select()
+    else:
+        # Batch runs share the selection per (table, subquestion); the first question's main question is used
+        out_column = llm_cache.step_memo.get("column_selection", (table_name, question.strip().lower()), select)
+
+    return [["name of table:" + table_name] + col_selec for col_selec in out_column]
+
+
+async def _aselect_columns_for_table(main_q, tab, semaphore):
+    table_name = tab[1]
+    question = tab[0]
+
+    async def select():
+        return await aagent_column_selection(main_q, question, column_index.columns_prompt(table_name, question, main_q))
+
+    async with semaphore:
+        if llm_cache.step_memo is None:
+            out_column = await select()
+        else:
+            out_column = await llm_cache.step_memo.aget(
+                "column_selection", (table_name, question.strip().lower()), select
+            )
+
+    return [["name of table:" + table_name] + col_selec for col_selec in out_column]
+
+
+def solve_column_selection(main_q, list_sub, max_workers=None):
+    """
+    Select columns for every subquestion. The LLM calls run concurrently with at most
+    `max_workers` in flight (defaults to COLUMN_SELECTION_MAX_WORKERS); results keep
+    the order of `list_sub`.
+    """
+    tabs = [tab for tab in list_sub if len(tab) != 0]
+    if max_workers is None:
+        max_workers = COLUMN_SELECTION_MAX_WORKERS
+
+    if max_workers <= 1 or len(tabs) <= 1:
+        per_table = [_select_columns_for_table(main_q, tab) for tab in tabs]
+    else:
+        with ContextThreadPoolExecutor(max_workers=min(max_workers, len(tabs))) as pool:
+            per_table = list(pool.map(lambda tab: _select_columns_for_table(main_q, tab), tabs))
+
+    final_col = []
+    for cols in per_table:
+        final_col.extend(cols)
+    return final_col
+
+
+async def asolve_column_selection(main_q, list_sub, max_workers=None):
+    """Async variant of solve_column_selection (bounded by a semaphore instead of a thread pool)."""
+    tabs = [tab for tab in list_sub if len(tab) != 0]
+    semaphore = asyncio.Semaphore(max(1, max_workers or COLUMN_SELECTION_MAX_WORKERS))
+    per_table = await asyncio.gather(*[_aselect_columns_for_table(main_q, tab, semaphore) for tab in tabs])
 
-def solve_column_selection(main_q, list_sub):
     final_col = []
-    inter = []
-    for tab in list_sub:
-        if len(tab)==0:
-            continue
-        table_name = tab[1]
-        question = tab[0]
-        columns = loaded_dict[table_name]["columns"]
-        out_column = agent_column_selection(main_q, question, str(columns))
-        trans_col = (out_column)
-
-        for col_selec in trans_col:
-            new_col = ["name of table:" + table_name] + col_selec
-            inter.append(new_col)
-        final_col.extend(inter)
+    for cols in per_table:
+        final_col.extend(cols)
     return final_col
 
 
+@timed_node("subquestion")
 def sq_node(state: overallstate):
     q = state['user_query']
     lst = state['table_lst']
@@ -133,6 +218,12 @@ def sq_node(state: overallstate):
     
     return {"table_extract": (o)}
 
+@timed_node("subquestion")
+async def asq_node(state: overallstate):
+    o = await asolve_subquestion(state['user_query'], state['table_lst'])
+    return {"table_extract": o}
+
+@timed_node("column_e")
 def column_node(state: overallstate):
     subq = state['table_extract']
     mq = state['user_query']
@@ -140,14 +231,24 @@ def column_node(state: overallstate):
     o = solve_column_selection(mq, subq)
     return {"column_extract": o}
 
+@timed_node("column_e")
+async def acolumn_node(state: overallstate):
+    o = await asolve_column_selection(state['user_query'], state['table_extract'])
+    return {"column_extract": o}
+
+
+def build_graph_final():
+    # Each node carries a sync and an async implementation, so graph_final.invoke and
+    # graph_final.ainvoke/astream both run natively
+    builder_final = StateGraph(overallstate)
+    builder_final.add_node("subquestion", RunnableLambda(sq_node, afunc=asq_node))
+    builder_final.add_node("column_e", RunnableLambda(column_node, afunc=acolumn_node))
 
-builder_final = StateGraph(overallstate)
-builder_final.add_node("subquestion", sq_node)
-builder_final.add_node("column_e", column_node)
+    builder_final.add_edge(START, "subquestion")
+    builder_final.add_edge("subquestion", "column_e")
 
-builder_final.add_edge(START, "subquestion")
-builder_final.add_edge("subquestion", "column_e")
+    builder_final.add_edge("column_e", END)
+    return builder_final.compile()
 
-builder_final.add_edge("column_e", END)
-graph_final = builder_final.compile()
 
+graph_final = lazy("graph_final", build_graph_final)
@@ -1,15 +1,13 @@
-from groq import Groq
-from langchain_groq import ChatGroq
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough, RunnableMap, RunnableLambda
-from langchain_openai import ChatOpenAI
-import pickle
 import re
 import os
 from dotenv import load_dotenv
 load_dotenv()
 import streamlit as st
+from llm_cache import memoized
+from startup import lazy
 
 def strip_think_block(text: str) -> str:
     return re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL).strip()
@@ -17,9 +15,17 @@ def strip_think_block(text: str) -> str:
 model_name = 'openai/gpt-oss-20b'
 #model_name = 'qwen/qwen3-32b'
 #model_name = 'deepseek-r1-distill-llama-70b'
-api_key=st.secrets["OPENAI_API_KEY"]
-#model = ChatGroq(temperature=0, model_name=model_name,response_format={"type": "text"})
-model=ChatOpenAI(model="gpt-4o",temperature=0,api_key=api_key)
+
+
+def _build_model():
+    # Imported here so the OpenAI client stack loads on first use, not at import
+    from langchain_openai import ChatOpenAI
+    api_key=st.secrets["OPENAI_API_KEY"]
+    #model = ChatGroq(temperature=0, model_name=model_name,response_format={"type": "text"})
+    return ChatOpenAI(model="gpt-4o",temperature=0,api_key=api_key)
+
+
+model = lazy("openai_model", _build_model)
 ##model = model | RunnableLambda(strip_think_block)
 
 ################################################ Sub question #############################
@@ -59,6 +65,7 @@ Additional Guidelines:
 - Your ONLY job is to check whether a specific subpart of the question can be answered from a table based on its description.
 - If multiple subquestions map to the same table, group them into a single list entry like club multiple subquestions into 1 single question.
 - A table might not answer a subquestion, but adding it might act as a link with another table selected by different agent that helps answering user question. Think in this way while selecting a table. If selected table has all information, ignore other tables.
+- Tables described as "PREFERRED reporting view" already contain the joined dimension columns. When such a table covers the subquestions, select it instead of the tables it was built from.
 - STRICTLY exclude subquestions that no table can answer.
 - Length of each sublist should be exactly 2 as per below output format.
 
@@ -113,9 +120,9 @@ chain_subquestion = (
         "user_query": lambda x: x["user_query"]
     })
     | template_subquestion
-    | model
+    | memoized(model, "chain_subquestion")
     | StrOutputParser()
-)
+).with_config(run_name="chain_subquestion")
 
 #########################################column selection######################333
 
@@ -185,9 +192,9 @@ chain_column_extractor = (
         "main_question": lambda x: x["main_question"]
     })
     | template_column
-    | model
+    | memoized(model, "chain_column_extractor")
     | StrOutputParser()
-)
+).with_config(run_name="chain_column_extractor")
 
 ############################### Decision#####################
 
@@ -242,9 +249,9 @@ chain_filter_extractor = (
         "query": lambda x: x["query"]
     })
     | template_filter_check
-    | model 
+    | memoized(model, "chain_filter_extractor")
     | StrOutputParser() | RunnableLambda(strip_think_block)
-)
+).with_config(run_name="chain_filter_extractor")
 
 ########################################## QUERY generation #################################3
 
@@ -269,6 +276,8 @@ HOW TO THINK STEP BY STEP:
 - Do NOT drop or skip any columns under any circumstances.
 - Avoid using reserved SQL keywords like or, and, or as as aliases, as they may cause query errors.
 - Use CTE if query is big.
+- If a "PREFERRED reporting view" (rv_*) provides all the listed columns, query it directly instead of re-joining its source tables.
+- For totals or filters under a parent profit center, cost center, cost element or functional area, use the matching *_hierarchy_closure table when its columns are listed: join on the descendant code column and filter the ancestor_* column. Do not write recursive CTEs over the *_hierarchy tables.
 
 - Check if there are any filters mentioned in "Applicable filters" below.
   - If yes, verify that they match column types and values.
@@ -296,6 +305,9 @@ Relevant tables and columns:
 
 Applicable filters:
 {filters}
+
+Previous attempt that failed on the database (if any, fix the error and return the corrected query):
+{error_feedback}
 ''')
 ])
 
@@ -306,12 +318,13 @@ chain_query_extractor = (
     RunnableMap({
         "columns": lambda x: x["columns"],
         "query": lambda x: x["query"],
-        "filters": lambda x: x["filters"]
+        "filters": lambda x: x["filters"],
+        "error_feedback": lambda x: x.get("error_feedback", "None"),
     })
     | template_sql_query
-    | model
+    | memoized(model, "chain_query_extractor")
     | StrOutputParser() | RunnableLambda(strip_think_block)
-)
+).with_config(run_name="chain_query_extractor")
 
 
 ############################################# Validation ################
@@ -338,6 +351,7 @@ You must enforce the following rules with **strict accuracy**:
 - **All selected columns are mandatory**. Every column provided is crucial for business logic, traceability, auditability, or correctness. **They must appear in the query in a relevant and meaningful way, based on their descriptions.**
 - If any selected column is missing, misused, or ignored, the query must be rewritten accordingly.
 - If the query involves filtering grouped results or counting grouped records, use subqueries where appropriate to avoid logical conflicts between GROUP BY, HAVING, and aggregate functions in the SELECT clause
+- Keep joins on *_hierarchy_closure tables for hierarchy rollups; do not rewrite them as recursive CTEs.
 - Validate all SQL **aliases** especially in joins—for clarity and consistency.
 -  Remove/REPLACE any reserved SQL keywords like 'or', 'and', or 'as' as aliases, as they may cause query errors in the given SQL
 - Ensure **complete syntactic correctness** of the SQL statement.
@@ -358,6 +372,9 @@ You must enforce the following rules with **strict accuracy**:
 
 **SQL Query to Validate:**  
 {sql_query}
+
+**Issues Found by Static Checks (fix all of these):**  
+{issues}
 ''')
 ])
 
@@ -368,8 +385,9 @@ chain_query_validator = (
         "query": lambda x: x["query"],
         "filters": lambda x: x["filters"],
         'sql_query': lambda x: x["sql_query"],
+        "issues": lambda x: x.get("issues", "None"),
     })
     | template_validation
-    | model
+    | memoized(model, "chain_query_validator")
     | StrOutputParser()| RunnableLambda(strip_think_block)
-)
+).with_config(run_name="chain_query_validator")
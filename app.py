@@ -1,106 +1,229 @@
+import os
+import threading
 import streamlit as st
 import pandas as pd
-from sqlalchemy import create_engine, text
-from sqlalchemy.exc import SQLAlchemyError
-from pipeline import graph_main, engine  # reuse pipeline + engine
-import io
-# ---------------- Utility ----------------
-import re
-
-def extract_sql_from_output(output: str) -> str:
-    """
-    Extracts only the SQL query from an LLM response.
-    Handles cases with ```sql fences or extra text.
-    """
-    if not output:
-        return ""
+from pipeline import graph_main, learn_template, stream_graph, template_store
+from sql_runner import execute_streaming, StreamedResult
+from sql_validator import extract_sql_from_output
+from query_guard import execute_with_repair
+from instrumentation import metrics_run
+from question_cache import QuestionCache
+import db
+from entity_linker import entity_linker
+from replay import record_live
 
-    # Look for SQL inside ```sql ... ```
-    match = re.search(r"```sql\s+(.*?)```", output, re.DOTALL | re.IGNORECASE)
-    if match:
-        return match.group(1).strip()
 
-    # Look for SQL inside generic ``` ... ```
-    match = re.search(r"```(.*?)```", output, re.DOTALL)
-    if match:
-        return match.group(1).strip()
+# Render each pipeline stage as it completes ("0" waits for the full result)
+APP_STREAMING = os.getenv("APP_STREAMING", "1") != "0"
+# Largest spooled result offered as a download; Streamlit holds download data in memory
+APP_DOWNLOAD_MAX_BYTES = int(os.getenv("APP_DOWNLOAD_MAX_BYTES", str(100 * 1024 * 1024)))
 
-    # If no fences, return the raw output (assume it's already SQL)
-    return output.strip()
 
-def run_sql(query: str):
-    """
-    Run SQL query safely with proper error handling.
-    Ensures rollback and connection closure in case of errors.
-    Returns either a DataFrame or an error message.
-    """
-    conn = None
+@st.cache_resource
+def get_question_cache():
+    return QuestionCache()
+
+
+def _warm_database():
     try:
-        conn = engine.connect()
-        trans = conn.begin()  # start transaction explicitly
-        df = pd.read_sql(text(query), conn)
-        trans.commit()
-        return df
-    except SQLAlchemyError as e:
-        if conn:
-            try:
-                trans.rollback()
-            except Exception:
-                pass  # ignore rollback failure
-        return f"❌ SQLAlchemy error: {str(e.__cause__ or e)}"
+        db.warm_up()
+        entity_linker.refresh()
     except Exception as e:
-        if conn:
-            try:
-                trans.rollback()
-            except Exception:
-                pass
-        return f"❌ Unexpected error: {str(e)}"
-    finally:
-        if conn:
-            conn.close()
+        print(f"⚠️ Database warm-up failed: {e}")
+
+
+@st.cache_resource
+def warm_database():
+    """Open pooled connections once per process, in the background, so the first question skips TLS setup."""
+    thread = threading.Thread(target=_warm_database, daemon=True)
+    thread.start()
+    return thread
+
+
+def stage_slots():
+    """Placeholders for each pipeline stage, filled in as results arrive."""
+    st.write("### 🔍 Router Output")
+    router_slot = st.empty()
+    st.write("### 🗂️ Selected Tables & Columns")
+    columns_slot = st.container()
+    st.write("### 🎯 Filters")
+    filters_slot = st.empty()
+    st.write("### 📝  SQL Query")
+    sql_slot = st.empty()
+    st.write("### 📝 Final SQL Query")
+    final_slot = st.empty()
+    return {"router": router_slot, "columns": columns_slot, "filters": filters_slot,
+            "sql": sql_slot, "final": final_slot}
+
+
+def show_stage(slots, node, output):
+    """Render the output of one graph node (or the matching keys of a full result)."""
+    if node == "sql_template":
+        # A matched template carries the whole state; otherwise the node has no output
+        for stage in ("router", "dim", "sales", "expense", "filter_check", "query_generator", "query_validation"):
+            if output:
+                show_stage(slots, stage, output)
+    elif node == "router":
+        slots["router"].json(output.get("router_out", []))
+    elif node in ("dim", "sales", "expense"):
+        rows = [
+            {"table": str(col[0]).replace("name of table:", ""), "column": col[1],
+             "description": col[2] if len(col) > 2 else ""}
+            for col in (output.get(f"{node}_out") or {}).get("column_extract", []) if len(col) >= 2
+        ]
+        if rows:
+            slots["columns"].caption(f"{node} agent")
+            slots["columns"].dataframe(pd.DataFrame(rows), hide_index=True)
+    elif node == "filter_check":
+        filters = output.get("filter_extractor") or ["no"]
+        resolved = output.get("fuzz_match") or []
+        if filters[0] == "no" and not resolved:
+            slots["filters"].caption("No filters needed")
+        else:
+            slots["filters"].json(resolved + filters[1:])
+    elif node == "fuzz_filter":
+        slots["filters"].json(output.get("fuzz_match", []))
+    elif node == "query_generator":
+        slots["sql"].code(output.get("sql_query", "No query generated"), language="sql")
+    elif node == "query_validation":
+        slots["final"].code(output.get("final_query", "No query generated"), language="sql")
+
+
+def request_cancel():
+    event = st.session_state.pop("cancel_event", None)
+    if event is not None:
+        event.set()
+        st.session_state["cancelled"] = True
+
+
+def run_streaming(user_q, slots, run):
+    """
+    Run graph_main through stream_graph, rendering every stage and the SQL tokens as
+    they arrive. Returns the final state, or None if the user cancelled the run.
+    """
+    cancel = threading.Event()
+    st.session_state["cancel_event"] = cancel
+    status = st.status("🔎 Processing...", expanded=False)
+    tokens = {}
+    for kind, node, data in stream_graph(user_q, config=run.config(), cancel_event=cancel):
+        if kind == "update":
+            status.update(label=f"🔎 Finished {node}...")
+            show_stage(slots, node, data)
+        elif kind == "token":
+            tokens[node] = tokens.get(node, "") + data
+            slots["sql" if node == "query_generator" else "final"].code(tokens[node], language="sql")
+        else:
+            st.session_state.pop("cancel_event", None)
+            status.update(label="✅ SQL generated", state="complete")
+            return data
+    run.outcome = "cancelled"
+    status.update(label="⏹ Cancelled", state="error")
+    return None
+
 
 st.set_page_config(page_title="LangGraph Text2SQL", layout="wide")
 st.title("🧠 LangGraph + OpenAI based Text2SQL Agent")
+warm_database()
 
 user_q = st.text_input("💬 Enter your question:")
+download_format = st.radio("Download format", ["CSV", "Parquet"], horizontal=True)
+
+if st.session_state.pop("cancelled", False):
+    st.warning("⏹ The previous run was cancelled.")
 
 if st.button("Run Query") and user_q:
-    with st.spinner("🔎 Processing..."):
+    if APP_STREAMING:
+        # Clicking re-runs the script, which stops this run at its next UI update
+        st.button("⏹ Cancel", on_click=request_cancel)
+    with st.spinner("🔎 Processing..."), metrics_run(user_q) as run:
         try:
-            result = graph_main.invoke({"user_query": user_q})
-
-            st.write("### 🔍 Router Output")
-            st.json(result.get("router_out", {}))
-
-            st.write("### 📝  SQL Query")
-            sql_query1 = result.get("sql_query", "No query generated")
-            st.code(sql_query1, language="sql")
+            question_cache = get_question_cache()
+            result = question_cache.get(user_q)
+            cache_hit = result is not None
+            slots = stage_slots()
+            if cache_hit:
+                st.info("⚡ Served from question cache")
+            elif APP_STREAMING:
+                result = run_streaming(user_q, slots, run)
+            else:
+                result = graph_main.invoke({"user_query": user_q}, config=run.config())
 
-            st.write("### 📝 Final SQL Query")
-            sql_query = result.get("final_query", "No query generated")
-            st.code(sql_query, language="sql")
+            if result is not None and (cache_hit or not APP_STREAMING):
+                for node in ("router", "dim", "sales", "expense", "filter_check", "fuzz_filter",
+                             "query_generator", "query_validation"):
+                    show_stage(slots, node, result)
+            if result is not None and not cache_hit:
+                record_live(user_q, result, run)
+            sql_query = result.get("final_query", "No query generated") if result is not None else None
 
             if sql_query and "SELECT" in sql_query.upper():
                 sql_query_new = extract_sql_from_output(sql_query)
-                df = run_sql(sql_query_new)
 
-                if isinstance(df, pd.DataFrame):
+                # Drop the spool file of the previous query in this session
+                previous = st.session_state.pop("result_spool", None)
+                if previous is not None:
+                    previous.cleanup()
+
+                table_slot = st.empty()
+                progress_slot = st.empty()
+
+                def show_progress(rows, preview):
+                    progress_slot.caption(f"⏳ Fetched {rows:,} rows...")
+                    table_slot.dataframe(preview)
+
+                fmt = "parquet" if download_format == "Parquet" else "csv"
+                df, executed_sql, attempts = execute_with_repair(
+                    sql_query_new, result, lambda q: execute_streaming(q, fmt=fmt, on_chunk=show_progress)
+                )
+                if len(attempts) > 1:
+                    with st.expander(f"🔁 SQL was repaired {len(attempts) - 1} time(s)"):
+                        for attempt in attempts:
+                            st.code(attempt["sql"], language="sql")
+                            if attempt["error"]:
+                                st.caption(attempt["error"])
+                    result["final_query"] = executed_sql
+                if result.get("sql_template") and (len(attempts) > 1 or not isinstance(df, StreamedResult)):
+                    template_store.forget(result["sql_template"])
+
+                if isinstance(df, StreamedResult):
+                    st.session_state["result_spool"] = df
                     st.success("✅ Query executed successfully")
-                    st.dataframe(df)
+                    if df.cached:
+                        st.info("⚡ Results served from the result cache (tables unchanged since the last run)")
+                    if result.get("sql_template"):
+                        st.info("📐 SQL reused from a verified question of the same shape")
+                    if not cache_hit:
+                        question_cache.put(user_q, result)
+                        learn_template(user_q, result, executed_sql)
+                    table_slot.dataframe(df.preview)
+                    note = f"{df.total_rows:,} rows"
+                    if df.truncated:
+                        note += f" (stopped at the {df.total_rows:,} row cap)"
+                    if df.total_rows > len(df.preview):
+                        note += f"; showing the first {len(df.preview):,}"
+                    progress_slot.caption(note)
 
-                    # --- Download functionality ---
-                    csv_buffer = io.StringIO()
-                    df.to_csv(csv_buffer, index=False)
+                    # --- Download functionality (file is read from the spool only on click) ---
+                    label, data = f"⬇️ Download Results as {download_format}", df.read_bytes
+                    if df.size > APP_DOWNLOAD_MAX_BYTES:
+                        st.warning(f"⚠️ The full result is {df.size / 2**20:,.0f} MB, above the "
+                                   f"{APP_DOWNLOAD_MAX_BYTES / 2**20:,.0f} MB download limit; "
+                                   f"the download holds the first {len(df.preview):,} rows")
+                        label, data = f"⬇️ Download first {len(df.preview):,} rows as {download_format}", df.preview_bytes
                     st.download_button(
-                        label="⬇️ Download Results as CSV",
-                        data=csv_buffer.getvalue(),
-                        file_name="query_results.csv",
-                        mime="text/csv",
+                        label=label,
+                        data=data,
+                        file_name="query_results." + fmt,
+                        mime="application/vnd.apache.parquet" if fmt == "parquet" else "text/csv",
+                        on_click="ignore",
                     )
                 else:
+                    run.outcome = "sql_error"
                     st.error(df)
-            else:
+            elif result is not None:
+                run.outcome = "no_sql"
                 st.warning("⚠️ No valid SQL query was generated.")
 
         except Exception as e:
+            run.outcome = f"error:{type(e).__name__}"
             st.error(f"❌ Pipeline failed: {e}")
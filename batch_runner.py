@@ -0,0 +1,193 @@
+"""
+Batch SQL generation for saved business questions.
+
+    python batch_runner.py questions.txt -o results.jsonl --workers 8 --execute
+
+Questions are read from a .txt file (one per line) or a .jsonl file with
+"question" and optional "id" fields. One JSON line is appended per question as
+soon as it finishes, and questions already present in the output file are
+skipped, so an interrupted batch can be resumed by rerunning the same command.
+
+Work shared across the batch:
+- questions with the same normalized form run once;
+- routing is done once per question shape (entity values and dates replaced,
+  the columns of the linked entities kept), so "gross sales for B001 in Jan
+  2025" and "gross sales for B002 in Mar 2024" share one router call;
+- column selection is done once per (table, subquestion), without the main
+  question, so questions that split into the same subquestion share it;
+- LLM prompts that are identical across runs are answered once by the chain
+  memo (the subquestion, filter and SQL prompts embed the question, so in
+  practice only exact repeats).
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import llm_cache
+from instrumentation import metrics_run
+import sql_templates
+from pipeline import graph_main
+from query_guard import execute_with_repair
+from question_cache import question_key
+from sql_runner import StreamedResult, execute_streaming
+from sql_validator import extract_sql_from_output
+
+BATCH_WORKERS = int(os.getenv("BATCH_WORKERS", "8"))
+
+
+def load_questions(path):
+    """Return [(id, question)] from a .txt or .jsonl file."""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for i, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                item = json.loads(line)
+                questions.append((str(item.get("id", i)), item["question"]))
+            else:
+                questions.append((str(i), line))
+    return questions
+
+
+def _done_ids(output_path):
+    done = set()
+    if os.path.exists(output_path):
+        with open(output_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)["id"])
+                except (ValueError, KeyError):
+                    continue  # partial line from a crash
+    return done
+
+
+def _summarise_result(sql, state):
+    """Execute the SQL (with cost guard and repair) and summarise the outcome."""
+    try:
+        out, executed_sql, attempts = execute_with_repair(
+            sql, state, lambda q: execute_streaming(q, preview_rows=5)
+        )
+    except Exception as e:
+        # e.g. the repair LLM failing: record it for this question instead of aborting the batch
+        return {"status": "error", "error": f"{type(e).__name__}: {e}", "executed_sql": sql}
+    if not isinstance(out, StreamedResult):
+        return {"status": "sql_error", "error": out, "executed_sql": executed_sql, "repairs": len(attempts) - 1}
+    out.cleanup()
+    return {
+        "status": "ok",
+        "executed_sql": executed_sql,
+        "repairs": len(attempts) - 1,
+        "rows": out.total_rows,
+        "truncated": out.truncated,
+        "columns": list(out.preview.columns),
+        "sample": json.loads(out.preview.to_json(orient="records", date_format="iso")),
+    }
+
+
+def run_question(question, execute=False):
+    """Run one question through graph_main and build its result record."""
+    start = time.perf_counter()
+    with metrics_run(question) as run:
+        try:
+            state = graph_main.invoke({"user_query": question}, config=run.config())
+        except Exception as e:
+            run.outcome = f"error:{type(e).__name__}"
+            return {"status": "pipeline_error", "error": str(e), "elapsed_s": time.perf_counter() - start}
+
+        final_query = state.get("final_query", "")
+        sql = extract_sql_from_output(final_query)
+        record = {
+            "router_out": state.get("router_out"),
+            "sql_query": state.get("sql_query"),
+            "final_query": final_query,
+            "sql": sql,
+            "validation_issues": state.get("validation_issues"),
+            "status": "ok" if "SELECT" in sql.upper() else "no_sql",
+        }
+        if execute and record["status"] == "ok":
+            record.update(_summarise_result(sql, state))
+        run.outcome = record["status"]
+    record["elapsed_s"] = round(time.perf_counter() - start, 3)
+    return record
+
+
+def run_batch(questions, output_path, workers=BATCH_WORKERS, execute=False):
+    """
+    Run [(id, question)] concurrently with at most `workers` pipelines in flight.
+    Questions with the same normalized form run once and share the result; routing
+    and column selection are shared between questions through llm_cache.step_memo
+    (see the module docstring). A question that raises is recorded with status
+    "error". Returns a summary dict.
+    """
+    done = _done_ids(output_path)
+    pending = [(qid, q) for qid, q in questions if qid not in done]
+
+    groups = {}
+    for qid, q in pending:
+        groups.setdefault(question_key(q), []).append((qid, q))
+
+    # A batch regenerates SQL (e.g. after a prompt change): run the full pipeline, not stored templates
+    sql_templates.SQL_TEMPLATES = False
+    if not llm_cache.llm_memo.enabled:
+        # Share identical sub-results within the batch even when caching is off globally
+        llm_cache.llm_memo = llm_cache.ChainMemo(mode="memory")
+
+    write_lock = threading.Lock()
+    counts = {"questions": len(questions), "skipped": len(questions) - len(pending),
+              "unique": len(groups), "ok": 0, "failed": 0}
+    start = time.perf_counter()
+
+    def write(records):
+        with write_lock, open(output_path, "a", encoding="utf-8") as f:
+            for rec in records:
+                f.write(json.dumps(rec, default=str) + "\n")
+                counts["ok" if rec["status"] == "ok" else "failed"] += 1
+            f.flush()
+
+    def work(normalized, members):
+        try:
+            result = run_question(members[0][1], execute=execute)
+        except Exception as e:
+            print(f"❌ Question {members[0][0]} failed: {e}")
+            result = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+        write([
+            {"id": qid, "question": q, "normalized": normalized, "shared_with": members[0][0], **result}
+            for qid, q in members
+        ])
+
+    llm_cache.step_memo = steps = llm_cache.StepMemo()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = [pool.submit(work, normalized, members) for normalized, members in groups.items()]
+            for i, fut in enumerate(as_completed(futures), start=1):
+                fut.result()
+                print(f"📦 {i}/{len(futures)} unique questions done")
+    finally:
+        llm_cache.step_memo = None
+
+    counts["elapsed_s"] = round(time.perf_counter() - start, 2)
+    counts["llm_cache"] = llm_cache.llm_memo.stats()
+    counts["shared_steps"] = steps.stats()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate SQL for a file of questions")
+    parser.add_argument("questions", help=".txt (one question per line) or .jsonl with a 'question' field")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl", help="JSON-lines output (appended)")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="concurrent pipeline runs")
+    parser.add_argument("--execute", action="store_true", help="run each final SQL and record a result summary")
+    args = parser.parse_args(argv)
+
+    summary = run_batch(load_questions(args.questions), args.output, workers=args.workers, execute=args.execute)
+    print(json.dumps(summary, indent=2))
+    return summary
+
+
+if __name__ == "__main__":
+    main()
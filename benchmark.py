@@ -0,0 +1,479 @@
+"""
+Offline benchmark for the Text2SQL pipeline.
+
+Drives graph_main, graph_final, call_match and run_sql against a deterministic fake
+chat model and a local SQLite (or Postgres, via --db-url) database seeded with
+synthetic SAP-style tables, so pipeline overhead can be measured with no network.
+
+    python benchmark.py --rows 100000 --latency 0.05 --concurrency 1,4,16 --iterations 32
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from sqlalchemy import create_engine, text
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FAKE_SECRETS = {
+    "OPENAI_API_KEY": "sk-benchmark",
+    "GROQ_API_KEY": "gsk-benchmark",
+    "DB_USER": "benchmark",
+    "DB_PASSWORD": "benchmark",
+    "DB_HOST": "localhost",
+    "DBBASE": "benchmark",
+    "DB_PORT": 5432,
+}
+
+# ------------------ Synthetic schema ------------------
+SCHEMA = {
+    "brand_master": {
+        "description": "Mapping of brand id to brand name",
+        "columns": {"brand_id": "TEXT", "brand_name": "TEXT"},
+    },
+    "profit_center_hierarchy": {
+        "description": "Profit centers with parent profit center and the brand each maps to",
+        "columns": {"profit_center_code": "TEXT", "profit_center_name": "TEXT",
+                    "parent_profit_center_code": "TEXT", "brand_id": "TEXT"},
+    },
+    "cost_center_hierarchy": {
+        "description": "Cost centers with parent cost center and functional area",
+        "columns": {"cost_center_code": "TEXT", "cost_center_name": "TEXT",
+                    "parent_cost_center_code": "TEXT", "functional_area_id": "TEXT"},
+    },
+    "cost_element_hierarchy": {
+        "description": "Cost elements with parent cost element",
+        "columns": {"cost_element_code": "TEXT", "cost_element_name": "TEXT",
+                    "parent_cost_element_code": "TEXT"},
+    },
+    "functional_area_hierarchy": {
+        "description": "Functional areas with parent functional area",
+        "columns": {"functional_area_id": "TEXT", "functional_area_name": "TEXT",
+                    "parent_functional_area_id": "TEXT"},
+    },
+    "functional_area_metric_map": {
+        "description": "Mapping of functional area to P&L metric",
+        "columns": {"functional_area_id": "TEXT", "metric": "TEXT"},
+    },
+    "key_figure_metric_map": {
+        "description": "Mapping of key figure to P&L metric like Gross Sales or Net Sales",
+        "columns": {"key_figure": "TEXT", "metric": "TEXT"},
+    },
+    "sales_data": {
+        "description": "Sales by key figure, version, year month and profit center",
+        "columns": {"key_figure": "TEXT", "version": "TEXT", "year_month": "TEXT",
+                    "profit_center_code": "TEXT", "currency": "TEXT", "value": "REAL"},
+    },
+    "income_expense_reporting": {
+        "description": "Revenues and costs by profit center, cost center, cost element and functional area",
+        "columns": {"key_figure": "TEXT", "version": "TEXT", "year_month": "TEXT",
+                    "profit_center_code": "TEXT", "cost_center_code": "TEXT",
+                    "cost_element_code": "TEXT", "functional_area_id": "TEXT",
+                    "currency": "TEXT", "value": "REAL"},
+    },
+}
+
+DIM_SIZES = {"brands": 50, "profit_centers": 200, "cost_centers": 300,
+             "cost_elements": 150, "functional_areas": 20, "key_figures": 12}
+
+QUESTIONS = [
+    "Give me the Gross sales for Brand B001 for the period January 2025",
+    "Total net sales by brand for 2024 actuals",
+    "Gross sales of profit center PC0001 by month",
+    "Expenses by functional area for Brand B002",
+]
+
+FAKE_SQL = (
+    "SELECT b.brand_name, SUM(s.value) AS total_value "
+    "FROM sales_data s "
+    "JOIN profit_center_hierarchy p ON s.profit_center_code = p.profit_center_code "
+    "JOIN brand_master b ON p.brand_id = b.brand_id "
+    "WHERE b.brand_id = 'B001' "
+    "GROUP BY b.brand_name"
+)
+
+FILTERS = ["yes", ["brand_master", "brand_id", "B001, B0002"], ["key_figure_metric_map", "metric", "Gross Sales"]]
+
+# Tables the fake subquestion agent selects when they are offered to it
+FAKE_SUBQUESTION_TABLES = ["sales_data", "brand_master", "profit_center_hierarchy",
+                           "key_figure_metric_map", "income_expense_reporting"]
+
+
+def build_kb():
+    """Knowledge base entries (kb_store layout) for the synthetic schema."""
+    return {
+        table: {
+            "table_description": spec["description"],
+            "columns": {col: f"{col} of {table} ({typ})" for col, typ in spec["columns"].items()},
+        }
+        for table, spec in SCHEMA.items()
+    }
+
+
+# ------------------ Fake chat model ------------------
+def canned_response(prompt: str, responses: dict) -> str:
+    """Pick a deterministic reply based on which chain rendered the prompt."""
+    if "intelligent router" in prompt:
+        return responses.get("router", '["dim", "sales"]')
+    if "subquestion generator" in prompt:
+        tables = [t for t in FAKE_SUBQUESTION_TABLES if f"'{t}'" in prompt]
+        return responses.get("subquestion", json.dumps([[f"details from {t}", t] for t in tables] or [[]]))
+    if "data column selector" in prompt:
+        columns = []
+        for spec in SCHEMA.values():
+            for col in spec["columns"]:
+                if f"'{col}'" in prompt and col not in columns:
+                    columns.append(col)
+        return responses.get("column", json.dumps([[c, f"column {c}"] for c in columns[:4]] or [[]]))
+    if "determine whether filters" in prompt:
+        return responses.get("filter", json.dumps(FILTERS))
+    if "SQL query generator" in prompt:
+        return responses.get("generation", f"```sql\n{FAKE_SQL}\n```")
+    if "query validator" in prompt:
+        return responses.get("validation", f"```sql\n{FAKE_SQL}\n```")
+    return responses.get("default", "[]")
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic chat model with configurable artificial latency."""
+
+    model_name: str = "fake-benchmark"
+    temperature: float = 0.0
+    latency: float = 0.0
+    jitter: float = 0.0
+    responses: dict = {}
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-benchmark"
+
+    def _reply(self, messages):
+        prompt = "\n".join(str(m.content) for m in messages)
+        content = canned_response(prompt, self.responses)
+        usage = {"input_tokens": len(prompt) // 4, "output_tokens": len(content) // 4,
+                 "total_tokens": (len(prompt) + len(content)) // 4}
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=content, usage_metadata=usage))])
+
+    def _delay(self):
+        return self.latency + random.uniform(0, self.jitter)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        time.sleep(self._delay())
+        return self._reply(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._delay())
+        return self._reply(messages)
+
+
+def install_fakes(latency=0.0, jitter=0.0, responses=None):
+    """
+    Route every model and secret lookup to the fakes. Must run before the
+    first question, since models are built on first use (or at import with LAZY_INIT=0).
+    """
+    import streamlit as st
+    import langchain_groq
+    import langchain_openai
+
+    st.secrets = dict(FAKE_SECRETS)
+
+    def factory(*args, **kwargs):
+        return FakeChatModel(latency=latency, jitter=jitter, responses=responses or {})
+
+    langchain_openai.ChatOpenAI = factory
+    langchain_groq.ChatGroq = factory
+
+
+# ------------------ Synthetic database ------------------
+def _synthetic_rows(rows, seed):
+    rnd = random.Random(seed)
+    n = DIM_SIZES
+    brands = [f"B{i:03d}" for i in range(1, n["brands"] + 1)]
+    pcs = [f"PC{i:04d}" for i in range(1, n["profit_centers"] + 1)]
+    ccs = [f"CC{i:04d}" for i in range(1, n["cost_centers"] + 1)]
+    ces = [f"CE{i:04d}" for i in range(1, n["cost_elements"] + 1)]
+    fas = [f"FA_{i:03d}" for i in range(1, n["functional_areas"] + 1)]
+    kfs = [f"KF_{i:03d}" for i in range(1, n["key_figures"] + 1)]
+    metrics = ["Gross Sales", "Net Sales", "Discounts", "COGS", "Advt", "Expenses"]
+    months = [f"{y}{m:02d}" for y in (2023, 2024, 2025) for m in range(1, 13)]
+    versions = ["Actual", "Budget", "Forecast"]
+
+    def parent(codes, i):
+        return codes[(i - 1) // 4] if i > 0 else None
+
+    data = {
+        "brand_master": [{"brand_id": b, "brand_name": f"Brand {b}"} for b in brands],
+        "profit_center_hierarchy": [
+            {"profit_center_code": c, "profit_center_name": f"Profit center {c}",
+             "parent_profit_center_code": parent(pcs, i), "brand_id": brands[i % len(brands)]}
+            for i, c in enumerate(pcs)],
+        "cost_center_hierarchy": [
+            {"cost_center_code": c, "cost_center_name": f"Cost center {c}",
+             "parent_cost_center_code": parent(ccs, i), "functional_area_id": fas[i % len(fas)]}
+            for i, c in enumerate(ccs)],
+        "cost_element_hierarchy": [
+            {"cost_element_code": c, "cost_element_name": f"Cost element {c}",
+             "parent_cost_element_code": parent(ces, i)}
+            for i, c in enumerate(ces)],
+        "functional_area_hierarchy": [
+            {"functional_area_id": c, "functional_area_name": f"Functional area {c}",
+             "parent_functional_area_id": parent(fas, i)}
+            for i, c in enumerate(fas)],
+        "functional_area_metric_map": [{"functional_area_id": c, "metric": metrics[i % len(metrics)]}
+                                       for i, c in enumerate(fas)],
+        "key_figure_metric_map": [{"key_figure": c, "metric": metrics[i % len(metrics)]}
+                                  for i, c in enumerate(kfs)],
+        "sales_data": [
+            {"key_figure": rnd.choice(kfs), "version": rnd.choice(versions), "year_month": rnd.choice(months),
+             "profit_center_code": rnd.choice(pcs), "currency": "USD", "value": round(rnd.uniform(-1e4, 1e5), 2)}
+            for _ in range(rows)],
+        "income_expense_reporting": [
+            {"key_figure": rnd.choice(kfs), "version": rnd.choice(versions), "year_month": rnd.choice(months),
+             "profit_center_code": rnd.choice(pcs), "cost_center_code": rnd.choice(ccs),
+             "cost_element_code": rnd.choice(ces), "functional_area_id": rnd.choice(fas),
+             "currency": "USD", "value": round(rnd.uniform(-1e4, 1e5), 2)}
+            for _ in range(rows)],
+    }
+    return data
+
+
+def seed_database(engine, rows, seed=0):
+    """Create and fill the synthetic tables, replacing any previous copy."""
+    data = _synthetic_rows(rows, seed)
+    with engine.begin() as conn:
+        for table, spec in SCHEMA.items():
+            cols = spec["columns"]
+            conn.execute(text(f"DROP TABLE IF EXISTS {table}"))
+            conn.execute(text(f"CREATE TABLE {table} ({', '.join(f'{c} {t}' for c, t in cols.items())})"))
+            insert = text(f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join(':' + c for c in cols)})")
+            for i in range(0, len(data[table]), 10000):
+                conn.execute(insert, data[table][i:i + 10000])
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sales_pc ON sales_data (profit_center_code)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_ie_pc ON income_expense_reporting (profit_center_code)"))
+
+
+# ------------------ Measurement ------------------
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[k]
+
+
+def _max_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _summarise(drive, concurrency, iterations, trace_memory):
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    latencies, errors = drive()
+    wall = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+
+    return {
+        "concurrency": concurrency,
+        "iterations": iterations,
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "mean_s": sum(latencies) / len(latencies),
+        "p50_s": _percentile(latencies, 50),
+        "p90_s": _percentile(latencies, 90),
+        "p95_s": _percentile(latencies, 95),
+        "p99_s": _percentile(latencies, 99),
+        "throughput_per_s": iterations / wall if wall else 0.0,
+        "peak_traced_mb": peak,
+        "max_rss_mb": _max_rss_mb(),
+    }
+
+
+def measure(fn, concurrency, iterations, trace_memory=False):
+    """Call fn(i) `iterations` times with `concurrency` worker threads and summarise."""
+    def drive():
+        errors = []
+
+        def one(i):
+            start = time.perf_counter()
+            try:
+                fn(i)
+            except Exception as e:
+                errors.append(repr(e))
+            return time.perf_counter() - start
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            latencies = list(pool.map(one, range(iterations)))
+        return latencies, errors
+
+    return _summarise(drive, concurrency, iterations, trace_memory)
+
+
+def measure_async(coro_fn, concurrency, iterations, trace_memory=False):
+    """Await coro_fn(i) `iterations` times on one event loop with at most `concurrency` in flight."""
+    async def drive():
+        semaphore = asyncio.Semaphore(concurrency)
+        errors = []
+
+        async def one(i):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await coro_fn(i)
+                except Exception as e:
+                    errors.append(repr(e))
+                return time.perf_counter() - start
+
+        latencies = await asyncio.gather(*[one(i) for i in range(iterations)])
+        return latencies, errors
+
+    return _summarise(lambda: asyncio.run(drive()), concurrency, iterations, trace_memory)
+
+
+def build_targets(cold_values=False):
+    """Import the pipeline (after install_fakes) and return the benchmark callables."""
+    import agent
+    import fuzzy_match
+    import pipeline
+    import sql_runner
+
+    def run_graph_main(i):
+        pipeline.graph_main.invoke({"user_query": QUESTIONS[i % len(QUESTIONS)]})
+
+    def run_graph_final(i):
+        agent.graph_final.invoke({"user_query": QUESTIONS[i % len(QUESTIONS)], "table_lst": agent.d_store["dim"]})
+
+    def run_call_match(i):
+        if cold_values:
+            fuzzy_match.value_index.invalidate()
+        fuzzy_match.call_match(FILTERS)
+
+    def run_run_sql(i):
+        out = sql_runner.run_sql(FAKE_SQL)
+        if isinstance(out, str):
+            raise RuntimeError(out)
+
+    async def run_graph_main_async(i):
+        await pipeline.graph_main.ainvoke({"user_query": QUESTIONS[i % len(QUESTIONS)]})
+
+    async def run_run_sql_async(i):
+        out = await sql_runner.arun_sql(FAKE_SQL, async_engine=fuzzy_match.value_index.async_engine)
+        if isinstance(out, str):
+            raise RuntimeError(out)
+
+    return {
+        "graph_main": run_graph_main,
+        "graph_final": run_graph_final,
+        "call_match": run_call_match,
+        "run_sql": run_run_sql,
+        "graph_main_async": run_graph_main_async,
+        "run_sql_async": run_run_sql_async,
+    }
+
+
+def use_engine(engine, async_url=None):
+    """Point the shared database layer (primary and replica) at the benchmark database."""
+    import db
+    import fuzzy_match
+
+    db.engine = db.replica_engine = fuzzy_match.engine = engine
+    async_engine = None
+    if async_url:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        from sqlalchemy.pool import NullPool
+
+        # asyncio.run() uses a fresh loop per measurement, so connections are not pooled
+        async_engine = create_async_engine(async_url, poolclass=NullPool)
+        db._async_engines.update(primary=async_engine, replica=async_engine)
+    fuzzy_match.value_index = fuzzy_match.ValueIndex(engine, persist_dir=None, async_engine=async_engine)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline Text2SQL pipeline benchmark")
+    parser.add_argument("--rows", type=int, default=10000, help="rows per fact table")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake LLM latency per call (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random LLM latency (s)")
+    parser.add_argument("--concurrency", default="1,4,16", help="comma separated worker counts")
+    parser.add_argument("--iterations", type=int, default=16, help="calls per concurrency level")
+    parser.add_argument("--targets", default="graph_main,graph_final,call_match,run_sql",
+                        help="any of graph_main, graph_final, call_match, run_sql, graph_main_async, run_sql_async")
+    parser.add_argument("--db-url", default=None, help="SQLAlchemy URL of a local Postgres to seed instead of SQLite")
+    parser.add_argument("--async-db-url", default=None,
+                        help="async SQLAlchemy URL for the *_async targets (defaults to aiosqlite on the SQLite file)")
+    parser.add_argument("--llm-cache", default="off", choices=["off", "memory", "disk"],
+                        help="LLM memoization mode for the run (off measures every call)")
+    parser.add_argument("--result-cache", action="store_true",
+                        help="keep the SQL result cache on (off measures every query against the database)")
+    parser.add_argument("--cold-values", action="store_true", help="drop the value index before each call_match")
+    parser.add_argument("--trace-memory", action="store_true", help="report tracemalloc peak (slower)")
+    parser.add_argument("--json", dest="json_path", default=None, help="write the report to this file")
+    args = parser.parse_args(argv)
+    json_path = os.path.abspath(args.json_path) if args.json_path else None
+
+    workdir = tempfile.mkdtemp(prefix="text2sql_bench_")
+    os.environ.setdefault("METRICS_LOG_PATH", "")
+    os.environ.setdefault("WORKLOAD_LOG_PATH", "")
+    os.environ["LLM_CACHE_MODE"] = args.llm_cache
+    if not args.result_cache:
+        os.environ["RESULT_CACHE_MAX_MB"] = "0"
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+    from kb_store import write_kb
+    write_kb(build_kb(), os.path.join(workdir, "kb.sqlite"))
+
+    if args.db_url:
+        engine = create_engine(args.db_url)
+        async_url = args.async_db_url
+    else:
+        db_path = os.path.join(workdir, "bench.db")
+        engine = create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False})
+        async_url = args.async_db_url or f"sqlite+aiosqlite:///{db_path}"
+    print(f"Seeding synthetic database ({args.rows} rows per fact table)...")
+    seed_database(engine, args.rows)
+
+    install_fakes(latency=args.latency, jitter=args.jitter)
+    targets = build_targets(cold_values=args.cold_values)
+    target_names = [t.strip() for t in args.targets.split(",") if t.strip()]
+    use_engine(engine, async_url if any(t.endswith("_async") for t in target_names) else None)
+
+    report = {"rows": args.rows, "latency": args.latency, "results": {}}
+    levels = [int(c) for c in args.concurrency.split(",") if c]
+    for name in target_names:
+        report["results"][name] = []
+        for level in levels:
+            measure_fn = measure_async if name.endswith("_async") else measure
+            res = measure_fn(targets[name], level, args.iterations, trace_memory=args.trace_memory)
+            report["results"][name].append(res)
+            print(
+                f"{name:12s} c={level:<3d} p50={res['p50_s'] * 1000:8.1f}ms p95={res['p95_s'] * 1000:8.1f}ms "
+                f"p99={res['p99_s'] * 1000:8.1f}ms thr={res['throughput_per_s']:7.2f}/s "
+                f"rss={res['max_rss_mb'] or 0:7.1f}MB errors={res['errors']}"
+            )
+            if res["first_error"]:
+                print(f"    first error: {res['first_error']}")
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    main()
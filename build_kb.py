@@ -0,0 +1,310 @@
+"""
+Build or refresh the knowledge base (kb.sqlite) from the live database.
+
+    python build_kb.py                      # re-annotate only tables that changed
+    python build_kb.py --tables sales_data  # limit the run to some tables
+    python build_kb.py --force              # re-annotate everything
+
+Each table is fingerprinted from its column schema, its hand-written description
+and its (log-bucketed) row estimate. Tables whose fingerprint matches the entry
+already in the KB keep that entry; the others are sampled and sent to the
+annotation LLM concurrently, under a requests-per-minute limit. The finished KB
+is swapped in atomically by kb_store.write_kb.
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import streamlit as st
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda, RunnableMap
+from sqlalchemy import inspect, text
+
+import db
+from kb_store import KB_PATH, KnowledgeBase, write_kb
+from startup import lazy
+
+# Concurrent tables being sampled/annotated
+KB_BUILD_WORKERS = int(os.getenv("KB_BUILD_WORKERS", "4"))
+# Annotation LLM calls allowed per minute across all workers
+KB_BUILD_RPM = float(os.getenv("KB_BUILD_RPM", "30"))
+KB_SAMPLE_ROWS = int(os.getenv("KB_SAMPLE_ROWS", "5"))
+KB_ANNOTATION_MODEL = os.getenv("KB_ANNOTATION_MODEL", "deepseek-r1-distill-llama-70b")
+
+table_description = {
+    'brand_master'  : 'It contains data related to the bmapping of brand id and the name of the brand ',
+    'cost_center_hierarchy' : 'It contains data related to cost center id  , The name of the cost center, the mapping between a cost center and functional area and also the parent cost center id which indicates the rollup cost center for this cost center',
+    'cost_element_hierarchy' : 'It contains data related to cost element id  , The name of the cost element, and also the parent cost element id which indicates the rollup cost element for this cost center',
+    'functional_area_hierarchy' : 'It contains data related to fuctional_area id  , The name of the functional area, and also the parent functional area id which indicates the rollup functional area for this cost center Each  cost center from cost_center_hierarchy is mapped to a functional area id in this table',
+    'functional_area_metric_map' : 'It contains mapping of a functional area to Profit & Loss metric like Net Sales , Gross Sales , Expenses etc',
+    'key_figure_metric_map' : 'It contains mapping of a key figures to Profit & Loss metric like Net Sales , Gross Sales , Expenses etc',
+    'profit_center_hierarchy' : 'It contains data related to profit center id  , The name of the profit center , and also the parent profit center id which indicates the rollup profit center. Each  profit center also maps to the Brand Id from the brand_master table .',
+    'sales_data' : 'It contains data related the actual sales which is segregated by key figure, version,year month, profit center  and value .Each key_figure maps to a business metric which can be found using key_figure_metric_map.Each Profit Center maps to a Brand id which can be found using profit_center_hierarchy. The actual Brand name can be found using the mapping from brand_master . Each Version name is an identifier that tells if the version is an actual version or budget. Currency tells about the transaction Currency used for the transaction.',
+    'income_expense_reporting' : 'It contains data related the actual sales & expenses which is segregated by key figure, version,year month, profit center  and value .Each key_figure maps to a business metric which can be found using key_figure_metric_map.Each Profit Center maps to a Brand id which can be found using profit_center_hierarchy. The actual Brand name can be found using the mapping from brand_master . Each Version name is an identifier that tells if the version is an actual version or budget. Currency tells about the transaction Currency used for the transaction.'
+}
+
+template_annotator = ChatPromptTemplate.from_messages([
+    ("system", """
+You are an intelligent data annotator. Please annotate data as mentioned by human and give output without any verbose and without any additional explantion.
+You will be given sql table description and sample columns from the sql table. The description that you generate will be given as input to text to sql automated system.
+Output of project depends on how you generate description. Make sure your description has all possible nuances.
+
+"""),
+
+    ("human", '''
+
+- Based on the column data, please generate description of entire table along with description for each column and sample values(1 or 2) for each column.
+- While generating column descriptions, please look at sql table description given to you and try to include them in column description. 
+- DONT write generic description . Just write description based on what you see in columns.
+
+      
+Context regarding the tables:
+These tables are standard tables provided by  SAP S4 HANA.
+In SAP S/4HANA, the Cost Element Hierarchy defines the types of expenses and revenues (e.g., salaries, rent, advertising, sales income) and links financial accounts with controlling objects. Cost Centers represent organizational units such as departments or functions where costs are incurred, and each cost center is assigned to a Functional Area that groups similar activities (like production, sales, or administration) for reporting in Profit & Loss statements. Profit Centers represent business units responsible for profitability and are often associated with brands, divisions, or regions. Sales performance is captured in the Sales Data table, which records key figures (sales, margin), versions (plan, actual, forecast), time periods, and the related profit center. The Income and Expense Reporting table consolidates financial performance by linking cost elements, cost centers, functional areas, and profit centers, providing detailed insights into revenues, costs, and profitability across dimensions.
+
+Relationships:
+
+Cost Elements → Cost Centers: Each cost element is posted to a cost center to track where costs occur.
+Cost Centers → Functional Areas: Each cost center belongs to one functional area for P&L grouping.
+Profit Centers can aggregate multiple cost centers and capture sales and expense values.
+Sales Data → Profit Centers: Sales metrics are assigned to profit centers for profitability analysis.
+Income & Expense Reporting brings all together, linking Functional Area, Profit Center, Cost Center, and Cost Element with values, forming the central reporting layer.
+    
+
+Please create a JSON structure that includes:
+
+1. Each column name.
+2. A few sample values for each column (up to 3 values).
+
+The JSON should be simple, valid, and formatted like this:
+
+{{
+  "columns": {{
+    "column1": ["sample_value1", "sample_value2", "sample_value3"],
+    "column2": ["sample_value1", "sample_value2", "sample_value3"]
+  }}
+}}
+
+Important constraints:
+- Do NOT include any reasoning, explanation, or <think> blocks.
+- Do NOT include markdown, code fences, or extra text.
+- The output MUST be valid JSON parsable by standard JSON parsers.     
+SQL table name :
+{sql_tbl_nm}
+     
+SQL table description:
+{description}
+
+Sample rows from the table:
+{data_sample}  
+     
+     ''')
+])
+
+
+def _build_model():
+    from langchain_groq import ChatGroq
+    return ChatGroq(
+        model=KB_ANNOTATION_MODEL,
+        api_key=st.secrets["GROQ_API_KEY"],
+        temperature=0,
+        max_tokens=None
+    )
+
+
+model = lazy("annotation_model", _build_model)
+
+
+def _annotate(prompt_value, config):
+    # Not memoized: build(force=True) must get a fresh annotation for an unchanged prompt,
+    # and unchanged tables are already skipped by their fingerprint
+    return model.invoke(prompt_value, config)
+
+
+chain_annotator = (
+    RunnableMap({
+        "description": lambda x: x["description"],
+        "data_sample": lambda x: x["data_sample"],
+        "sql_tbl_nm": lambda x: x["sql_tbl_nm"],
+    })
+    | template_annotator
+    | RunnableLambda(_annotate, name="annotation_model")
+    | StrOutputParser()
+).with_config(run_name="chain_annotator")
+
+# Bumped when the annotation prompt changes so every table is re-annotated
+PROMPT_VERSION = hashlib.sha256(
+    "".join(str(m.prompt.template) for m in template_annotator.messages).encode("utf-8")
+).hexdigest()[:8]
+
+
+class RateLimiter:
+    """Spaces calls at least 60/rpm seconds apart across threads."""
+
+    def __init__(self, rpm):
+        self.interval = 60.0 / rpm if rpm > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def parse_llm_json(text):
+    """
+    Cleans up LLM output by removing <think> blocks and parsing JSON.
+    Returns a Python object (dict/list) or None if parsing fails.
+    """
+    cleaned = re.sub(r"<think>.*?</think>\n*", "", text, flags=re.DOTALL).strip()
+    match = re.search(r"\{.*\}", cleaned, flags=re.DOTALL)
+    if match:
+        try:
+            return json.loads(match.group(0))
+        except json.JSONDecodeError:
+            return None
+    return None
+
+
+def estimate_rows(conn, table):
+    """Planner row estimate on Postgres (no scan); COUNT(*) elsewhere."""
+    if conn.dialect.name == "postgresql":
+        rows = conn.execute(
+            text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:t)"), {"t": table}
+        ).scalar()
+        if rows is not None and rows >= 0:
+            return int(rows)
+    return int(conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar())
+
+
+def table_fingerprint(engine, table, description):
+    """
+    Hash of the column schema, the description, the prompt version and the row
+    estimate bucketed by powers of two (so re-annotation happens when a table's
+    size roughly doubles or halves, not on every insert).
+    """
+    columns = [(c["name"], str(c["type"])) for c in inspect(engine).get_columns(table)]
+    with db.read_only(engine, op="kb_fingerprint") as conn:
+        rows = estimate_rows(conn, table)
+    payload = json.dumps({
+        "columns": columns,
+        "description": description,
+        "prompt": PROMPT_VERSION,
+        "rows_bucket": int(math.log2(rows + 1)),
+    })
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16], rows
+
+
+def sample_rows(engine, table, rows_estimate, n=KB_SAMPLE_ROWS):
+    """
+    A few rows from `table` without sorting the whole table. On Postgres, large
+    tables are read with TABLESAMPLE SYSTEM sized to return roughly 10*n rows;
+    small tables, other databases and empty samples fall back to LIMIT n.
+    """
+    with db.read_only(engine, op="kb_sample") as conn:
+        if conn.dialect.name == "postgresql" and rows_estimate > 100 * n:
+            percent = min(100.0, max(0.0001, 1000.0 * n / rows_estimate))
+            df = pd.read_sql(text(f"SELECT * FROM {table} TABLESAMPLE SYSTEM ({percent:.4f}) LIMIT {n}"), conn)
+            if len(df):
+                return df
+        return pd.read_sql(text(f"SELECT * FROM {table} LIMIT {n}"), conn)
+
+
+def annotate_table(table, description, engine, limiter, rows_estimate):
+    """Sample `table` and ask the annotation chain for its column descriptions."""
+    df_sample = sample_rows(engine, table, rows_estimate)
+    limiter.wait()
+    raw_response = chain_annotator.invoke({
+        "description": description,
+        "data_sample": json.dumps(df_sample.to_dict(orient="records"), default=str),
+        "sql_tbl_nm": table,
+    }).replace('```', '')
+    parsed = parse_llm_json(raw_response)
+    if not parsed or "columns" not in parsed:
+        raise ValueError(f"Annotation for {table} is not valid JSON: {raw_response[:200]}")
+    return {
+        "table_description": parsed.get("table_description") or description,
+        "columns": parsed["columns"],
+    }
+
+
+def build(tables=None, force=False, kb_path=KB_PATH, workers=KB_BUILD_WORKERS, rpm=KB_BUILD_RPM, engine=None):
+    """
+    Refresh the KB at `kb_path` and return a summary. Tables not in `tables`
+    keep their current entry; a table that fails to annotate keeps its previous
+    entry (if any) and is reported in the summary.
+    """
+    engine = engine if engine is not None else db.engine
+    selected = [t for t in table_description if tables is None or t in tables]
+    existing = {}
+    if os.path.exists(kb_path):
+        existing = KnowledgeBase(kb_path).as_dict()
+
+    limiter = RateLimiter(rpm)
+    summary = {"annotated": [], "unchanged": [], "failed": {}}
+    lock = threading.Lock()
+
+    def refresh(table):
+        description = table_description[table]
+        previous = existing.get(table)
+        try:
+            fingerprint, rows = table_fingerprint(engine, table, description)
+            if not force and previous and previous.get("fingerprint") == fingerprint:
+                with lock:
+                    summary["unchanged"].append(table)
+                return table, previous
+            entry = annotate_table(table, description, engine, limiter, rows)
+        except Exception as e:
+            print(f"❌ {table}: {type(e).__name__}: {e}")
+            with lock:
+                summary["failed"][table] = f"{type(e).__name__}: {e}"
+            return table, previous
+        entry["fingerprint"] = fingerprint
+        print(f"✅ Annotated {table}")
+        with lock:
+            summary["annotated"].append(table)
+        return table, entry
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = dict(pool.map(refresh, selected))
+
+    kb = {t: e for t, e in existing.items() if t in table_description and t not in results}
+    kb.update({t: e for t, e in results.items() if e is not None})
+    # Keep the configured table order; derived tables (hierarchy closures...) are kept as they are
+    kb = {t: kb[t] for t in table_description if t in kb}
+    kb.update({t: e for t, e in existing.items() if t not in kb and e.get("derived")})
+    summary["version"] = write_kb(kb, kb_path)
+    summary["tables"] = len(kb)
+    summary["seconds"] = round(time.perf_counter() - start, 2)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or refresh the Text2SQL knowledge base")
+    parser.add_argument("--tables", nargs="*", default=None, help="only refresh these tables")
+    parser.add_argument("--force", action="store_true", help="re-annotate even if the fingerprint is unchanged")
+    parser.add_argument("--kb-path", default=KB_PATH, help="KB file to update (default: KB_PATH)")
+    parser.add_argument("--workers", type=int, default=KB_BUILD_WORKERS, help="tables processed concurrently")
+    parser.add_argument("--rpm", type=float, default=KB_BUILD_RPM, help="annotation LLM calls per minute")
+    args = parser.parse_args(argv)
+
+    summary = build(args.tables, args.force, args.kb_path, args.workers, args.rpm)
+    print(json.dumps(summary, indent=2))
+    return summary
+
+
+if __name__ == "__main__":
+    main()
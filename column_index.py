@@ -0,0 +1,144 @@
+"""
+BM25 ranking of each table's columns (name, description and sample values) so
+chain_column_extractor only sees the top-k candidates for a subquestion instead
+of the full column catalog. Join keys (code/id columns shared by two or more
+tables) are always kept.
+"""
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+from kb_store import kb, render_columns
+
+
+# Columns offered to the column selector per table (0 = always send every column)
+COLUMN_TOP_K = int(os.getenv("COLUMN_TOP_K", "25"))
+# Columns that can be join keys; measures and attributes shared by the fact tables (value, version...) are not
+COLUMN_JOIN_KEY_PATTERN = os.getenv("COLUMN_JOIN_KEY_PATTERN", r"(_code|_id)$")
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+
+def tokenize(text) -> list:
+    """Lower-cased word tokens; snake_case and camelCase are split, plural 's' dropped."""
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text))
+    tokens = re.findall(r"[a-z0-9]+", text.lower())
+    return [t[:-1] if len(t) > 3 and t.endswith("s") and not t.endswith("ss") else t for t in tokens]
+
+
+class _TableIndex:
+    """BM25 statistics over the columns of one table."""
+
+    def __init__(self, columns: dict):
+        self.names = list(columns)
+        # The column name counts twice: it is the strongest signal
+        self.docs = [Counter(tokenize(name) * 2 + tokenize(columns[name])) for name in self.names]
+        self.lengths = [sum(doc.values()) for doc in self.docs]
+        self.avg_length = (sum(self.lengths) / len(self.lengths)) if self.lengths else 0.0
+        df = Counter(term for doc in self.docs for term in doc)
+        n = len(self.docs)
+        self.idf = {term: math.log(1 + (n - f + 0.5) / (f + 0.5)) for term, f in df.items()}
+
+    def scores(self, query_terms: Counter) -> list:
+        out = []
+        for doc, length in zip(self.docs, self.lengths):
+            score = 0.0
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (self.avg_length or 1))
+            for term, q_tf in query_terms.items():
+                tf = doc.get(term)
+                if tf:
+                    score += q_tf * self.idf[term] * tf * (BM25_K1 + 1) / (tf + norm)
+            out.append(score)
+        return out
+
+
+class ColumnIndex:
+    """
+    Lazily built per-table BM25 indexes over a KnowledgeBase. Rebuilt when the
+    KB version changes.
+    """
+
+    def __init__(self, kb_=kb, top_k=COLUMN_TOP_K, join_key_pattern=COLUMN_JOIN_KEY_PATTERN):
+        self.kb = kb_
+        self.top_k = top_k
+        self.join_key_pattern = re.compile(join_key_pattern)
+        self._version = None
+        self._tables = {}
+        self._join_keys = None
+        self._lock = threading.Lock()
+
+    def _check_version(self):
+        version = self.kb.version
+        if version != self._version:
+            self._tables = {}
+            self._join_keys = None
+            self._version = version
+
+    def join_keys(self) -> set:
+        """
+        Code/id column names shared by two or more KB tables (the keys the SQL joins on).
+        Derived tables (reporting views, closure tables) repeat their source columns and
+        are not counted.
+        """
+        with self._lock:
+            self._check_version()
+            if self._join_keys is None:
+                seen = Counter()
+                for table in self.kb.tables():
+                    if self.kb.entry(table).get("derived"):
+                        continue
+                    seen.update({name.lower() for name in self.kb.columns(table)
+                                 if self.join_key_pattern.search(name.lower())})
+                self._join_keys = {name for name, count in seen.items() if count > 1}
+            return self._join_keys
+
+    def _table(self, table) -> _TableIndex:
+        with self._lock:
+            self._check_version()
+            index = self._tables.get(table)
+            if index is None:
+                index = self._tables[table] = _TableIndex(self.kb.columns(table))
+            return index
+
+    def rank(self, table, question, main_question="", top_k=None) -> list:
+        """
+        The top_k columns of `table` for `question` (weighted over `main_question`)
+        plus every join key, in the table's original column order.
+        """
+        top_k = self.top_k if top_k is None else top_k
+        index = self._table(table)
+        if not top_k or len(index.names) <= top_k:
+            return list(index.names)
+        query = Counter(tokenize(question) * 2 + tokenize(main_question))
+        scores = index.scores(query)
+        best = sorted(range(len(index.names)), key=lambda i: -scores[i])[:top_k]
+        keys = self.join_keys()
+        keep = set(best) | {i for i, name in enumerate(index.names) if name.lower() in keys}
+        return [name for i, name in enumerate(index.names) if i in keep]
+
+    def columns_prompt(self, table, question, main_question="") -> str:
+        """
+        Column list for chain_column_extractor restricted to the ranked columns.
+        Narrow tables get the KB's pre-rendered full list unchanged.
+        """
+        names = self.rank(table, question, main_question)
+        columns = self.kb.columns(table)
+        if len(names) == len(columns):
+            return self.kb.columns_prompt(table)
+        return render_columns({name: columns[name] for name in names})
+
+
+def untrimmed_tables(kb_, top_k=COLUMN_TOP_K):
+    """
+    Tables wider than top_k whose rank() would still keep every column. Run after
+    registering derived tables: a non-empty result means the join keys grew to
+    cover whole tables and the column prompts are no longer reduced.
+    """
+    index = ColumnIndex(kb_, top_k)
+    return [t for t in kb_.tables()
+            if top_k and len(kb_.columns(t)) > top_k and len(index.rank(t, "")) == len(kb_.columns(t))]
+
+
+column_index = ColumnIndex()
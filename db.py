@@ -0,0 +1,180 @@
+"""
+Shared database layer: one pooled engine for analytic queries (the primary),
+an optional read replica for distinct-value lookups, read-only transactions
+with per-statement timeouts, a startup warm-up, and pool-wait/query timings
+recorded in the current metrics run.
+
+Connection settings come from st.secrets (DB_USER, DB_PASSWORD, DB_HOST, DBBASE,
+DB_PORT and optionally DB_REPLICA_HOST); pool settings from the environment.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+
+import streamlit as st
+from sqlalchemy import create_engine, text
+
+from instrumentation import current_run
+from startup import lazy
+
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+# Seconds to wait for a free pooled connection before failing
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Connections older than this are replaced (avoids server/proxy idle disconnects)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Connections opened per engine by warm_up()
+DB_WARMUP_CONNECTIONS = int(os.getenv("DB_WARMUP_CONNECTIONS", "2"))
+# Per-statement timeout applied to generated queries on Postgres (0 = server default)
+SQL_STATEMENT_TIMEOUT_MS = int(os.getenv("SQL_STATEMENT_TIMEOUT_MS", "60000"))
+
+
+def _db_url(driver="postgresql", host=None):
+    """Connection URL from st.secrets, read on first engine use rather than at import."""
+    s = st.secrets
+    return f"{driver}://{s['DB_USER']}:{s['DB_PASSWORD']}@{host or s['DB_HOST']}:{s.get('DB_PORT', 5432)}/{s['DBBASE']}"
+
+
+def _replica_host():
+    return st.secrets.get("DB_REPLICA_HOST")
+
+
+def _pool_options():
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True,
+        # Reuse the most recently returned connection so idle extras can age out
+        "pool_use_lifo": True,
+    }
+
+
+def _create_engine(host=None):
+    return create_engine(
+        _db_url(host=host) + "?sslmode=require",
+        connect_args={"application_name": "text2sql", "keepalives": 1, "keepalives_idle": 30},
+        **_pool_options(),
+    )
+
+
+# Analytic queries (run_sql, execute_streaming, EXPLAIN)
+engine = lazy("engine", _create_engine)
+# Distinct-value lookups for fuzzy matching; the primary unless DB_REPLICA_HOST is set
+replica_engine = lazy("replica_engine", lambda: _create_engine(_replica_host()) if _replica_host() else engine)
+
+_async_engines = {}
+
+
+def get_async_engine(replica=False):
+    """Async (asyncpg) engine for the primary or the replica, created on first use."""
+    role = "replica" if replica else "primary"
+    if role not in _async_engines:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        host = _replica_host() if replica else None
+        if replica and not host:
+            return get_async_engine()
+        _async_engines[role] = create_async_engine(
+            _db_url("postgresql+asyncpg", host), connect_args={"ssl": "require"}, **_pool_options()
+        )
+    return _async_engines[role]
+
+
+def apply_statement_timeout(conn, timeout_ms=None):
+    """SET LOCAL statement_timeout for the current transaction (Postgres only)."""
+    timeout_ms = SQL_STATEMENT_TIMEOUT_MS if timeout_ms is None else timeout_ms
+    if timeout_ms and conn.dialect.name == "postgresql":
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(timeout_ms)}")
+
+
+def prepare_read(conn, timeout_ms=None):
+    """Make the open transaction read-only and apply the statement timeout (Postgres only)."""
+    if conn.dialect.name == "postgresql":
+        conn.exec_driver_sql("SET TRANSACTION READ ONLY")
+    apply_statement_timeout(conn, timeout_ms)
+
+
+def _record(op, waited, started):
+    run = current_run()
+    if run is not None:
+        run.add_db(f"{op}:pool_wait", waited)
+        run.add_db(op, time.perf_counter() - started)
+
+
+@contextmanager
+def read_only(engine_=None, op="run_sql", timeout_ms=None, **execution_options):
+    """
+    Yield a pooled connection inside a read-only transaction with the statement
+    timeout applied. Time spent waiting for the pool and in the block is recorded
+    as `<op>:pool_wait` and `<op>` in the current metrics run.
+    """
+    engine_ = engine_ if engine_ is not None else engine
+    start = time.perf_counter()
+    with engine_.connect() as conn:
+        waited = time.perf_counter() - start
+        started = time.perf_counter()
+        try:
+            if execution_options:
+                conn = conn.execution_options(**execution_options)
+            with conn.begin():
+                prepare_read(conn, timeout_ms)
+                yield conn
+        finally:
+            _record(op, waited, started)
+
+
+@asynccontextmanager
+async def aread_only(async_engine=None, op="run_sql", timeout_ms=None):
+    """Async variant of read_only on an AsyncEngine."""
+    async_engine = async_engine or get_async_engine()
+    start = time.perf_counter()
+    async with async_engine.connect() as conn:
+        waited = time.perf_counter() - start
+        started = time.perf_counter()
+        try:
+            async with conn.begin():
+                await conn.run_sync(prepare_read, timeout_ms)
+                yield conn
+        finally:
+            _record(op, waited, started)
+
+
+def pool_stats():
+    """Checked-out / pooled / overflow connection counts for each engine built so far."""
+    stats = {}
+    for name, eng in (("primary", engine), ("replica", replica_engine)):
+        if not getattr(eng, "built", True) or (name == "replica" and not _replica_host()):
+            continue
+        pool = eng.pool
+        stats[name] = {
+            "size": pool.size() if hasattr(pool, "size") else None,
+            "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+            "overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+        }
+    return stats
+
+
+def warm_up(connections=DB_WARMUP_CONNECTIONS):
+    """
+    Open `connections` pooled connections per engine concurrently and run SELECT 1,
+    so TLS handshakes and authentication happen at startup instead of on the first
+    question. Returns the seconds taken per engine.
+    """
+    timings = {}
+    for name, eng in (("primary", engine), ("replica", replica_engine)):
+        if name == "replica" and not _replica_host():
+            continue
+        start = time.perf_counter()
+
+        def ping(_):
+            with eng.connect() as conn:
+                conn.execute(text("SELECT 1"))
+
+        with ThreadPoolExecutor(max_workers=max(1, connections)) as pool:
+            list(pool.map(ping, range(connections)))
+        timings[name] = time.perf_counter() - start
+        print(f"🔌 Warmed {connections} {name} connections in {timings[name]:.2f}s")
+    return timings
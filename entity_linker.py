@@ -0,0 +1,463 @@
+"""
+Dictionary entity linker for filter values.
+
+Every distinct value of the entity columns (codes, ids, names, key figures,
+versions...) of the KB tables is compiled into a word-level Aho-Corasick
+automaton. One pass over the question finds every value it mentions and emits
+resolved filters in the fuzz_match format, so pipeline.filter_check only calls
+chain_filter_extractor when part of the question looks like a filter the
+dictionary could not resolve, or has words that are neither linked values,
+schema terms nor question words (synonyms and abbreviations such as
+"Advertisement" for "Advt" are left to the LLM).
+
+Values made of ordinary words ("Actual", "Expenses") are only linked next to
+their entity noun ("version Actual", "Expenses metric"), except in vocabulary
+columns (key figures, metrics, versions), which are linked anywhere unless an
+unknown word is right next to them ("Advertisement expenses").
+"""
+import ast
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import text
+
+import fuzzy_match
+from kb_store import kb
+from question_cache import MONTHS, STOPWORDS
+
+
+# Columns whose values are linked ("" disables the linker)
+ENTITY_COLUMN_PATTERN = os.getenv(
+    "ENTITY_COLUMN_PATTERN", r"(_code|_id|_name)$|^(key_figure|metric|version|currency)$"
+)
+# Columns with more distinct values than this are left to the LLM + fuzzy path
+ENTITY_MAX_VALUES = int(os.getenv("ENTITY_MAX_VALUES", "50000"))
+# Columns whose plain-word values ("Gross Sales", "Actual") are linked without their entity noun
+ENTITY_VOCABULARY_PATTERN = os.getenv("ENTITY_VOCABULARY_PATTERN", r"^(key_figure|metric|version|currency)$")
+# "dictionary": LLM filter extraction only for unresolved spans; "llm": always call the LLM
+FILTER_LINKER_MODE = os.getenv("FILTER_LINKER_MODE", "dictionary")
+
+# Words that can follow an entity noun without naming an entity ("by brand and month", "brand wise")
+NON_ENTITY_WORDS = STOPWORDS | {
+    "month", "year", "with", "and", "all", "by", "wise", "level", "hierarchy", "name", "code", "id", "total", "each", "per", "or", "vs",
+    "versus", "from", "over", "across", "between", "which", "that", "have", "has", "had",
+}
+# Words that ask for a measure, grain or ranking rather than name a filter value
+QUESTION_WORDS = {
+    "sum", "average", "avg", "mean", "count", "number", "how", "many", "much", "top", "bottom", "highest",
+    "lowest", "max", "maximum", "min", "minimum", "trend", "compare", "comparison", "breakdown", "split",
+    "growth", "change", "share", "ratio", "percent", "percentage", "last", "previous", "next", "current", "this",
+    "ytd", "mtd", "qtd", "monthly", "yearly", "annual", "quarter", "quarterly", "week", "weekly", "day", "daily",
+    "date", "first", "latest", "do", "does", "did", "we", "our", "my", "us", "it", "they", "their", "be", "been",
+    "there", "why", "where", "when", "who", "up", "down", "into", "not", "no", "without", "only", "except",
+    "than", "more", "less", "above", "below", "greater", "under", "sort", "sorted", "order", "rank", "ranked",
+    "group", "grouped", "value", "amount", "overall", "grand", "both", "same", "like",
+}
+# Letter+digit tokens that are periods rather than entity codes (Q1, H2, FY2025, jan2025)
+PERIOD_RE = re.compile(
+    r"^(q[1-4]|h[12]|fy\d{2,4}|\d{4}[qh]?\d?|(" + "|".join(MONTHS) + r")[\-_]?\d{2,4}|\d{1,2}(st|nd|rd|th))$"
+)
+CODE_RE = re.compile(r"[A-Za-z0-9][A-Za-z0-9_\-]*")
+# Columns holding the code of an entity; names are mapped to these for canonical mentions
+CODE_COLUMN_RE = re.compile(r"(_code|_id)$")
+QUOTED_RE = re.compile(r"'([^']+)'|\"([^\"]+)\"")
+
+
+def _word(token):
+    """Match form of a word: lower case, plural 's' dropped from alphabetic words."""
+    if len(token) > 3 and token.isalpha() and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+    return token
+
+
+def tokens_with_spans(text):
+    """[(word, start, end)] of a text; punctuation and '_' separate words."""
+    return [(_word(m.group()), m.start(), m.end()) for m in re.finditer(r"[a-z0-9]+", str(text).lower())]
+
+
+def parse_filter_output(response: str) -> list:
+    """
+    Parse chain_filter_extractor output (["no"] or ["yes", [table, column, values], ...])
+    without eval. Unparseable or malformed replies are treated as ["no"].
+    """
+    body = re.sub(r"^\s*(json|python)\s*\n", "", str(response).replace("```", ""), flags=re.I).strip()
+    try:
+        parsed = json.loads(body)
+    except ValueError:
+        try:
+            parsed = ast.literal_eval(body)
+        except (ValueError, SyntaxError):
+            print(f"⚠️ Could not parse the filter extractor output, assuming no filters: {body[:200]!r}")
+            return ["no"]
+    if not isinstance(parsed, list) or not parsed or str(parsed[0]).lower() != "yes":
+        return ["no"]
+    entries = [[str(x) for x in e[:3]] for e in parsed[1:] if isinstance(e, (list, tuple)) and len(e) >= 3]
+    return ["yes", *entries] if entries else ["no"]
+
+
+def merge_filters(*filter_lists):
+    """Concatenate fuzz_match style filter lists, dropping duplicates."""
+    seen, merged = set(), []
+    for filters in filter_lists:
+        for f in filters or []:
+            key = tuple(str(x).lower() for x in f)
+            if key not in seen:
+                seen.add(key)
+                merged.append(f)
+    return merged
+
+
+class _Automaton:
+    """Aho-Corasick automaton over word sequences."""
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]   # node -> [(pattern length, payload)]
+
+    def add(self, words, payload):
+        node = 0
+        for w in words:
+            nxt = self.goto[node].get(w)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][w] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            node = nxt
+        self.out[node].append((len(words), payload))
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for w, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and w not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(w, 0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+        return self
+
+    def scan(self, words):
+        """Yield (start, end, payload) word ranges for every pattern occurrence."""
+        node = 0
+        for i, w in enumerate(words):
+            while node and w not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(w, 0)
+            for length, payload in self.out[node]:
+                yield i - length + 1, i + 1, payload
+
+
+def _table_column(item):
+    """(table, column) of a column_extract item such as ["name of table:sales_data", "brand", "..."]."""
+    return str(item[0]).replace("name of table:", "").strip(), str(item[1]).strip()
+
+
+class EntityLinker:
+    """
+    Links question spans to (table, column, value) filters. The automaton is
+    built on first use from the value index and rebuilt when the KB version
+    changes or the value index TTL has passed.
+    """
+
+    def __init__(self, kb_=kb, pattern=ENTITY_COLUMN_PATTERN, max_values=ENTITY_MAX_VALUES,
+                 ttl=fuzzy_match.VALUE_INDEX_TTL, vocabulary=ENTITY_VOCABULARY_PATTERN):
+        self.kb = kb_
+        self.pattern = re.compile(pattern) if pattern else None
+        self.vocabulary = re.compile(vocabulary) if vocabulary else None
+        self.max_values = max_values
+        self.ttl = ttl
+        self._automaton = None
+        self._nouns = set()
+        self._column_nouns = {}     # column -> entity noun words
+        self._ordinary = set()      # patterns of ordinary words, linked only next to their noun
+        self._known_words = set()   # schema terms and question words, never a leftover filter word
+        self._patterns = {}         # value words -> [(table, column, value)]
+        self._name_codes = None     # (table, name column, value) -> (code column, code), loaded on first use
+        self._version = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()   # one synchronous rebuild at a time
+
+    def entity_columns(self):
+        if self.pattern is None:
+            return []
+        return [(t, c) for t in self.kb.tables() for c in self.kb.columns(t) if self.pattern.search(c.lower())]
+
+    def _stale(self):
+        return (self._automaton is None or self._version != self.kb.version
+                or time.time() - self._built_at > self.ttl)
+
+    @staticmethod
+    def _is_ordinary(value, words):
+        """True for values spelled as plain words ("Actual"), not codes ("B001") or acronyms ("USD")."""
+        return all(w.isalpha() for w in words) and not str(value).isupper()
+
+    def _build(self, columns, values):
+        automaton, patterns, nouns, column_nouns, codes = _Automaton(), {}, set(), {}, set()
+        for (table, column), vals in zip(columns, values):
+            noun = tuple(_word(w) for w in re.sub(r"(_code|_id|_name)$", "", column.lower()).split("_"))
+            nouns.add(noun)
+            column_nouns[column] = noun
+            if len(vals) > self.max_values:
+                print(f"⚠️ {table}.{column} has {len(vals)} values, not linked")
+                continue
+            for value in vals:
+                words = tuple(w for w, _, _ in tokens_with_spans(value))
+                # Bare numbers and one-letter values are too ambiguous to link
+                if not words or (len(words) == 1 and (words[0].isdigit() or len(words[0]) < 2)):
+                    continue
+                if words not in patterns:
+                    patterns[words] = []
+                    automaton.add(words, patterns[words])
+                patterns[words].append((table, column, str(value)))
+                if not self._is_ordinary(value, words):
+                    codes.add(words)
+        known = {w for t in self.kb.tables() for name in [t, *self.kb.columns(t)]
+                 for w, _, _ in tokens_with_spans(name)}
+        known |= {w for words in NON_ENTITY_WORDS | QUESTION_WORDS for w, _, _ in tokens_with_spans(words)}
+        self._automaton, self._nouns, self._column_nouns = automaton.build(), nouns, column_nouns
+        self._patterns, self._name_codes = patterns, None
+        self._ordinary = set(patterns) - codes
+        self._known_words = known | {w for noun in nouns for w in noun}
+        self._version, self._built_at = self.kb.version, time.time()
+        print(f"📖 Entity dictionary built: {len(patterns)} values from {len(columns)} columns")
+
+    def refresh(self):
+        """(Re)build the automaton from the value index."""
+        columns = self.entity_columns()
+        values = []
+        for table, column in columns:
+            try:
+                values.append(fuzzy_match.value_index.get(table, column))
+            except Exception as e:
+                print(f"⚠️ Could not load {table}.{column} for the entity dictionary: {e}")
+                values.append([])
+        with self._lock:
+            self._build(columns, values)
+
+    async def arefresh(self):
+        """Async variant of refresh; the columns are loaded concurrently."""
+        columns = self.entity_columns()
+        values = await asyncio.gather(
+            *[fuzzy_match.value_index.aget(t, c) for t, c in columns], return_exceptions=True
+        )
+        for (table, column), vals in zip(columns, values):
+            if isinstance(vals, Exception):
+                print(f"⚠️ Could not load {table}.{column} for the entity dictionary: {vals}")
+        values = [[] if isinstance(vals, Exception) else vals for vals in values]
+        with self._lock:
+            self._build(columns, values)
+
+    def _unresolved(self, question, words, covered):
+        """Spans that look like filter values, or content words, that were not linked."""
+        def is_covered(start, end):
+            return any(s < end and start < e for s, e in covered)
+
+        spans = []
+        for m in CODE_RE.finditer(question):
+            tok = m.group().lower()
+            if (re.search(r"\d", tok) and re.search(r"[a-z]", tok) and not PERIOD_RE.match(tok)
+                    and not is_covered(m.start(), m.end())):
+                spans.append(m.group())
+        for m in QUOTED_RE.finditer(question):
+            if not is_covered(m.start(), m.end()):
+                spans.append(m.group(1) or m.group(2))
+        # An entity noun directly followed by an unlinked word: "brand Acme"
+        plain = [w for w, _, _ in words]
+        for noun in self._nouns:
+            n = len(noun)
+            for i in range(len(plain) - n):
+                if tuple(plain[i:i + n]) == noun:
+                    nxt, start, end = words[i + n]
+                    if nxt not in NON_ENTITY_WORDS and not nxt.isdigit() and not is_covered(start, end):
+                        spans.append(question[start:end])
+        # Any other word the dictionary and schema do not account for may be a synonym of a value
+        for w, start, end in words:
+            if self._is_content(w) and not is_covered(start, end) and question[start:end] not in spans:
+                spans.append(question[start:end])
+        return spans
+
+    def _is_content(self, word):
+        """True for a word that is not a schema term, question word, month, number or period."""
+        return (word not in self._known_words and word not in MONTHS and not word.isdigit()
+                and not PERIOD_RE.match(word))
+
+    def _next_to_noun(self, plain, start, end, column):
+        """True if the words just before or after plain[start:end] are the column's entity noun."""
+        noun = self._column_nouns.get(column, ())
+        n = len(noun)
+        return bool(n) and (tuple(plain[max(start - n, 0):start]) == noun or tuple(plain[end:end + n]) == noun)
+
+    def _matches(self, words, usable=None):
+        """Leftmost-longest non-overlapping matches: [(start word, end word, locations)]."""
+        plain = [w for w, _, _ in words]
+        matches = sorted(self._automaton.scan(plain), key=lambda m: (m[0], m[0] - m[1]))
+        found, loose, last_end = [], set(), 0
+        for start, end, locations in matches:
+            locations = [loc for loc in locations if usable is None or usable(loc)]
+            free = False
+            if tuple(plain[start:end]) in self._ordinary:
+                near = [loc for loc in locations if self._next_to_noun(plain, start, end, loc[1])]
+                free = not near
+                locations = near or [loc for loc in locations
+                                     if self.vocabulary is not None and self.vocabulary.search(loc[1].lower())]
+            if start < last_end or not locations:
+                continue
+            found.append((start, end, locations))
+            if free:
+                loose.add((start, end))
+            last_end = end
+        # A vocabulary value next to an unknown word is likely part of a longer name ("Advertisement expenses")
+        covered = {i for start, end, _ in found for i in range(start, end)}
+        unknown = {i for i, w in enumerate(plain) if i not in covered and self._is_content(w)}
+        return [(start, end, locations) for start, end, locations in found
+                if (start, end) not in loose or not ({start - 1, end} & unknown)]
+
+    def _link(self, question, columns):
+        selected = [_table_column(c) for c in columns if len(c) >= 2]
+        rank = {tc: i for i, tc in enumerate(selected)}
+        words = tokens_with_spans(question)
+
+        filters, covered = [], []
+        for start, end, usable in self._matches(words, lambda loc: (loc[0], loc[1]) in rank):
+            # One filter per column name: the same code often exists in a dimension and a fact table
+            by_column = {}
+            for table, column, value in sorted(usable, key=lambda loc: rank[(loc[0], loc[1])]):
+                by_column.setdefault(column, (table, column, value))
+            for table, column, value in by_column.values():
+                filters.append(["table name:" + table, "column_name:" + column, "filter_value:" + value])
+            covered.append((words[start][1], words[end - 1][2]))
+        return merge_filters(filters), self._unresolved(question, words, covered)
+
+    def _mention_words(self, words):
+        found = self._matches(words)
+        # Values nested in a longer match ("B001" in "Brand B001") are listed with it
+        for start, end, nested in self._automaton.scan([w for w, _, _ in words]):
+            for s, e, locations in found:
+                if s <= start and end <= e and (s, e) != (start, end):
+                    locations.extend(loc for loc in nested if loc not in locations)
+        return found
+
+    def _mentions(self, question):
+        words = tokens_with_spans(question)
+        return [(words[s][1], words[e - 1][2], locations) for s, e, locations in self._mention_words(words)]
+
+    def _load_name_codes(self):
+        """Name -> code pairs of the tables that hold both columns of an entity (brand_name, brand_id)."""
+        by_table = {}
+        for table, column in self.entity_columns():
+            by_table.setdefault(table, []).append(column)
+        pairs = {}
+        for table, columns in by_table.items():
+            for name in [c for c in columns if c.lower().endswith("_name")]:
+                stem = name[:-len("_name")]
+                code = next((c for c in columns if c.lower() in (stem.lower() + "_id", stem.lower() + "_code")), None)
+                if code is None:
+                    continue
+                try:
+                    with fuzzy_match.engine.connect() as conn:
+                        rows = conn.execute(text(f"SELECT DISTINCT {name}, {code} FROM {table}")).fetchall()
+                except Exception as e:
+                    print(f"⚠️ Could not load {table}.{name} -> {code} for canonical mentions: {e}")
+                    continue
+                for value, code_value in rows:
+                    if value is not None and code_value is not None:
+                        pairs[(table, name, str(value).lower())] = (code, str(code_value))
+        return pairs
+
+    def _code_locations(self, locations, name_codes):
+        """Code/id locations of a mention; names are mapped to their code and every place it occurs."""
+        found = {loc for loc in locations if CODE_COLUMN_RE.search(loc[1].lower())}
+        for table, column, value in locations:
+            mapped = name_codes.get((table, column, value.lower()))
+            if mapped:
+                code_column, code = mapped
+                same = self._patterns.get(tuple(w for w, _, _ in tokens_with_spans(code)), [])
+                found |= {loc for loc in same if CODE_COLUMN_RE.search(loc[1].lower()) and loc[2] == code}
+                found.add((table, code_column, code))
+        return found
+
+    def _canonical_mentions(self, question):
+        words = tokens_with_spans(question)
+        plain = [w for w, _, _ in words]
+        name_codes = self._name_codes
+        if name_codes is None:
+            name_codes = self._name_codes = self._load_name_codes()
+        out = []
+        for s, e, locations in self._mention_words(words):
+            codes = self._code_locations(locations, name_codes)
+            token = "|".join(sorted(f"{t}.{c}={v}" for t, c, v in codes or locations))
+            # "brand B001" and "B001" name the same entity: the noun goes with the span
+            for noun in {self._column_nouns.get(loc[1], ()) for loc in locations}:
+                if noun and tuple(plain[max(s - len(noun), 0):s]) == noun:
+                    s -= len(noun)
+                    break
+            out.append((words[s][1], words[e - 1][2], token))
+        return out
+
+    def _ensure_fresh(self):
+        if self._stale():
+            with self._refresh_lock:
+                if self._stale():
+                    self.refresh()
+
+    def link(self, question, columns):
+        """
+        Returns (filters, unresolved): filters for the question's values that exist in
+        one of the selected `columns` (column_extract items), and the spans that look
+        like filter values but could not be resolved.
+        """
+        if self.pattern is None:
+            return [], [question]
+        self._ensure_fresh()
+        return self._link(question, columns)
+
+    async def alink(self, question, columns):
+        """Async variant of link."""
+        if self.pattern is None:
+            return [], [question]
+        if self._stale():
+            await self.arefresh()
+        return self._link(question, columns)
+
+    def mentions(self, question):
+        """
+        [(start, end, [(table, column, value)])]: character spans of the dictionary
+        values in the question, with the locations of every value inside each span.
+        """
+        if self.pattern is None:
+            return []
+        self._ensure_fresh()
+        return self._mentions(question)
+
+    async def amentions(self, question):
+        """Async variant of mentions."""
+        if self.pattern is None:
+            return []
+        if self._stale():
+            await self.arefresh()
+        return self._mentions(question)
+
+    def canonical_mentions(self, question):
+        """
+        [(start, end, token)]: character spans of the entities in the question (with a
+        preceding entity noun) and a canonical "table.column=value|..." token made of
+        the code locations, so "brand B001", "B001" and the brand's name get the same token.
+        """
+        if self.pattern is None:
+            return []
+        self._ensure_fresh()
+        return self._canonical_mentions(question)
+
+
+entity_linker = EntityLinker()
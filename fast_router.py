@@ -0,0 +1,192 @@
+"""
+Local router for the dim / sales / expense agents.
+
+Each route gets a probability from keyword dictionaries (hand-seeded terms plus
+terms that only occur in that route's KB tables) blended, once enough examples
+exist, with a naive Bayes model trained on logged (question, routes) pairs.
+router_agent.agent_2 only calls the LLM router when this confidence is below
+ROUTER_CONFIDENCE_THRESHOLD, and every LLM decision is logged as a new example.
+"""
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+
+from agent import d_store as ROUTE_TABLES
+from column_index import tokenize
+from kb_store import kb
+
+
+ROUTES = ("dim", "sales", "expense")
+
+
+# Minimum confidence for answering without the LLM router
+ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.75"))
+# JSON lines of {"question": ..., "routes": [...]} used to train the local model ("" disables)
+ROUTER_TRAINING_PATH = os.getenv("ROUTER_TRAINING_PATH", "router_training.jsonl")
+# Examples needed before the trained model contributes to the score
+ROUTER_MIN_TRAINING = int(os.getenv("ROUTER_MIN_TRAINING", "20"))
+
+# Multi-word entities are joined first so "cost center" does not count as "cost"
+PHRASES = {
+    "profit center": "profit_center", "profit centre": "profit_center",
+    "cost center": "cost_center", "cost centre": "cost_center",
+    "cost element": "cost_element", "functional area": "functional_area",
+    "key figure": "key_figure", "profit and loss": "pnl", "p&l": "pnl",
+}
+
+SEED_TERMS = {
+    "dim": {"brand", "name", "hierarchy", "parent", "child", "rollup", "roll", "mapping", "map", "master",
+            "belong", "under", "profit_center", "cost_center", "cost_element", "functional_area",
+            "key_figure", "metric", "description", "attribute"},
+    "sales": {"sale", "sold", "revenue", "gross", "net", "margin", "discount", "turnover", "volume",
+              "plan", "budget", "forecast", "actual", "version"},
+    "expense": {"expense", "cost", "spend", "spending", "opex", "income", "pnl", "loss", "profitability",
+                "advertising", "advt", "salary", "rent", "cogs", "overhead"},
+}
+SEED_WEIGHT = 1.0
+KB_WEIGHT = 0.35
+
+
+def question_terms(question: str) -> list:
+    """Routing terms of a question, with multi-word entities kept as one term."""
+    text = question.lower()
+    for phrase, token in PHRASES.items():
+        text = re.sub(rf"\b{re.escape(phrase)}s?\b", token, text)
+    # tokenize() splits on underscores; keep the joined phrase tokens whole
+    terms = []
+    for word in re.findall(r"[a-z0-9_&]+", text):
+        terms.extend([word] if word in PHRASES.values() else tokenize(word))
+    return terms
+
+
+def _sigmoid(x):
+    return 1 / (1 + math.exp(-max(-30.0, min(30.0, x))))
+
+
+class _NaiveBayes:
+    """One-vs-rest multinomial naive Bayes per route over question terms."""
+
+    def __init__(self):
+        self.examples = 0
+        self.docs = {r: [0, 0] for r in ROUTES}            # route -> [positive, negative] docs
+        self.terms = {r: [Counter(), Counter()] for r in ROUTES}
+        self.vocab = set()
+
+    def add(self, terms, routes):
+        self.examples += 1
+        unique = set(terms)
+        self.vocab |= unique
+        for r in ROUTES:
+            side = 0 if r in routes else 1
+            self.docs[r][side] += 1
+            self.terms[r][side].update(unique)
+
+    def probability(self, route, terms):
+        (pos_docs, neg_docs), (pos, neg) = self.docs[route], self.terms[route]
+        v = len(self.vocab) + 1
+        pos_total, neg_total = sum(pos.values()) + v, sum(neg.values()) + v
+        log_odds = math.log((pos_docs + 1) / (neg_docs + 1))
+        for t in set(terms):
+            log_odds += math.log((pos[t] + 1) / pos_total) - math.log((neg[t] + 1) / neg_total)
+        return _sigmoid(log_odds)
+
+
+class FastRouter:
+    """Keyword + naive Bayes route classifier with per-route confidences."""
+
+    def __init__(self, training_path=ROUTER_TRAINING_PATH, kb_=kb):
+        self.training_path = training_path
+        self.kb = kb_
+        self._weights = None
+        self._kb_version = None
+        self._model = None
+        self._lock = threading.Lock()
+
+    def _term_weights(self):
+        """Seed terms plus column/description terms that belong to a single route's tables."""
+        version = self.kb.version
+        if self._weights is not None and version == self._kb_version:
+            return self._weights
+        route_terms = {}
+        for route, tables in ROUTE_TABLES.items():
+            terms = set()
+            for table in tables:
+                try:
+                    entry = self.kb.entry(table)
+                except (KeyError, FileNotFoundError):
+                    continue
+                for name in entry.get("columns", {}):
+                    terms.update(tokenize(name))
+                terms.update(tokenize(entry.get("table_description", "")))
+            route_terms[route] = terms
+        weights = {}
+        for route in ROUTES:
+            others = set().union(*(route_terms[r] for r in ROUTES if r != route))
+            for term in route_terms[route] - others:
+                weights.setdefault(term, {})[route] = KB_WEIGHT
+            for term in SEED_TERMS[route]:
+                weights.setdefault(term, {})[route] = SEED_WEIGHT
+        self._weights, self._kb_version = weights, version
+        return weights
+
+    def _trained(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    model = _NaiveBayes()
+                    if self.training_path and os.path.exists(self.training_path):
+                        with open(self.training_path, encoding="utf-8") as f:
+                            for line in f:
+                                try:
+                                    item = json.loads(line)
+                                except ValueError:
+                                    continue
+                                routes = item.get("routes") or item.get("router_out")
+                                if item.get("question") and routes:
+                                    model.add(question_terms(item["question"]), routes)
+                    self._model = model
+        return self._model
+
+    def scores(self, question: str) -> dict:
+        """Probability that each route is needed."""
+        terms = question_terms(question)
+        weights = self._term_weights()
+        totals = dict.fromkeys(ROUTES, 0.0)
+        for term in set(terms):
+            for route, w in weights.get(term, {}).items():
+                totals[route] += w
+        probs = {r: 1 - math.exp(-2 * totals[r]) for r in ROUTES}
+        model = self._trained()
+        if model.examples >= ROUTER_MIN_TRAINING:
+            probs = {r: (probs[r] + model.probability(r, terms)) / 2 for r in ROUTES}
+        return probs
+
+    def route(self, question: str):
+        """
+        Returns (routes, confidence). routes is never empty: with no positive
+        route, the most likely data route is paired with dim and confidence is 0.
+        """
+        probs = self.scores(question)
+        routes = [r for r in ROUTES if probs[r] >= 0.5]
+        if not routes:
+            best = max(("sales", "expense"), key=lambda r: probs[r])
+            return ["dim", best], 0.0
+        confidence = min(max(p, 1 - p) for p in probs.values())
+        return routes, confidence
+
+    def record(self, question: str, routes: list):
+        """Append an LLM-routed example to the training log and the in-memory model."""
+        if not routes:
+            return
+        with self._lock:
+            if self._model is not None:
+                self._model.add(question_terms(question), routes)
+            if self.training_path:
+                with open(self.training_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps({"question": question, "routes": routes}) + "\n")
+
+
+fast_router = FastRouter()
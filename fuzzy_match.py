@@ -0,0 +1,218 @@
+import pandas as pd
+from sqlalchemy.exc import SQLAlchemyError
+from rapidfuzz import process, fuzz
+import os
+import asyncio
+import threading
+import time
+import numpy as np
+import db
+
+# Distinct-value lookups go to the read replica when one is configured
+engine = db.replica_engine
+
+
+def get_async_engine():
+    """Async (asyncpg) engine for value lookups, created on first use."""
+    return db.get_async_engine(replica=True)
+
+
+# Seconds a cached distinct-value list stays fresh before it is re-read from the DB
+VALUE_INDEX_TTL = float(os.getenv("VALUE_INDEX_TTL", "3600"))
+# Optional directory where the value index is persisted between restarts
+VALUE_INDEX_DIR = os.getenv("VALUE_INDEX_DIR")
+
+
+def get_values(table_name: str, column_name: str, engine) -> list:
+    """
+    Fetch distinct non-null values from a given table column.
+    Handles errors gracefully and rolls back any failed transactions.
+    """
+    # SQL query to get distinct values
+    query = f"SELECT DISTINCT {column_name} FROM {table_name}"
+
+    try:
+        # Read-only transaction on a pooled connection; rolled back on errors
+        with db.read_only(engine, op="get_values") as conn:
+            df = pd.read_sql(query, con=conn)
+
+        # Convert to list if you want raw values
+        unique_values = df[column_name].dropna().tolist()
+        return unique_values
+
+    except SQLAlchemyError as e:
+        print(f"Error fetching values from {table_name}.{column_name}: {e}")
+        return []
+
+
+async def aget_values(table_name: str, column_name: str, async_engine) -> list:
+    """Async variant of get_values using an AsyncEngine."""
+    query = f"SELECT DISTINCT {column_name} FROM {table_name}"
+
+    try:
+        async with db.aread_only(async_engine, op="get_values") as conn:
+            df = await conn.run_sync(lambda sync_conn: pd.read_sql(query, con=sync_conn))
+        return df[column_name].dropna().tolist()
+
+    except SQLAlchemyError as e:
+        print(f"Error fetching values from {table_name}.{column_name}: {e}")
+        return []
+
+class ValueIndex:
+    """
+    Per-(table, column) cache of distinct column values used for fuzzy filter matching.
+    Values are stored as a deduplicated numpy string array, refreshed after `ttl`
+    seconds or on explicit invalidation, and optionally persisted to `persist_dir`.
+    """
+
+    def __init__(self, engine, ttl=VALUE_INDEX_TTL, persist_dir=VALUE_INDEX_DIR, async_engine=None):
+        self.engine = engine
+        self.async_engine = async_engine
+        self.ttl = ttl
+        self.persist_dir = persist_dir
+        self._entries = {}  # (table, column) -> (loaded_at, values)
+        self._lock = threading.Lock()
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+
+    def _path(self, table, column):
+        return os.path.join(self.persist_dir, f"{table}.{column}.npz")
+
+    def _fresh(self, loaded_at):
+        return time.time() - loaded_at < self.ttl
+
+    def _load_from_disk(self, table, column):
+        path = self._path(table, column)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                return float(data["loaded_at"]), data["values"]
+        except Exception as e:
+            print(f"Error reading value index {path}: {e}")
+            return None
+
+    def _save_to_disk(self, table, column, loaded_at, values):
+        path = self._path(table, column)
+        tmp = path + ".tmp.npz"
+        try:
+            np.savez(tmp, values=values, loaded_at=np.array(loaded_at))
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"Error writing value index {path}: {e}")
+
+    def _cached(self, key):
+        entry = self._entries.get(key)
+        if entry and self._fresh(entry[0]):
+            return entry[1]
+        if self.persist_dir:
+            entry = self._load_from_disk(*key)
+            if entry and self._fresh(entry[0]):
+                self._entries[key] = entry
+                return entry[1]
+        return None
+
+    def _store(self, key, raw):
+        values = np.unique(np.asarray([str(i) for i in raw], dtype=str))
+        loaded_at = time.time()
+        self._entries[key] = (loaded_at, values)
+        if self.persist_dir and len(values):
+            self._save_to_disk(key[0], key[1], loaded_at, values)
+        return values
+
+    def get(self, table, column):
+        """Return the distinct values of table.column as a numpy string array."""
+        key = (table, column)
+        entry = self._entries.get(key)
+        if entry and self._fresh(entry[0]):
+            return entry[1]
+
+        with self._lock:
+            values = self._cached(key)
+            if values is None:
+                values = self._store(key, get_values(table, column, self.engine))
+            return values
+
+    async def aget(self, table, column):
+        """Async variant of get; loads through `async_engine` (asyncpg by default)."""
+        key = (table, column)
+        values = self._cached(key)
+        if values is None:
+            raw = await aget_values(table, column, self.async_engine or get_async_engine())
+            with self._lock:
+                values = self._store(key, raw)
+        return values
+
+    def invalidate(self, table=None, column=None):
+        """Drop cached values for one column, one table, or (no arguments) everything."""
+        with self._lock:
+            for key in list(self._entries):
+                if (table is None or key[0] == table) and (column is None or key[1] == column):
+                    del self._entries[key]
+            if self.persist_dir:
+                for name in os.listdir(self.persist_dir):
+                    if not name.endswith(".npz"):
+                        continue
+                    t, c = name[:-len(".npz")].split(".", 1)
+                    if (table is None or t == table) and (column is None or c == column):
+                        os.remove(os.path.join(self.persist_dir, name))
+
+
+value_index = ValueIndex(engine)
+
+
+def match_batch(values, choices):
+    """
+    Match every input value against `choices` in one rapidfuzz cdist call.
+    Returns a list of (best_match, score) in input order.
+    """
+    if len(choices) == 0:
+        return [(None, 0)] * len(values)
+    scores = process.cdist(values, choices, scorer=fuzz.token_set_ratio, workers=-1)
+    best = scores.argmax(axis=1)
+    return [(str(choices[j]), float(scores[i, j])) for i, j in enumerate(best)]
+
+
+def _requested_values(val):
+    """Group the filter extractor output as {(table, column): [values]}."""
+    requested = {}
+    for lst in val[1:]:
+        table = lst[0]
+        column = lst[1]
+        str_lst = [i.strip() for i in lst[2].split(',')]
+        requested.setdefault((table, column), []).extend(str_lst)
+    return requested
+
+
+def _matched_filters(table, column, str_lst, unq_col_val):
+    final = []
+    for subval, (best_match, score) in zip(str_lst, match_batch(str_lst, unq_col_val)):
+        if best_match is None:
+            print(f"No values available to match {subval!r} in {table}.{column}")
+            continue
+        final.append(["table name:"+table, "column_name:"+column, "filter_value:"+best_match])
+    return final
+
+
+def call_match(val):
+    """
+    Resolve the filter values from the filter extractor against actual column values.
+    All values requested for the same table.column are matched in a single batch.
+    """
+    final = []
+    for (table, column), str_lst in _requested_values(val).items():
+        unq_col_val = value_index.get(table, column)
+        final.extend(_matched_filters(table, column, str_lst, unq_col_val))
+
+    return final
+
+
+async def acall_match(val):
+    """Async variant of call_match; value lookups for different columns run concurrently."""
+    requested = _requested_values(val)
+    indexes = await asyncio.gather(*[value_index.aget(table, column) for table, column in requested])
+
+    final = []
+    for ((table, column), str_lst), unq_col_val in zip(requested.items(), indexes):
+        final.extend(_matched_filters(table, column, str_lst, unq_col_val))
+    return final
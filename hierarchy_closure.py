@@ -0,0 +1,229 @@
+"""
+Build or refresh closure tables for the parent/child hierarchies.
+
+    python hierarchy_closure.py                                  # refresh every hierarchy that changed
+    python hierarchy_closure.py --tables cost_center_hierarchy   # limit the run
+    python hierarchy_closure.py --force                          # rebuild even if unchanged
+
+For each hierarchy table (e.g. profit_center_hierarchy with profit_center_code
+and parent_profit_center_code) a <table>_closure table holds one row per
+(ancestor, descendant) pair at any depth, including every node with itself at
+depth 0:
+
+    ancestor_profit_center_code | profit_center_code | depth
+
+so "total for parent X" is a plain indexed join on profit_center_code filtered
+on ancestor_profit_center_code, instead of a recursive CTE. The edge list is
+fingerprinted; an unchanged hierarchy is skipped and a changed one only has
+its added/removed closure rows written. The closure tables are registered in
+the KB as derived "dim" tables so the agents are offered them.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+
+from sqlalchemy import (Column, Float, Index, Integer, MetaData, PrimaryKeyConstraint, String, Table,
+                        and_, bindparam, inspect, select)
+
+import db
+from column_index import untrimmed_tables
+from kb_store import KB_PATH, KnowledgeBase, write_kb
+
+
+HIERARCHY_TABLES = [
+    "profit_center_hierarchy",
+    "cost_center_hierarchy",
+    "cost_element_hierarchy",
+    "functional_area_hierarchy",
+]
+CLOSURE_SUFFIX = "_closure"
+META_TABLE = "hierarchy_closure_meta"
+# Deeper chains are treated as a cycle in the source data
+HIERARCHY_MAX_DEPTH = int(os.getenv("HIERARCHY_MAX_DEPTH", "50"))
+# Rows per INSERT/DELETE batch when applying closure changes
+HIERARCHY_WRITE_BATCH = int(os.getenv("HIERARCHY_WRITE_BATCH", "5000"))
+
+
+def detect_columns(columns):
+    """(key, parent) column names: parent_<key> / <key>_parent next to <key>."""
+    names = {c.lower(): c for c in columns}
+    for lower, name in names.items():
+        m = re.fullmatch(r"parent_(.+)", lower) or re.fullmatch(r"(.+)_parent", lower)
+        if m and m.group(1) in names:
+            return names[m.group(1)], name
+        # parent_profit_center_id next to profit_center_code
+        if m:
+            stem = re.sub(r"_(id|code)$", "", m.group(1))
+            for suffix in ("_code", "_id"):
+                if stem + suffix in names:
+                    return names[stem + suffix], name
+    raise ValueError(f"no <key>/parent_<key> column pair among {sorted(columns)}")
+
+
+def closure_rows(edges):
+    """
+    {(ancestor, descendant): depth} for a {child: parent} mapping. Nodes that only
+    appear as parents are included. Raises ValueError on a cycle.
+    """
+    rows = {}
+    for node in set(edges) | {p for p in edges.values() if p is not None}:
+        rows[(node, node)] = 0
+        depth, current = 0, node
+        while edges.get(current) is not None:
+            current = edges[current]
+            depth += 1
+            if current == node or depth > HIERARCHY_MAX_DEPTH:
+                raise ValueError(f"cycle or depth > {HIERARCHY_MAX_DEPTH} above {node!r}")
+            rows[(current, node)] = depth
+    return rows
+
+
+def fingerprint(edges):
+    text = "\n".join(f"{c}\t{p}" for c, p in sorted(edges.items(), key=lambda e: str(e[0])))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+def _meta_table(metadata):
+    return Table(
+        META_TABLE, metadata,
+        Column("source", String(128), primary_key=True),
+        Column("fingerprint", String(32)),
+        Column("rows", Integer),
+        Column("refreshed_at", Float),
+    )
+
+
+def _closure_table(metadata, source, key, key_type):
+    name = source + CLOSURE_SUFFIX
+    ancestor = f"ancestor_{key}"
+    return Table(
+        name, metadata,
+        Column(ancestor, key_type, nullable=False),
+        Column(key, key_type, nullable=False),
+        Column("depth", Integer, nullable=False),
+        PrimaryKeyConstraint(ancestor, key, name=f"pk_{name}"),
+        # Fact rows join on the descendant; the primary key serves "everything under X"
+        Index(f"ix_{name}_{key}", key, ancestor),
+    )
+
+
+def _read_edges(conn, table, key, parent):
+    source = Table(table, MetaData(), autoload_with=conn)
+    edges = {}
+    for child, par in conn.execute(select(source.c[key], source.c[parent]).where(source.c[key].is_not(None))):
+        edges[child] = par if par != child else None
+    return edges
+
+
+def refresh(source, engine=None, force=False):
+    """
+    Bring `source`'s closure table up to date. Returns a summary dict with the
+    status ("unchanged", "built" or "updated") and the rows inserted / deleted.
+    """
+    engine = engine if engine is not None else db.engine
+    columns = inspect(engine).get_columns(source)
+    key, parent = detect_columns([c["name"] for c in columns])
+    key_type = next(c["type"] for c in columns if c["name"] == key)
+    metadata = MetaData()
+    meta = _meta_table(metadata)
+    closure = _closure_table(metadata, source, key, key_type)
+    summary = {"table": closure.name, "source": source, "key": key, "parent": parent}
+
+    with engine.begin() as conn:
+        metadata.create_all(conn)
+        edges = _read_edges(conn, source, key, parent)
+        digest = fingerprint(edges)
+        previous = conn.execute(select(meta.c.fingerprint).where(meta.c.source == source)).scalar()
+        if previous == digest and not force:
+            summary.update(status="unchanged", inserted=0, deleted=0)
+            return summary
+
+        wanted = closure_rows(edges)
+        ancestor = closure.c[f"ancestor_{key}"]
+        current = {(a, d): depth for a, d, depth in conn.execute(select(ancestor, closure.c[key], closure.c.depth))}
+        stale = [pair for pair, depth in current.items() if wanted.get(pair) != depth]
+        added = [pair for pair, depth in wanted.items() if current.get(pair) != depth]
+
+        delete = closure.delete().where(and_(ancestor == bindparam("old_ancestor"),
+                                             closure.c[key] == bindparam("old_descendant")))
+        for i in range(0, len(stale), HIERARCHY_WRITE_BATCH):
+            conn.execute(delete, [{"old_ancestor": a, "old_descendant": d} for a, d in stale[i:i + HIERARCHY_WRITE_BATCH]])
+        for i in range(0, len(added), HIERARCHY_WRITE_BATCH):
+            conn.execute(closure.insert(), [
+                {ancestor.name: a, key: d, "depth": wanted[(a, d)]} for a, d in added[i:i + HIERARCHY_WRITE_BATCH]
+            ])
+
+        conn.execute(meta.delete().where(meta.c.source == source))
+        conn.execute(meta.insert(), [{"source": source, "fingerprint": digest, "rows": len(wanted),
+                                      "refreshed_at": time.time()}])
+    summary.update(status="updated" if current else "built", inserted=len(added), deleted=len(stale),
+                   rows=len(wanted))
+    return summary
+
+
+def kb_entry(summary):
+    """KB entry for a closure table built by refresh()."""
+    key, source = summary["key"], summary["source"]
+    label = re.sub(r"_(code|id)$", "", key).replace("_", " ")
+    return {
+        "table_description": (
+            f"Precomputed closure of {source}: one row for every {label} and each {label} below it at any "
+            f"depth (a {label} is also paired with itself at depth 0). Use it for rollups such as the total "
+            f"for a parent {label}: join the fact table on {key} and filter ancestor_{key}, instead of "
+            f"walking {source} with a recursive CTE."
+        ),
+        "columns": {
+            f"ancestor_{key}": f"{label} at or above {key} in the hierarchy; filter on this for 'under / rolls up to'",
+            key: f"descendant {label}; joins to {key} in {source} and in the fact tables",
+            "depth": "levels from ancestor to descendant (0 = same node, 1 = direct child)",
+        },
+        "derived": {"kind": "closure", "source": source, "route": "dim"},
+    }
+
+
+def register(summaries, kb_path=KB_PATH):
+    """Add or update the closure table entries in the KB; returns the new KB version."""
+    kb = KnowledgeBase(kb_path).as_dict() if os.path.exists(kb_path) else {}
+    for summary in summaries:
+        kb[summary["table"]] = kb_entry(summary)
+    version = write_kb(kb, kb_path)
+    wide = untrimmed_tables(KnowledgeBase(kb_path))
+    if wide:
+        print(f"⚠️ Column ranking no longer trims {wide}: the join keys cover every column")
+    return version
+
+
+def refresh_all(tables=None, force=False, kb_path=KB_PATH, engine=None):
+    """Refresh every hierarchy in `tables` (default HIERARCHY_TABLES) and register the results."""
+    results = {"tables": [], "failed": {}}
+    for source in tables or HIERARCHY_TABLES:
+        try:
+            summary = refresh(source, engine, force)
+        except Exception as e:
+            print(f"❌ {source}: {type(e).__name__}: {e}")
+            results["failed"][source] = f"{type(e).__name__}: {e}"
+            continue
+        print(f"🌳 {summary['table']}: {summary['status']} (+{summary['inserted']} / -{summary['deleted']} rows)")
+        results["tables"].append(summary)
+    if results["tables"] and kb_path:
+        results["kb_version"] = register(results["tables"], kb_path)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or refresh hierarchy closure tables")
+    parser.add_argument("--tables", nargs="*", default=None, help="hierarchy tables to refresh")
+    parser.add_argument("--force", action="store_true", help="recompute even if the hierarchy is unchanged")
+    parser.add_argument("--kb-path", default=KB_PATH, help="KB file to register the closure tables in")
+    args = parser.parse_args(argv)
+
+    results = refresh_all(args.tables, args.force, args.kb_path)
+    print(json.dumps(results, indent=2, default=str))
+    return results
+
+
+if __name__ == "__main__":
+    main()
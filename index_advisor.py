@@ -0,0 +1,294 @@
+"""
+Index advisor over the captured SQL workload (workload.py).
+
+    python index_advisor.py                          # ranked CREATE INDEX advice from sql_workload.jsonl
+    python index_advisor.py --top 5 --json advice.json
+    python index_advisor.py --apply-url postgresql://user:pw@staging/db   # try them on staging
+
+Every distinct query (by normalized SQL) is parsed with sqlglot and its WHERE
+equality / IN / range predicates, join keys and GROUP BY columns are resolved
+to their tables. The most expensive queries are EXPLAINed on the database to
+see which tables they currently read with sequential scans. Candidate indexes
+(equality columns first, then one range column) that no existing index already
+leads with are ranked by estimated benefit: the workload seconds of the queries
+that could use them, weighted by predicate type and by whether the plan
+seq-scans the table today. Small tables are skipped.
+
+With --apply-url the recommendations are created on a staging database and the
+planner cost of the affected queries is compared before and after.
+"""
+import argparse
+import hashlib
+import json
+import os
+from collections import defaultdict
+
+import sqlglot
+from sqlalchemy import create_engine, inspect, text
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+from sqlglot.optimizer.scope import traverse_scope
+
+import db
+from build_kb import estimate_rows
+from kb_store import kb
+from result_cache import normalize_sql
+from sql_validator import build_catalog
+from workload import WORKLOAD_LOG_PATH, load_workload
+
+
+# Tables with fewer rows than this are not worth indexing
+ADVISOR_MIN_TABLE_ROWS = int(os.getenv("ADVISOR_MIN_TABLE_ROWS", "10000"))
+# Distinct queries (most expensive first) that are EXPLAINed
+ADVISOR_EXPLAIN_TOP = int(os.getenv("ADVISOR_EXPLAIN_TOP", "20"))
+# Most columns in a recommended composite index
+ADVISOR_MAX_COLUMNS = 3
+
+ROLE_WEIGHTS = {"eq": 1.0, "in": 0.9, "join": 0.6, "range": 0.6, "group": 0.2}
+# Benefit multiplier by how the plan reads the table today
+PLAN_FACTORS = {"seq_scan": 1.0, "unknown": 0.6, "index_scan": 0.25}
+
+
+def column_usage(sql, catalog):
+    """[(table, column, role)] for the predicates, join keys and GROUP BY columns of a query."""
+    usage = []
+    for scope in traverse_scope(sqlglot.parse_one(sql, read="postgres")):
+        select = scope.expression
+        if not isinstance(select, exp.Select):
+            continue
+        tables = {alias: src.name.lower() for alias, src in scope.sources.items() if isinstance(src, exp.Table)}
+
+        def resolve(col):
+            if col.table:
+                return tables.get(col.table)
+            owners = {t for t in tables.values() if col.name.lower() in catalog.get(t, ())}
+            if len(owners) == 1:
+                return owners.pop()
+            return next(iter(tables.values())) if len(set(tables.values())) == 1 else None
+
+        def add(col, role):
+            if isinstance(col, exp.Column):
+                table = resolve(col)
+                if table:
+                    usage.append((table, col.name.lower(), role))
+
+        def own(node):
+            return node.find_ancestor(exp.Select) is select
+
+        where = select.args.get("where")
+        if where is not None:
+            for pred in where.find_all(exp.EQ, exp.In, exp.GT, exp.GTE, exp.LT, exp.LTE, exp.Between):
+                if not own(pred):
+                    continue
+                if isinstance(pred, exp.EQ):
+                    both = isinstance(pred.left, exp.Column) and isinstance(pred.right, exp.Column)
+                    add(pred.left, "join" if both else "eq")
+                    add(pred.right, "join" if both else "eq")
+                elif isinstance(pred, exp.In):
+                    add(pred.this, "in")
+                elif isinstance(pred, exp.Between):
+                    add(pred.this, "range")
+                else:
+                    add(pred.left, "range")
+                    add(pred.right, "range")
+        for join in select.args.get("joins") or []:
+            on = join.args.get("on")
+            for eq in (on.find_all(exp.EQ) if on is not None else []):
+                if own(eq) and isinstance(eq.left, exp.Column) and isinstance(eq.right, exp.Column):
+                    add(eq.left, "join")
+                    add(eq.right, "join")
+        group = select.args.get("group")
+        for col in (group.expressions if group is not None else []):
+            add(col, "group")
+    return usage
+
+
+def summarize_workload(records):
+    """Group captured executions by normalized SQL: {key: {"sql", "count", "total_s", "max_s"}}."""
+    queries = {}
+    for r in records:
+        key = normalize_sql(r["sql"])
+        q = queries.setdefault(key, {"sql": r["sql"], "count": 0, "total_s": 0.0, "max_s": 0.0})
+        q["count"] += 1
+        q["total_s"] += r.get("seconds") or 0.0
+        q["max_s"] = max(q["max_s"], r.get("seconds") or 0.0)
+    return queries
+
+
+def _plan_access(plan, found=None):
+    """{table: "seq_scan" | "index_scan"} from an EXPLAIN (FORMAT JSON) plan tree."""
+    found = {} if found is None else found
+    relation = plan.get("Relation Name")
+    if relation:
+        kind = "seq_scan" if plan.get("Node Type") == "Seq Scan" else "index_scan"
+        # A seq scan anywhere wins: it is what an index would remove
+        if found.get(relation.lower()) != "seq_scan":
+            found[relation.lower()] = kind
+    for child in plan.get("Plans", []):
+        _plan_access(child, found)
+    return found
+
+
+def explain_plan(sql, engine=None):
+    """Top-level plan dict from EXPLAIN (FORMAT JSON), or None when the database is not Postgres."""
+    engine = engine if engine is not None else db.engine
+    if engine.dialect.name != "postgresql":
+        return None
+    with engine.connect() as conn:
+        raw = conn.execute(text("EXPLAIN (FORMAT JSON) " + sql)).scalar()
+    return (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+
+
+def existing_indexes(engine, table):
+    """Column lists of the table's indexes and primary key (lower-cased)."""
+    insp = inspect(engine)
+    indexes = [[c.lower() for c in ix["column_names"] if c] for ix in insp.get_indexes(table)]
+    pk = insp.get_pk_constraint(table).get("constrained_columns") or []
+    if pk:
+        indexes.append([c.lower() for c in pk])
+    return indexes
+
+
+def index_name(table, columns):
+    name = f"ix_{table}_{'_'.join(columns)}"
+    if len(name) > 63:
+        name = name[:54] + "_" + hashlib.sha1(name.encode("utf-8")).hexdigest()[:8]
+    return name
+
+
+def create_index_sql(table, columns, concurrently=True):
+    mode = "CONCURRENTLY " if concurrently else ""
+    return f"CREATE INDEX {mode}IF NOT EXISTS {index_name(table, columns)} ON {table} ({', '.join(columns)})"
+
+
+def _candidates(usage):
+    """Candidate column tuples per table for one query: equality columns first, then a range column."""
+    by_table = defaultdict(lambda: defaultdict(set))
+    for table, column, role in usage:
+        by_table[table][column].add(role)
+    for table, cols in by_table.items():
+        eq = sorted(c for c, roles in cols.items() if roles & {"eq", "in"})
+        rng = sorted(c for c, roles in cols.items() if "range" in roles and c not in eq)
+        if eq or rng:
+            columns = tuple((eq + rng[:1])[:ADVISOR_MAX_COLUMNS])
+            roles = set().union(*(cols[c] for c in columns))
+            yield table, columns, max(ROLE_WEIGHTS[r] for r in roles if r != "group")
+        for c, roles in cols.items():
+            if "join" in roles and c not in eq:
+                yield table, (c,), ROLE_WEIGHTS["join"]
+
+
+def advise(records=None, engine=None, explain=True, top=None, min_rows=ADVISOR_MIN_TABLE_ROWS):
+    """Ranked index recommendations (dicts) for the captured workload."""
+    engine = engine if engine is not None else db.engine
+    records = load_workload() if records is None else records
+    queries = summarize_workload(records)
+    catalog = build_catalog(kb.as_dict())
+    insp = inspect(engine)
+    insp_tables = {t.lower(): t for t in insp.get_table_names()}
+    if engine.dialect.name == "postgresql":
+        insp_tables.update({t.lower(): t for t in insp.get_materialized_view_names()})
+
+    ranked = sorted(queries.values(), key=lambda q: -q["total_s"])
+    access = {}
+    for i, q in enumerate(ranked):
+        if explain and i < ADVISOR_EXPLAIN_TOP:
+            try:
+                plan = explain_plan(q["sql"], engine)
+                access[q["sql"]] = _plan_access(plan) if plan else {}
+            except Exception as e:
+                print(f"⚠️ EXPLAIN failed, plan unknown: {type(e).__name__}: {str(e).splitlines()[0]}")
+
+    candidates = {}
+    for q in ranked:
+        try:
+            usage = column_usage(q["sql"], catalog)
+        except SqlglotError:
+            continue
+        plan = access.get(q["sql"], {})
+        for table, columns, weight in _candidates(usage):
+            if table not in insp_tables:
+                continue
+            state = plan.get(table, "unknown")
+            c = candidates.setdefault((table, columns), {
+                "table": table, "columns": list(columns), "estimated_benefit_s": 0.0, "queries": 0,
+                "executions": 0, "seq_scans": 0, "examples": [],
+            })
+            c["estimated_benefit_s"] += q["total_s"] * weight * PLAN_FACTORS[state]
+            c["queries"] += 1
+            c["executions"] += q["count"]
+            c["seq_scans"] += state == "seq_scan"
+            if len(c["examples"]) < 3:
+                c["examples"].append(q["sql"])
+
+    rows, covered, recommendations = {}, {}, []
+    for c in sorted(candidates.values(), key=lambda c: -c["estimated_benefit_s"]):
+        table = c["table"]
+        if table not in rows:
+            with db.read_only(engine, op="advisor") as conn:
+                rows[table] = estimate_rows(conn, insp_tables[table])
+            covered[table] = existing_indexes(engine, insp_tables[table])
+        if rows[table] < min_rows:
+            continue
+        # Already served by an index (existing or recommended above) that starts with these columns
+        if any(ix[:len(c["columns"])] == c["columns"] for ix in covered[table]):
+            continue
+        covered[table].append(c["columns"])
+        c["table_rows"] = rows[table]
+        c["estimated_benefit_s"] = round(c["estimated_benefit_s"], 3)
+        c["create_sql"] = create_index_sql(insp_tables[table], c["columns"], engine.dialect.name == "postgresql")
+        recommendations.append(c)
+    return recommendations[:top] if top else recommendations
+
+
+def apply_to_staging(recommendations, staging_url):
+    """
+    Create the recommended indexes on a staging database and record the planner
+    cost of each recommendation's example queries before and after.
+    """
+    staging = create_engine(staging_url, isolation_level="AUTOCOMMIT")
+    postgres = staging.dialect.name == "postgresql"
+    for rec in recommendations:
+        before = [_cost(staging, sql) for sql in rec["examples"]] if postgres else []
+        with staging.connect() as conn:
+            conn.execute(text(create_index_sql(rec["table"], rec["columns"], postgres)))
+            if postgres:
+                conn.execute(text(f"ANALYZE {rec['table']}"))
+        after = [_cost(staging, sql) for sql in rec["examples"]] if postgres else []
+        rec["staging"] = {"applied": True, "cost_before": before, "cost_after": after}
+        print(f"🧪 {index_name(rec['table'], rec['columns'])}: planner cost {before} -> {after}")
+    return recommendations
+
+
+def _cost(engine, sql):
+    try:
+        return float(explain_plan(sql, engine)["Total Cost"])
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recommend indexes from the captured SQL workload")
+    parser.add_argument("--workload", default=WORKLOAD_LOG_PATH, help="workload JSON-lines file")
+    parser.add_argument("--top", type=int, default=10, help="number of recommendations")
+    parser.add_argument("--no-explain", action="store_true", help="do not EXPLAIN the captured queries")
+    parser.add_argument("--min-rows", type=int, default=ADVISOR_MIN_TABLE_ROWS, help="skip smaller tables")
+    parser.add_argument("--apply-url", default=None, help="SQLAlchemy URL of a staging database to apply them to")
+    parser.add_argument("--json", dest="json_path", default=None, help="write the recommendations to this file")
+    args = parser.parse_args(argv)
+
+    recommendations = advise(load_workload(args.workload), explain=not args.no_explain, top=args.top,
+                             min_rows=args.min_rows)
+    if args.apply_url:
+        apply_to_staging(recommendations, args.apply_url)
+    for i, rec in enumerate(recommendations, 1):
+        print(f"{i:2d}. {rec['create_sql']};  -- ~{rec['estimated_benefit_s']}s over {rec['executions']} "
+              f"executions, {rec['seq_scans']} seq-scan plans, {rec['table_rows']:,} rows")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(recommendations, f, indent=2)
+    return recommendations
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+# JSON-lines file receiving one record per run ("" disables it)
+METRICS_LOG_PATH = os.getenv("METRICS_LOG_PATH", "pipeline_metrics.jsonl")
+# Optional file rewritten with the Prometheus text export after every run
+METRICS_PROM_PATH = os.getenv("METRICS_PROM_PATH", "")
+
+_current_run = contextvars.ContextVar("current_run", default=None)
+_write_lock = threading.Lock()
+
+
+class RunMetrics:
+    """
+    Metrics collected for one question: node wall times, LLM calls and tokens
+    per chain, DB time per operation, and the outcome of the run.
+    """
+
+    def __init__(self, question):
+        self.run_id = str(uuid.uuid4())
+        self.question = question
+        self.started_at = time.time()
+        self.outcome = "ok"
+        self.nodes = {}
+        self.llm = {}
+        self.db = {}
+        self.models = {}
+        self._lock = threading.Lock()
+        self.callback = MetricsCallbackHandler(self)
+
+    def config(self):
+        """RunnableConfig that attaches LLM accounting to a graph invocation."""
+        return {"callbacks": [self.callback]}
+
+    def add_node(self, name, seconds):
+        with self._lock:
+            entry = self.nodes.setdefault(name, {"calls": 0, "seconds": 0.0})
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+
+    def add_llm(self, chain, seconds, prompt_tokens, completion_tokens):
+        with self._lock:
+            entry = self.llm.setdefault(
+                chain, {"calls": 0, "seconds": 0.0, "prompt_tokens": 0, "completion_tokens": 0}
+            )
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+            entry["prompt_tokens"] += prompt_tokens
+            entry["completion_tokens"] += completion_tokens
+
+    def note_model(self, chain, model):
+        with self._lock:
+            self.models[chain] = model
+
+    def add_db(self, op, seconds):
+        with self._lock:
+            entry = self.db.setdefault(op, {"calls": 0, "seconds": 0.0})
+            entry["calls"] += 1
+            entry["seconds"] += seconds
+
+    def to_dict(self):
+        return {
+            "run_id": self.run_id,
+            "question": self.question,
+            "started_at": self.started_at,
+            "total_seconds": round(time.time() - self.started_at, 4),
+            "outcome": self.outcome,
+            "nodes": self.nodes,
+            "llm_calls": sum(v["calls"] for v in self.llm.values()),
+            "llm": self.llm,
+            "models": self.models,
+            "db": self.db,
+        }
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    Counts chat model calls and tokens, attributed to the nearest named chain
+    (e.g. chain_subquestion) above each model call.
+    """
+
+    def __init__(self, run: RunMetrics):
+        self.run = run
+        self._parents = {}   # run_id -> (parent_run_id, name)
+        self._started = {}   # llm run_id -> (chain name, start time)
+        self._lock = threading.Lock()
+
+    def _chain_name(self, parent_run_id):
+        while parent_run_id is not None:
+            parent, name = self._parents.get(parent_run_id, (None, None))
+            if name and name.startswith("chain_"):
+                return name
+            parent_run_id = parent
+        return "unknown"
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        with self._lock:
+            self._parents[run_id] = (parent_run_id, kwargs.get("name"))
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        with self._lock:
+            chain = self._chain_name(parent_run_id)
+            self._started[run_id] = (chain, time.perf_counter())
+        params = kwargs.get("invocation_params") or {}
+        model = (kwargs.get("metadata") or {}).get("ls_model_name") or params.get("model") or params.get("model_name")
+        if model:
+            self.run.note_model(chain, model)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self.on_chat_model_start(serialized, [], run_id=run_id, parent_run_id=parent_run_id, **kwargs)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        with self._lock:
+            chain, start = self._started.pop(run_id, ("unknown", time.perf_counter()))
+        prompt_tokens, completion_tokens = _token_usage(response)
+        self.run.add_llm(chain, time.perf_counter() - start, prompt_tokens, completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        with self._lock:
+            chain, start = self._started.pop(run_id, ("unknown", time.perf_counter()))
+        self.run.add_llm(chain + ":error", time.perf_counter() - start, 0, 0)
+
+
+def _token_usage(response):
+    prompt_tokens = completion_tokens = 0
+    for gens in response.generations:
+        for gen in gens:
+            usage = getattr(getattr(gen, "message", None), "usage_metadata", None)
+            if usage:
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+    if not (prompt_tokens or completion_tokens):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+    return prompt_tokens, completion_tokens
+
+
+# ------------------ Aggregates (Prometheus export) ------------------
+_totals = {"runs": {}, "nodes": {}, "llm": {}, "db": {}}
+
+
+def _accumulate(record):
+    with _write_lock:
+        _totals["runs"][record["outcome"]] = _totals["runs"].get(record["outcome"], 0) + 1
+        for group in ("nodes", "llm", "db"):
+            for name, stats in record[group].items():
+                agg = _totals[group].setdefault(name, {})
+                for k, v in stats.items():
+                    agg[k] = agg.get(k, 0) + v
+
+
+def prometheus_text():
+    """Render metrics accumulated since process start in Prometheus text format."""
+    lines = [
+        "# TYPE text2sql_runs_total counter",
+        *[f'text2sql_runs_total{{outcome="{k}"}} {v}' for k, v in _totals["runs"].items()],
+        "# TYPE text2sql_node_seconds summary",
+    ]
+    for name, s in _totals["nodes"].items():
+        lines.append(f'text2sql_node_seconds_sum{{node="{name}"}} {s["seconds"]:.6f}')
+        lines.append(f'text2sql_node_seconds_count{{node="{name}"}} {s["calls"]}')
+    lines.append("# TYPE text2sql_llm_calls_total counter")
+    lines.extend(f'text2sql_llm_calls_total{{chain="{name}"}} {s["calls"]}' for name, s in _totals["llm"].items())
+    lines.append("# TYPE text2sql_llm_seconds_total counter")
+    lines.extend(f'text2sql_llm_seconds_total{{chain="{name}"}} {s["seconds"]:.6f}' for name, s in _totals["llm"].items())
+    lines.append("# TYPE text2sql_llm_tokens_total counter")
+    for name, s in _totals["llm"].items():
+        lines.append(f'text2sql_llm_tokens_total{{chain="{name}",type="prompt"}} {s["prompt_tokens"]}')
+        lines.append(f'text2sql_llm_tokens_total{{chain="{name}",type="completion"}} {s["completion_tokens"]}')
+    lines.append("# TYPE text2sql_db_seconds summary")
+    for name, s in _totals["db"].items():
+        lines.append(f'text2sql_db_seconds_sum{{op="{name}"}} {s["seconds"]:.6f}')
+        lines.append(f'text2sql_db_seconds_count{{op="{name}"}} {s["calls"]}')
+    return "\n".join(lines) + "\n"
+
+
+def emit(run: RunMetrics):
+    """Write the run as one JSON line and refresh the Prometheus export."""
+    record = run.to_dict()
+    _accumulate(record)
+    with _write_lock:
+        if METRICS_LOG_PATH:
+            with open(METRICS_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+    if METRICS_PROM_PATH:
+        tmp = METRICS_PROM_PATH + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(prometheus_text())
+        os.replace(tmp, METRICS_PROM_PATH)
+    return record
+
+
+# ------------------ Public helpers ------------------
+@contextmanager
+def metrics_run(question):
+    """
+    Collect metrics for everything executed inside the block and emit them on exit.
+    Pass `run.config()` to graph_main.invoke so LLM calls are counted.
+    """
+    run = RunMetrics(question)
+    token = _current_run.set(run)
+    try:
+        yield run
+    except BaseException as e:
+        run.outcome = f"error:{type(e).__name__}"
+        raise
+    finally:
+        _current_run.reset(token)
+        emit(run)
+
+
+def current_run():
+    return _current_run.get()
+
+
+def timed_node(name):
+    """Decorator recording the wall time of a graph node (sync or async) in the current run."""
+    def record(start):
+        run = _current_run.get()
+        if run is not None:
+            run.add_node(name, time.perf_counter() - start)
+
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    record(start)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(start)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def track_db(op):
+    """Record the time spent in a database operation in the current run."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        run = _current_run.get()
+        if run is not None:
+            run.add_db(op, time.perf_counter() - start)
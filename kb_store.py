@@ -0,0 +1,200 @@
+"""
+Knowledge base store shared by agent.py, pipeline.py and the caches.
+
+The KB ({table: {"table_description": ..., "columns": {...}}}) lives in a SQLite
+file with one row per table, holding the raw entry as JSON plus the prompt text
+rendered for it. Entries are read lazily on first use and kept in memory.
+
+Migrate an existing pickle once with:
+
+    python kb_store.py import kb.pkl
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+
+KB_PATH = os.getenv("KB_PATH", "kb.sqlite")
+# How often (seconds) the KB file is checked for replacement by build_kb / write_kb
+KB_RELOAD_CHECK_SECONDS = float(os.getenv("KB_RELOAD_CHECK_SECONDS", "2"))
+
+
+def render_columns(columns) -> str:
+    """Column list as passed to chain_column_extractor."""
+    return str(columns)
+
+
+def _entry_hash(entry) -> str:
+    return hashlib.sha256(json.dumps(entry, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def write_kb(kb: dict, path=KB_PATH):
+    """
+    Write a whole KB dict to `path`. The file is built next to the target and
+    swapped in with os.replace, so readers never see a half-written KB.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    hashes = {}
+    conn = sqlite3.connect(tmp)
+    try:
+        conn.execute("CREATE TABLE kb_meta (key TEXT PRIMARY KEY, value TEXT)")
+        conn.execute(
+            "CREATE TABLE kb_tables (name TEXT PRIMARY KEY, entry TEXT, description TEXT, "
+            "columns_prompt TEXT, fingerprint TEXT, updated_at REAL)"
+        )
+        now = time.time()
+        for table, entry in kb.items():
+            hashes[table] = _entry_hash(entry)
+            conn.execute(
+                "INSERT INTO kb_tables VALUES (?, ?, ?, ?, ?, ?)",
+                (table, json.dumps(entry, default=str), str(entry.get("table_description", "")),
+                 render_columns(entry.get("columns", {})), hashes[table], now),
+            )
+        version = hashlib.sha256(
+            "".join(f"{t}:{h}" for t, h in sorted(hashes.items())).encode("utf-8")
+        ).hexdigest()[:16]
+        conn.execute("INSERT INTO kb_meta VALUES ('version', ?)", (version,))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp, path)
+    return version
+
+
+class KnowledgeBase:
+    """
+    Read-only view over a KB file. Nothing is read until first use; each table
+    entry and its rendered prompt text are loaded once and cached. When the file
+    is replaced (a KB rebuild), the cache is dropped on the next access so
+    `version` and every lookup follow the new file.
+    """
+
+    def __init__(self, path=KB_PATH):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._names = None
+        self._version = None
+        self._rows = {}          # table -> (entry dict, description, columns prompt)
+        self._descriptions = {}  # tuple of tables -> rendered description mapping
+        self._signature = None   # (inode, mtime, size) of the file the cache was read from
+        self._checked_at = 0.0
+
+    def _check_replaced(self):
+        """Reload if the file was replaced since it was last read (checked every KB_RELOAD_CHECK_SECONDS)."""
+        now = time.monotonic()
+        if now - self._checked_at < KB_RELOAD_CHECK_SECONDS:
+            return
+        self._checked_at = now
+        try:
+            st = os.stat(self.path)
+            signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            signature = None
+        if self._signature is not None and signature != self._signature:
+            print(f"🔄 Knowledge base {self.path} changed, reloading")
+            self.reload()
+        self._signature = signature
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            if self._conn is None:
+                if not os.path.exists(self.path):
+                    raise FileNotFoundError(
+                        f"Knowledge base {self.path} not found; build it or run "
+                        f"`python kb_store.py import kb.pkl` to migrate a pickle"
+                    )
+                self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            return self._conn.execute(sql, params).fetchall()
+
+    @property
+    def version(self) -> str:
+        """Content hash of the KB; changes whenever any table entry changes."""
+        self._check_replaced()
+        if self._version is None:
+            if not os.path.exists(self.path):
+                return "missing"
+            self._version = self._query("SELECT value FROM kb_meta WHERE key = 'version'")[0][0]
+        return self._version
+
+    def tables(self) -> list:
+        self._check_replaced()
+        if self._names is None:
+            self._names = [r[0] for r in self._query("SELECT name FROM kb_tables ORDER BY name")]
+        return list(self._names)
+
+    def _row(self, table):
+        self._check_replaced()
+        row = self._rows.get(table)
+        if row is None:
+            found = self._query(
+                "SELECT entry, description, columns_prompt FROM kb_tables WHERE name = ?", (table,)
+            )
+            if not found:
+                raise KeyError(table)
+            entry, description, columns_prompt = found[0]
+            row = self._rows[table] = (json.loads(entry), description, columns_prompt)
+        return row
+
+    def entry(self, table) -> dict:
+        return self._row(table)[0]
+
+    def columns(self, table) -> dict:
+        return self._row(table)[0].get("columns", {})
+
+    def columns_prompt(self, table) -> str:
+        """Pre-rendered column list for chain_column_extractor."""
+        return self._row(table)[2]
+
+    def descriptions_prompt(self, tables) -> str:
+        """Rendered {table: description} mapping for chain_subquestion."""
+        key = tuple(tables)
+        text = self._descriptions.get(key)
+        if text is None:
+            text = self._descriptions[key] = str({tab: self._row(tab)[1] for tab in tables})
+        return text
+
+    def route_tables(self, route, base=()) -> list:
+        """
+        `base` plus the derived tables (closure tables, reporting views) registered
+        in the KB for `route`; preferred ones (reporting views) come first.
+        """
+        derived = {t: self.entry(t).get("derived") or {} for t in self.tables() if t not in base}
+        derived = {t: d for t, d in derived.items() if d.get("route") == route}
+        preferred = [t for t, d in derived.items() if d.get("preferred")]
+        return preferred + list(base) + [t for t in derived if t not in preferred]
+
+    def as_dict(self) -> dict:
+        return {table: self.entry(table) for table in self.tables()}
+
+    def reload(self):
+        """Drop everything cached so the next lookup reads the (replaced) file again."""
+        self._checked_at = time.monotonic()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+        self._names = self._version = None
+        self._rows = {}
+        self._descriptions = {}
+
+
+kb = KnowledgeBase()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "import":
+        sys.exit("usage: python kb_store.py import kb.pkl")
+    import pickle
+
+    # One-off migration from the legacy pickle; only run this on a file you produced yourself
+    with open(sys.argv[2], "rb") as f:
+        legacy = pickle.load(f)
+    version = write_kb(legacy)
+    print(f"✅ Wrote {len(legacy)} tables to {KB_PATH} (version {version})")
@@ -0,0 +1,309 @@
+import asyncio
+import copy
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from startup import lazy
+
+
+# "off", "memory" or "disk" (memory in front of a SQLite file)
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "disk")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite")
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "2000"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+
+
+class ChainMemo:
+    """
+    Content-addressed store of LLM replies keyed on sha256(model, temperature, rendered prompt).
+    Holds a size-bounded in-memory LRU and, in "disk" mode, a size-bounded SQLite file.
+    """
+
+    def __init__(self, mode=LLM_CACHE_MODE, path=LLM_CACHE_PATH,
+                 memory_entries=LLM_CACHE_MEMORY_ENTRIES, max_bytes=LLM_CACHE_MAX_BYTES):
+        self.mode = mode
+        self.path = path if mode == "disk" else None
+        self.memory_entries = memory_entries
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {}  # chain name -> {"hits": n, "misses": n}
+        self._inflight = {}  # key -> threading.Event for calls currently being made
+        self._ainflight = {}  # (event loop id, key) -> asyncio.Event for async calls being made
+        self._disk_bytes = self._disk_rows = 0  # running totals of the SQLite file
+        if self.path:
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS llm_cache ("
+                    "key TEXT PRIMARY KEY, chain TEXT, value TEXT, size INTEGER, last_access REAL)"
+                )
+                self._disk_bytes, self._disk_rows = self._totals(conn)
+
+    @property
+    def enabled(self):
+        return self.mode in ("memory", "disk")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def key(prompt_value, model):
+        model_id = getattr(model, "model_name", None) or getattr(model, "model", None) or type(model).__name__
+        temperature = getattr(model, "temperature", None)
+        raw = f"{model_id}\x00{temperature}\x00{prompt_value.to_string()}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _count(self, chain, outcome):
+        with self._lock:
+            self._stats.setdefault(chain, {"hits": 0, "misses": 0})[outcome] += 1
+
+    def get(self, chain, key, count=True):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                value = self._memory[key]
+            else:
+                value = None
+        if value is None and self.path:
+            with self._connect() as conn:
+                row = conn.execute("SELECT value FROM llm_cache WHERE key = ?", (key,)).fetchone()
+                if row:
+                    conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+                    value = row[0]
+                    self._remember(key, value)
+        if count:
+            self._count(chain, "misses" if value is None else "hits")
+        return value
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    @staticmethod
+    def _totals(conn):
+        return conn.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM llm_cache").fetchone()
+
+    def put(self, chain, key, value):
+        self._remember(key, value)
+        if not self.path:
+            return
+        size = len(value.encode("utf-8"))
+        with self._connect() as conn:
+            old = conn.execute("SELECT size FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?)",
+                (key, chain, value, size, time.time()),
+            )
+            with self._lock:
+                self._disk_bytes += size - (old[0] if old else 0)
+                self._disk_rows += 0 if old else 1
+                over = self._disk_bytes > self.max_bytes
+            if not over:
+                return
+            # Other processes may share the file, so recount before evicting
+            total, rows = self._totals(conn)
+            if total > self.max_bytes:
+                # Drop the least recently used tenth of the entries
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN "
+                    "(SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?)",
+                    (max(1, rows // 10),),
+                )
+                total, rows = self._totals(conn)
+            with self._lock:
+                self._disk_bytes, self._disk_rows = total, rows
+
+    def claim(self, key):
+        """
+        Single-flight: returns True if the caller should make the LLM call for `key`,
+        or waits for a concurrent caller with the same key and returns False.
+        """
+        with self._lock:
+            event = self._inflight.get(key)
+            if event is None:
+                self._inflight[key] = threading.Event()
+                return True
+        event.wait()
+        return False
+
+    def release(self, key):
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    async def aclaim(self, key):
+        """Async variant of claim, shared by the coroutines of the running event loop."""
+        loop_key = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            event = self._ainflight.get(loop_key)
+            if event is None:
+                self._ainflight[loop_key] = asyncio.Event()
+                return True
+        await event.wait()
+        return False
+
+    def arelease(self, key):
+        with self._lock:
+            event = self._ainflight.pop((id(asyncio.get_running_loop()), key), None)
+        if event is not None:
+            event.set()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+        if self.path:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM llm_cache")
+            with self._lock:
+                self._disk_bytes = self._disk_rows = 0
+
+    def stats(self):
+        """Hit/miss counts per chain since process start."""
+        with self._lock:
+            return {chain: dict(v) for chain, v in self._stats.items()}
+
+
+# Built on first use, so importers that install their own memo (batch_runner, replay) never open the default file
+llm_memo = lazy("llm_memo", ChainMemo)
+
+
+class StepMemo:
+    """
+    In-memory results of pipeline steps keyed on inputs that do not include the
+    question text (routing by question shape, column selection by table and
+    subquestion), so different questions can share them. Concurrent callers with
+    the same key wait for the first one; a failed call is not stored.
+    """
+
+    def __init__(self):
+        self._values = {}  # (step, key) -> Future
+        self._lock = threading.Lock()
+        self._stats = {}  # step -> {"hits": n, "misses": n}
+
+    def _claim(self, step, key):
+        with self._lock:
+            future = self._values.get((step, key))
+            owner = future is None
+            if owner:
+                future = self._values[(step, key)] = Future()
+            self._stats.setdefault(step, {"hits": 0, "misses": 0})["misses" if owner else "hits"] += 1
+        return future, owner
+
+    def _fail(self, step, key, future, error):
+        with self._lock:
+            self._values.pop((step, key), None)
+        future.set_exception(error)
+
+    def get(self, step, key, compute):
+        """The stored result of `step` for `key`, or compute() stored under it."""
+        future, owner = self._claim(step, key)
+        if not owner:
+            try:
+                return copy.deepcopy(future.result())
+            except Exception:
+                return compute()
+        try:
+            value = compute()
+        except Exception as e:
+            self._fail(step, key, future, e)
+            raise
+        future.set_result(value)
+        return copy.deepcopy(value)
+
+    async def aget(self, step, key, compute):
+        """Async variant of get; `compute` returns an awaitable."""
+        future, owner = self._claim(step, key)
+        if not owner:
+            try:
+                return copy.deepcopy(await asyncio.wrap_future(future))
+            except Exception:
+                return await compute()
+        try:
+            value = await compute()
+        except Exception as e:
+            self._fail(step, key, future, e)
+            raise
+        future.set_result(value)
+        return copy.deepcopy(value)
+
+    def stats(self):
+        """Hit/miss counts per step."""
+        with self._lock:
+            return {step: dict(v) for step, v in self._stats.items()}
+
+
+# Set to a StepMemo by batch_runner; None outside batches, where every question runs its own steps
+step_memo = None
+
+
+def memoized(model, chain_name, memo=None):
+    """
+    Wrap a chat model so identical rendered prompts are answered from `memo`
+    (defaults to the module-level llm_memo). Use in place of the model in a chain:
+    `template | memoized(model, "chain_subquestion") | StrOutputParser()`.
+    Models with a non-zero temperature are never cached.
+    """
+    def _memo():
+        return memo or llm_memo
+
+    def cacheable():
+        return _memo().enabled and not getattr(model, "temperature", 0)
+
+    def call(prompt_value, config):
+        if not cacheable():
+            return model.invoke(prompt_value, config)
+        memo_ = _memo()
+        key = memo_.key(prompt_value, model)
+        cached = memo_.get(chain_name, key)
+        owner = False
+        if cached is None:
+            owner = memo_.claim(key)
+            if not owner:
+                # An identical prompt was in flight on another thread; reuse its reply
+                cached = memo_.get(chain_name, key, count=False)
+        if cached is not None:
+            return AIMessage(content=cached)
+        try:
+            message = model.invoke(prompt_value, config)
+            memo_.put(chain_name, key, message.content)
+        finally:
+            # Only the claiming thread releases: a waiter whose leader failed calls the model unclaimed
+            if owner:
+                memo_.release(key)
+        return message
+
+    async def acall(prompt_value, config):
+        if not cacheable():
+            return await model.ainvoke(prompt_value, config)
+        memo_ = _memo()
+        key = memo_.key(prompt_value, model)
+        cached = memo_.get(chain_name, key)
+        owner = False
+        if cached is None:
+            owner = await memo_.aclaim(key)
+            if not owner:
+                # An identical prompt was in flight on this event loop; reuse its reply
+                cached = memo_.get(chain_name, key, count=False)
+        if cached is not None:
+            return AIMessage(content=cached)
+        try:
+            message = await model.ainvoke(prompt_value, config)
+            memo_.put(chain_name, key, message.content)
+        finally:
+            if owner:
+                memo_.arelease(key)
+        return message
+
+    return RunnableLambda(call, afunc=acall, name=f"memoized_{chain_name}")
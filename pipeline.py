@@ -2,14 +2,20 @@
 from langgraph.graph import StateGraph, START, END
 from typing import TypedDict, Annotated
 from operator import add
-import pickle
 import os
-import pandas as pd
-from sqlalchemy import create_engine
-from router_agent import agent_2
+from langchain_core.messages import AIMessageChunk
+from langchain_core.runnables import RunnableLambda
+from router_agent import agent_2, aagent_2
 from agent import graph_final
 from agent_helper import chain_filter_extractor, chain_query_extractor, chain_query_validator
-from fuzzy_match import call_match
+from fuzzy_match import call_match, acall_match
+from entity_linker import FILTER_LINKER_MODE, entity_linker, merge_filters, parse_filter_output
+from instrumentation import timed_node
+from kb_store import kb
+from startup import lazy
+from sql_validator import build_catalog, extract_sql_from_output, validate_sql
+import llm_cache
+import sql_templates
 
 
 # ------------------ Data Store ------------------
@@ -27,29 +33,27 @@ d_store = {
     "expense": ["income_expense_reporting"],
 }
 
-with open("kb.pkl", "rb") as f:
-    loaded_dict = pickle.load(f)
+def route_tables(route):
+    """Tables offered to an agent: its d_store list plus derived tables registered in the KB."""
+    return kb.route_tables(route, d_store[route])
 
-# ------------------ DB Config ------------------
-# pipeline.py
-import streamlit as st
-from sqlalchemy import create_engine
-import pickle
-from langgraph.graph import StateGraph, START, END
-from typing import TypedDict
 
-# ------------------ Load Secrets ------------------
-DB_USER = st.secrets["DB_USER"]
-DB_PASSWORD = st.secrets["DB_PASSWORD"]
-DB_HOST = st.secrets["DB_HOST"]
-DB_NAME = st.secrets["DBBASE"]
-DB_PORT = st.secrets.get("DB_PORT", 5432)
+_sql_catalog = {"version": None, "catalog": {}}
+
 
-engine = create_engine(
-    f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}?sslmode=require"
-)
+def sql_catalog():
+    """Validator catalog of the KB tables, rebuilt when the KB version changes."""
+    version = kb.version
+    if _sql_catalog["version"] != version:
+        catalog = build_catalog(kb.as_dict())
+        _sql_catalog.update(catalog=catalog, version=version)
+    return _sql_catalog["catalog"]
 
 
+template_store = lazy("sql_templates", sql_templates.TemplateStore)
+
+# "local": run the LLM validator only when the local checks fail; "llm": always run it
+SQL_VALIDATION_MODE = os.getenv("SQL_VALIDATION_MODE", "local")
 
 # ------------------ Helpers ------------------
 def remove_duplicates(f):
@@ -77,14 +81,80 @@ class FinalState(TypedDict):
     filter_extractor: list[str]
     fuzz_match: list[str]
     sql_query: str
+    validation_issues: list[str]
     final_query: str
+    sql_template: str
 
 
 # ------------------ Nodes ------------------
+# Every node has a sync and an async implementation; build_graph registers both so
+# graph_main.invoke/stream and graph_main.ainvoke/astream each run natively.
+def _template_state(question, mentions):
+    matched = template_store.match(question, mentions)
+    if matched is None:
+        return {}
+    issues = validate_sql(matched["final_query"], sql_catalog())
+    if issues:
+        print(f"⚠️ Filled SQL template failed the local checks {issues}, running the agents")
+        template_store.forget(matched["sql_template"])
+        return {}
+    print("📐 Matched a verified SQL template, skipping the agents")
+    return matched
+
+
+@timed_node("sql_template")
+def sql_template(state: FinalState):
+    if not sql_templates.SQL_TEMPLATES or not template_store.stats()["templates"]:
+        return {}
+    q = state["user_query"]
+    return _template_state(q, entity_linker.mentions(q))
+
+
+@timed_node("sql_template")
+async def asql_template(state: FinalState):
+    if not sql_templates.SQL_TEMPLATES or not template_store.stats()["templates"]:
+        return {}
+    q = state["user_query"]
+    return _template_state(q, await entity_linker.amentions(q))
+
+
+def template_condition(state: FinalState):
+    return "matched" if state.get("sql_template") else "router"
+
+
+def learn_template(question, state, sql):
+    """Store the confirmed SQL of a run as a verified template (see sql_templates)."""
+    if not sql_templates.SQL_TEMPLATES:
+        return None
+    try:
+        return template_store.learn(question, state, sql, entity_linker.mentions(question))
+    except Exception as e:
+        print(f"⚠️ Could not store the SQL template: {type(e).__name__}: {e}")
+        return None
+
+
+def _route_key(question, mentions):
+    """Routing key shared by questions that differ only in entity values and dates (batch runs)."""
+    skeleton, slots = sql_templates.question_shape(question, mentions)
+    return skeleton, tuple(tuple(sorted({loc[1] for loc in s.get("locations", [])})) for s in slots)
+
+
+@timed_node("router")
 def router(state: FinalState):
     q = state["user_query"]
-    o = agent_2(q)
-    return {"router_out": o}
+    if llm_cache.step_memo is None:
+        return {"router_out": agent_2(q)}
+    key = _route_key(q, entity_linker.mentions(q))
+    return {"router_out": llm_cache.step_memo.get("router", key, lambda: agent_2(q))}
+
+
+@timed_node("router")
+async def arouter(state: FinalState):
+    q = state["user_query"]
+    if llm_cache.step_memo is None:
+        return {"router_out": await aagent_2(q)}
+    key = _route_key(q, await entity_linker.amentions(q))
+    return {"router_out": await llm_cache.step_memo.aget("router", key, lambda: aagent_2(q))}
 
 
 def route_request(state: FinalState):
@@ -93,85 +163,192 @@ def route_request(state: FinalState):
     return routes
 
 
+@timed_node("dim")
 def dim(state: FinalState):
     q = state["user_query"]
     print("📊 Extracting relevant tables and columns from dim agent...")
-    sub = graph_final.invoke({"user_query": q, "table_lst": d_store["dim"]})
+    sub = graph_final.invoke({"user_query": q, "table_lst": route_tables("dim")})
+    return {"dim_out": sub}
+
+
+@timed_node("dim")
+async def adim(state: FinalState):
+    print("📊 Extracting relevant tables and columns from dim agent...")
+    sub = await graph_final.ainvoke({"user_query": state["user_query"], "table_lst": route_tables("dim")})
     return {"dim_out": sub}
 
 
+@timed_node("sales")
 def sales(state: FinalState):
     q = state["user_query"]
     print("💰 Extracting relevant tables and columns from sales agent...")
-    sub = graph_final.invoke({"user_query": q, "table_lst": d_store["sales"]})
+    sub = graph_final.invoke({"user_query": q, "table_lst": route_tables("sales")})
+    return {"sales_out": sub}
+
+
+@timed_node("sales")
+async def asales(state: FinalState):
+    print("💰 Extracting relevant tables and columns from sales agent...")
+    sub = await graph_final.ainvoke({"user_query": state["user_query"], "table_lst": route_tables("sales")})
     return {"sales_out": sub}
 
 
+@timed_node("expense")
 def expense(state: FinalState):
     q = state["user_query"]
     print("📉 Extracting relevant tables and columns from expense agent...")
-    sub = graph_final.invoke({"user_query": q, "table_lst": d_store["expense"]})
+    sub = graph_final.invoke({"user_query": q, "table_lst": route_tables("expense")})
     return {"expense_out": sub}
 
 
-def filter_check(state: FinalState):
-    q = state["user_query"]
+@timed_node("expense")
+async def aexpense(state: FinalState):
+    print("📉 Extracting relevant tables and columns from expense agent...")
+    sub = await graph_final.ainvoke({"user_query": state["user_query"], "table_lst": route_tables("expense")})
+    return {"expense_out": sub}
+
+
+def _collect_columns(state: FinalState):
     f = {}
     for key in ["dim_out", "sales_out", "expense_out"]:
         if key in state:
             f[key] = state.get(key)
-    col_details = remove_duplicates(f)
+    return remove_duplicates(f)
+
+
+def _filter_state(col_details, linked, extracted):
+    out = {"filter_extractor": extracted, "filtered_col": str(col_details)}
+    if linked:
+        out["fuzz_match"] = linked
+    return out
+
+
+def _skip_filter_llm(linked, unresolved):
+    if FILTER_LINKER_MODE != "dictionary" or unresolved:
+        if unresolved and FILTER_LINKER_MODE == "dictionary":
+            print(f"   ↪️ Unresolved filter spans {unresolved}, asking the filter extractor")
+        return False
+    if linked:
+        print(f"📖 Resolved {len(linked)} filter(s) from the entity dictionary, skipping the filter LLM")
+    else:
+        print("📖 No filter values in the question, skipping the filter LLM")
+    return True
+
+
+@timed_node("filter_check")
+def filter_check(state: FinalState):
+    q = state["user_query"]
+    col_details = _collect_columns(state)
     print("🔍 Checking the need for filter...")
-    response = chain_filter_extractor.invoke({"columns": str(col_details), "query": q}).replace("```", "")
-    return {"filter_extractor": eval(response), "filtered_col": str(col_details)}
+    linked, unresolved = entity_linker.link(q, col_details) if FILTER_LINKER_MODE == "dictionary" else ([], [])
+    if _skip_filter_llm(linked, unresolved):
+        return _filter_state(col_details, linked, ["no"])
+    response = chain_filter_extractor.invoke({"columns": str(col_details), "query": q})
+    return _filter_state(col_details, linked, parse_filter_output(response))
 
 
+@timed_node("filter_check")
+async def afilter_check(state: FinalState):
+    q = state["user_query"]
+    col_details = _collect_columns(state)
+    print("🔍 Checking the need for filter...")
+    linked, unresolved = await entity_linker.alink(q, col_details) if FILTER_LINKER_MODE == "dictionary" else ([], [])
+    if _skip_filter_llm(linked, unresolved):
+        return _filter_state(col_details, linked, ["no"])
+    response = await chain_filter_extractor.ainvoke({"columns": str(col_details), "query": q})
+    return _filter_state(col_details, linked, parse_filter_output(response))
+
+
+@timed_node("fuzz_filter")
 def fuzz_match_node(state: FinalState):
     val = state["filter_extractor"]
     print("🧩 Matching filters with fuzzy logic...")
     lst = call_match(val)
-    return {"fuzz_match": lst}
+    # Keep the filters already resolved by the entity dictionary
+    return {"fuzz_match": merge_filters(state.get("fuzz_match"), lst)}
+
+
+@timed_node("fuzz_filter")
+async def afuzz_match_node(state: FinalState):
+    print("🧩 Matching filters with fuzzy logic...")
+    return {"fuzz_match": merge_filters(state.get("fuzz_match"), await acall_match(state["filter_extractor"]))}
 
 
 def filter_condition(state: FinalState):
     return "no" if len(state["filter_extractor"]) == 1 else "yes"
 
 
+def _generation_inputs(state: FinalState):
+    return {"columns": state["filtered_col"], "query": state["user_query"], "filters": state.get("fuzz_match", "")}
+
+
+@timed_node("query_generator")
 def query_generation(state: FinalState):
-    q = state["user_query"]
-    tab_cols = state["filtered_col"]
-    filters = state.get("fuzz_match", "")
     print("🛠️ Generating SQL query...")
-    final_query = chain_query_extractor.invoke({"columns": tab_cols, "query": q, "filters": filters})
+    final_query = chain_query_extractor.invoke(_generation_inputs(state))
     return {"sql_query": final_query}
 
 
-def query_validation(state: FinalState):
+@timed_node("query_generator")
+async def aquery_generation(state: FinalState):
+    print("🛠️ Generating SQL query...")
+    return {"sql_query": await chain_query_extractor.ainvoke(_generation_inputs(state))}
+
+
+def _local_validation(state: FinalState):
+    """
+    Returns (issues, validator_inputs); validator_inputs is None when the LLM validator can be skipped.
+    """
+    issues = validate_sql(extract_sql_from_output(state["sql_query"]), sql_catalog())
+    if not issues and SQL_VALIDATION_MODE == "local":
+        print("✅ Local SQL checks passed, skipping LLM validation")
+        return issues, None
+
     print("✅ Validating and finalizing SQL query...")
-    o = chain_query_validator.invoke(
-        {
-            "columns": state["filtered_col"],
-            "query": state["user_query"],
-            "filters": state.get("fuzz_match"),
-            "sql_query": state["sql_query"],
-        }
-    )
-    return {"final_query": o}
+    for issue in issues:
+        print("   ⚠️ " + issue)
+    return issues, {
+        "columns": state["filtered_col"],
+        "query": state["user_query"],
+        "filters": state.get("fuzz_match"),
+        "sql_query": state["sql_query"],
+        "issues": "\n".join(issues) or "None",
+    }
+
+
+@timed_node("query_validation")
+def query_validation(state: FinalState):
+    issues, inputs = _local_validation(state)
+    if inputs is None:
+        return {"final_query": state["sql_query"], "validation_issues": []}
+    o = chain_query_validator.invoke(inputs)
+    return {"final_query": o, "validation_issues": issues}
+
+
+@timed_node("query_validation")
+async def aquery_validation(state: FinalState):
+    issues, inputs = _local_validation(state)
+    if inputs is None:
+        return {"final_query": state["sql_query"], "validation_issues": []}
+    o = await chain_query_validator.ainvoke(inputs)
+    return {"final_query": o, "validation_issues": issues}
 
 
 # ------------------ Graph Builder ------------------
 def build_graph():
     builder = StateGraph(FinalState)
-    builder.add_node("router", router)
-    builder.add_node("dim", dim)
-    builder.add_node("sales", sales)
-    builder.add_node("expense", expense)
-    builder.add_node("filter_check", filter_check)
-    builder.add_node("fuzz_filter", fuzz_match_node)
-    builder.add_node("query_generator", query_generation)
-    builder.add_node("query_validation", query_validation)
-
-    builder.add_edge(START, "router")
+    builder.add_node("sql_template", RunnableLambda(sql_template, afunc=asql_template))
+    builder.add_node("router", RunnableLambda(router, afunc=arouter))
+    builder.add_node("dim", RunnableLambda(dim, afunc=adim))
+    builder.add_node("sales", RunnableLambda(sales, afunc=asales))
+    builder.add_node("expense", RunnableLambda(expense, afunc=aexpense))
+    builder.add_node("filter_check", RunnableLambda(filter_check, afunc=afilter_check))
+    builder.add_node("fuzz_filter", RunnableLambda(fuzz_match_node, afunc=afuzz_match_node))
+    builder.add_node("query_generator", RunnableLambda(query_generation, afunc=aquery_generation))
+    builder.add_node("query_validation", RunnableLambda(query_validation, afunc=aquery_validation))
+
+    builder.add_edge(START, "sql_template")
+    builder.add_conditional_edges("sql_template", template_condition, {"matched": END, "router": "router"})
     builder.add_conditional_edges("router", route_request, ["dim", "sales", "expense"])
     builder.add_edge("dim", "filter_check")
     builder.add_edge("sales", "filter_check")
@@ -184,4 +361,41 @@ def build_graph():
     return builder.compile()
 
 
-graph_main = build_graph()
+graph_main = lazy("graph_main", build_graph)
+
+
+# ------------------ Streaming ------------------
+# Nodes whose LLM tokens are forwarded by stream_graph
+STREAM_TOKEN_NODES = ("query_generator", "query_validation")
+
+
+def stream_graph(question, config=None, cancel_event=None):
+    """
+    Run graph_main with stream_mode updates + messages + values. Yields
+    ("update", node, node_output) as each node finishes, ("token", node, text)
+    for LLM tokens of STREAM_TOKEN_NODES, and finally ("done", None, final_state).
+    Setting `cancel_event` (a threading.Event) stops the run before the next node;
+    in that case no "done" event is produced.
+    """
+    state = None
+    stream = graph_main.stream(
+        {"user_query": question}, config=config, stream_mode=["updates", "messages", "values"]
+    )
+    try:
+        for mode, chunk in stream:
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            if mode == "values":
+                state = chunk
+            elif mode == "updates":
+                for node, output in chunk.items():
+                    yield "update", node, output
+            else:
+                message, metadata = chunk
+                if (metadata.get("langgraph_node") in STREAM_TOKEN_NODES
+                        and isinstance(message, AIMessageChunk) and message.content):
+                    yield "token", metadata["langgraph_node"], message.content
+    finally:
+        # Closing the graph stream cancels nodes that have not started yet
+        stream.close()
+    yield "done", None, state
@@ -0,0 +1,108 @@
+import json
+import os
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+import db
+from agent_helper import chain_query_extractor
+from sql_validator import extract_sql_from_output
+
+
+# Planner estimates above which a generated query is not executed
+SQL_MAX_PLAN_COST = float(os.getenv("SQL_MAX_PLAN_COST", "50000000"))
+SQL_MAX_PLAN_ROWS = float(os.getenv("SQL_MAX_PLAN_ROWS", "5000000"))
+# "reject": send over-limit queries back for repair; "limit": wrap row-heavy queries in a LIMIT
+SQL_COST_GUARD_ACTION = os.getenv("SQL_COST_GUARD_ACTION", "reject")
+# Automatic repair attempts after a rejection or execution error
+SQL_MAX_REPAIRS = int(os.getenv("SQL_MAX_REPAIRS", "2"))
+
+
+def explain(sql: str, engine=None) -> dict:
+    """
+    Run EXPLAIN (FORMAT JSON) and return the planner's top-level estimates, or
+    None when the database is not Postgres. Raises SQLAlchemyError if the query
+    does not plan (syntax errors, unknown columns...).
+    """
+    engine = engine if engine is not None else db.engine
+    if engine.dialect.name != "postgresql":
+        return None
+    with db.read_only(engine, op="explain") as conn:
+        raw = conn.execute(text("EXPLAIN (FORMAT JSON) " + sql)).scalar()
+    plan = (json.loads(raw) if isinstance(raw, str) else raw)[0]["Plan"]
+    return {
+        "node_type": plan.get("Node Type"),
+        "total_cost": float(plan.get("Total Cost", 0)),
+        "plan_rows": float(plan.get("Plan Rows", 0)),
+    }
+
+
+def check_cost(sql: str, engine=None):
+    """
+    Compare the plan estimates with the configured limits.
+    Returns (sql_to_run, problem, plan); problem is None when the query may run.
+    """
+    plan = explain(sql, engine)
+    if plan is None:
+        return sql, None, None
+
+    if plan["total_cost"] > SQL_MAX_PLAN_COST:
+        return sql, (
+            f"Query rejected before execution: estimated cost {plan['total_cost']:.0f} exceeds the limit "
+            f"{SQL_MAX_PLAN_COST:.0f} (estimated rows {plan['plan_rows']:.0f}). Avoid cross joins, join on "
+            f"key columns and filter or aggregate as early as possible."
+        ), plan
+
+    if plan["plan_rows"] > SQL_MAX_PLAN_ROWS:
+        if SQL_COST_GUARD_ACTION == "limit":
+            limited = f"SELECT * FROM ({sql.strip().rstrip(';')}) AS guarded_result LIMIT {int(SQL_MAX_PLAN_ROWS)}"
+            print(f"⚠️ Estimated {plan['plan_rows']:.0f} rows, capping result at {int(SQL_MAX_PLAN_ROWS)}")
+            return limited, None, plan
+        return sql, (
+            f"Query rejected before execution: estimated {plan['plan_rows']:.0f} result rows exceeds the limit "
+            f"{SQL_MAX_PLAN_ROWS:.0f}. Aggregate the result or add filters."
+        ), plan
+
+    return sql, None, plan
+
+
+def repair_sql(state: dict, sql: str, error: str) -> str:
+    """Send the failing SQL and its database error back to chain_query_extractor."""
+    response = chain_query_extractor.invoke({
+        "columns": state.get("filtered_col", ""),
+        "query": state["user_query"],
+        "filters": state.get("fuzz_match", ""),
+        "error_feedback": f"SQL:\n{sql}\n\nDatabase error:\n{error}",
+    })
+    return extract_sql_from_output(response)
+
+
+def execute_with_repair(sql: str, state: dict, execute, max_repairs=SQL_MAX_REPAIRS):
+    """
+    Cost-check and run `sql` with `execute` (run_sql or execute_streaming, which
+    return an error string on failure). Rejections and execution errors are fed
+    back to the SQL generator for up to `max_repairs` new attempts.
+    Returns (result or last error message, sql actually run, attempts).
+    """
+    attempts = []
+    problem = None
+    for attempt in range(max_repairs + 1):
+        try:
+            to_run, problem, plan = check_cost(sql)
+        except SQLAlchemyError as e:
+            to_run, problem, plan = sql, f"❌ SQLAlchemy error: {str(e.__cause__ or e)}", None
+
+        if problem is None:
+            out = execute(to_run)
+            if not isinstance(out, str):
+                attempts.append({"sql": to_run, "error": None, "plan": plan})
+                return out, to_run, attempts
+            problem = out
+
+        attempts.append({"sql": sql, "error": problem, "plan": plan})
+        if attempt == max_repairs:
+            break
+        print(f"🔁 Repairing SQL (attempt {attempt + 1}/{max_repairs}): {problem}")
+        sql = repair_sql(state, sql, problem)
+
+    return problem, sql, attempts
@@ -0,0 +1,247 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from kb_store import kb
+
+
+# Persistent store for cached question results ("" keeps the cache in memory only)
+QUESTION_CACHE_PATH = os.getenv("QUESTION_CACHE_PATH", "question_cache.sqlite")
+QUESTION_CACHE_TTL = float(os.getenv("QUESTION_CACHE_TTL", str(7 * 24 * 3600)))
+QUESTION_CACHE_MAX_ENTRIES = int(os.getenv("QUESTION_CACHE_MAX_ENTRIES", "1000"))
+
+MONTHS = {
+    "jan": 1, "january": 1, "feb": 2, "february": 2, "mar": 3, "march": 3, "apr": 4, "april": 4,
+    "may": 5, "jun": 6, "june": 6, "jul": 7, "july": 7, "aug": 8, "august": 8,
+    "sep": 9, "sept": 9, "september": 9, "oct": 10, "october": 10, "nov": 11, "november": 11,
+    "dec": 12, "december": 12,
+}
+
+# Filler only: grain ("month", "year"), conjunctions ("and", "with", "all") and entity
+# nouns ("profit center" vs "cost center") change the answer and stay in the key
+STOPWORDS = {
+    "a", "an", "the", "for", "of", "in", "on", "at", "to", "me", "give", "show", "get", "list",
+    "please", "what", "is", "are", "was", "were", "tell", "find", "can", "you", "i", "want",
+    "during", "period",
+}
+
+# Bumped when normalize_question changes, so keys stored by an older version are dropped
+KEY_FORMAT = 3
+
+CODE_RE = re.compile(r"^(?=.*\d)(?=.*[a-z])[a-z0-9_\-]+$")
+
+
+def _canonical_dates(text):
+    """Rewrite month/year mentions ("Jan 2025", "01/2025", "2025-1", "202501") as YYYY-MM."""
+    month_names = "|".join(sorted(MONTHS, key=len, reverse=True))
+    text = re.sub(
+        rf"\b({month_names})\.?,?\s*(\d{{4}})\b",
+        lambda m: f"{m.group(2)}-{MONTHS[m.group(1)]:02d}", text,
+    )
+    text = re.sub(
+        rf"\b(\d{{4}})\s*({month_names})\b",
+        lambda m: f"{m.group(1)}-{MONTHS[m.group(2)]:02d}", text,
+    )
+    text = re.sub(r"\b(0?[1-9]|1[0-2])[/\-.](\d{4})\b", lambda m: f"{m.group(2)}-{int(m.group(1)):02d}", text)
+    text = re.sub(r"\b(\d{4})[/\-.](0?[1-9]|1[0-2])\b", lambda m: f"{m.group(1)}-{int(m.group(2)):02d}", text)
+    text = re.sub(r"\b(20\d{2})(0[1-9]|1[0-2])\b", lambda m: f"{m.group(1)}-{m.group(2)}", text)
+    return text
+
+
+def _canonical_number(token):
+    """'1,000' -> '1000', '2.50' -> '2.5', '5k' -> '5000'."""
+    m = re.fullmatch(r"(\d[\d,]*)(?:\.(\d+))?(k|m)?", token)
+    if not m:
+        return token
+    value = float(m.group(1).replace(",", "") + ("." + m.group(2) if m.group(2) else ""))
+    value *= {"k": 1e3, "m": 1e6}.get(m.group(3), 1)
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+def normalize_question(question: str, mentions=()) -> str:
+    """
+    Canonical form of a question used as the cache key: lower case, dates as
+    YYYY-MM, canonical numbers, upper-cased entity codes, no filler words.
+    `mentions` (entity_linker.canonical_mentions) replaces each linked entity and its
+    noun with a table.column=value token, so "brand B001", "B001" and the brand's
+    name share a key. "by month" / "by year" and "profit center X" / "cost center X"
+    keep distinct keys.
+    """
+    parts, entities, last = [], [], 0
+    for start, end, token in mentions:
+        parts += [question[last:start], f" zzentity{len(entities)}zz "]
+        entities.append(token)
+        last = end
+    parts.append(question[last:])
+    text = _canonical_dates("".join(parts).lower())
+    tokens = re.findall(r"\d{4}-\d{2}|[a-z0-9_\-]+(?:[.,]\d+)*[km]?", text)
+
+    out = []
+    for tok in tokens:
+        entity = re.fullmatch(r"zzentity(\d+)zz", tok)
+        if entity:
+            out.append(entities[int(entity.group(1))])
+        elif re.fullmatch(r"\d{4}-\d{2}", tok):
+            out.append(tok)
+        elif CODE_RE.match(tok) and not re.fullmatch(r"[\d.,]+[km]?", tok):
+            out.append(tok.upper())
+        elif re.fullmatch(r"[\d,]+(?:\.\d+)?[km]?", tok):
+            out.append(_canonical_number(tok))
+        elif tok not in STOPWORDS:
+            out.append(tok)
+    return " ".join(out)
+
+
+def question_key(question: str) -> str:
+    """normalize_question with the entity dictionary's canonical mentions."""
+    # Imported here: entity_linker imports this module
+    from entity_linker import entity_linker
+
+    try:
+        mentions = entity_linker.canonical_mentions(question)
+    except Exception as e:
+        print(f"⚠️ Could not link entities for the question key: {type(e).__name__}: {e}")
+        mentions = []
+    return normalize_question(question, mentions)
+
+
+class QuestionCache:
+    """
+    Cache of validated graph_main results keyed on the normalized question.
+    Keeps an in-memory LRU in front of an optional SQLite file so hits survive
+    restarts; entries expire after `ttl` seconds or when the KB version changes.
+    """
+
+    def __init__(self, path=QUESTION_CACHE_PATH, ttl=QUESTION_CACHE_TTL,
+                 max_entries=QUESTION_CACHE_MAX_ENTRIES, kb_version=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._fixed_version = kb_version
+        self.kb_version = self._current_version()
+        self._memory = OrderedDict()  # key -> (created_at, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.path:
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS question_cache ("
+                    "key TEXT PRIMARY KEY, kb_version TEXT, question TEXT, "
+                    "created_at REAL, last_access REAL, result TEXT)"
+                )
+                # Results built against an older KB are no longer valid
+                conn.execute("DELETE FROM question_cache WHERE kb_version != ?", (self.kb_version,))
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _current_version(self):
+        return f"{self._fixed_version or kb.version}/{KEY_FORMAT}"
+
+    def _check_version(self):
+        """Drop every entry when the KB changed (e.g. a rebuild in a running app)."""
+        version = self._current_version()
+        if version == self.kb_version:
+            return
+        with self._lock:
+            self._memory.clear()
+            self.kb_version = version
+        if self.path:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM question_cache WHERE kb_version != ?", (version,))
+
+    def _expired(self, created_at):
+        return time.time() - created_at > self.ttl
+
+    def get(self, question):
+        """Return the cached result state for `question`, or None."""
+        self._check_version()
+        key = question_key(question)
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and not self._expired(entry[0]):
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+        result = None
+        if self.path:
+            with self._connect() as conn:
+                row = conn.execute(
+                    "SELECT created_at, result FROM question_cache WHERE key = ? AND kb_version = ?",
+                    (key, self.kb_version),
+                ).fetchone()
+                if row and not self._expired(row[0]):
+                    conn.execute("UPDATE question_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+                    result = json.loads(row[1])
+                    self._remember(key, row[0], result)
+
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def _remember(self, key, created_at, result):
+        with self._lock:
+            self._memory[key] = (created_at, result)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def put(self, question, result):
+        """Store a validated result state for `question`."""
+        self._check_version()
+        key = question_key(question)
+        now = time.time()
+        result = json.loads(json.dumps(result, default=str))
+        self._remember(key, now, result)
+        if self.path:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO question_cache VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, self.kb_version, question, now, now, json.dumps(result)),
+                )
+                conn.execute("DELETE FROM question_cache WHERE created_at < ?", (now - self.ttl,))
+                conn.execute(
+                    "DELETE FROM question_cache WHERE key NOT IN "
+                    "(SELECT key FROM question_cache ORDER BY last_access DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+
+    def invalidate(self, question=None):
+        """Drop one question, or everything when called without arguments."""
+        with self._lock:
+            if question is None:
+                self._memory.clear()
+            else:
+                self._memory.pop(question_key(question), None)
+        if self.path:
+            with self._connect() as conn:
+                if question is None:
+                    conn.execute("DELETE FROM question_cache")
+                else:
+                    conn.execute("DELETE FROM question_cache WHERE key = ?", (question_key(question),))
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self._memory)}
+
+
+def invoke_cached(graph, question, cache, config=None):
+    """
+    graph.invoke with the question cache in front. Returns (result, hit).
+    Only results that produced a SELECT statement are stored.
+    """
+    cached = cache.get(question)
+    if cached is not None:
+        return cached, True
+    result = graph.invoke({"user_query": question}, config=config)
+    if "SELECT" in str(result.get("final_query", "")).upper():
+        cache.put(question, result)
+    return result, False
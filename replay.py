@@ -0,0 +1,299 @@
+"""
+Record-and-replay regression harness for prompt and model changes.
+
+    python replay.py record questions.txt -o corpus.jsonl     # run and record a corpus
+    python replay.py replay corpus.jsonl --report report.json  # rerun it on the current code and models
+
+Recording runs each question through graph_main and stores the final graph
+state, the final SQL, a fingerprint of its result set, the per-node timings,
+the LLM calls and tokens per chain, and the models and prompt templates used.
+Replay reruns every question, executes both the recorded and the new SQL on
+the current data and compares their result hashes, and reports per-node
+latency, LLM call and token deltas. It exits with status 1 when a result set
+changed, a question stopped producing SQL, or the median latency grew by more
+than --latency-tolerance.
+
+Verified SQL templates are turned off while recording and replaying so every
+question runs the full agent pipeline. Set REPLAY_RECORD_PATH to also record
+the questions asked in the app.
+"""
+import argparse
+import hashlib
+import json
+import numbers
+import os
+import statistics
+import sys
+import time
+
+import pandas as pd
+from langchain_core.prompts import ChatPromptTemplate
+
+import agent_helper
+import llm_cache
+import router_agent
+import sql_templates
+from batch_runner import load_questions
+from instrumentation import metrics_run
+from pipeline import graph_main
+from result_cache import normalize_sql
+from sql_runner import run_sql
+from sql_validator import extract_sql_from_output
+
+
+# JSON-lines corpus the app appends its questions to ("" disables live recording)
+REPLAY_RECORD_PATH = os.getenv("REPLAY_RECORD_PATH", "")
+# Relative growth of the median run time reported as a latency regression
+REPLAY_LATENCY_TOLERANCE = float(os.getenv("REPLAY_LATENCY_TOLERANCE", "0.25"))
+
+
+def prompt_versions():
+    """{template name: short hash} of the agents' prompt templates."""
+    versions = {}
+    for module in (router_agent, agent_helper):
+        for name, obj in vars(module).items():
+            if isinstance(obj, ChatPromptTemplate):
+                text = obj.pretty_repr()
+                versions[f"{module.__name__}.{name}"] = hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+    return versions
+
+
+def _cell(value):
+    if value is None or (not isinstance(value, (list, dict, tuple)) and pd.isna(value)):
+        return None
+    if isinstance(value, numbers.Real):
+        # 3 and 3.0 (an INTEGER vs NUMERIC SUM) are the same result
+        return round(float(value), 6)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def result_fingerprint(df):
+    """
+    Row count, column count and an order-insensitive hash of the values. Column
+    names are left out so a renamed alias does not count as a different result.
+    """
+    rows = sorted(json.dumps([_cell(v) for v in row]) for row in df.astype(object).itertuples(index=False))
+    digest = hashlib.sha256("\n".join(rows).encode("utf-8")).hexdigest()[:16]
+    return {"rows": len(df), "columns": len(df.columns), "hash": digest}
+
+
+def execute_fingerprint(sql):
+    """Fingerprint of the SQL's result on the current data, or {"error": ...}."""
+    if not sql or "SELECT" not in sql.upper():
+        return {"error": "no SQL"}
+    out = run_sql(sql, use_cache=False)
+    if isinstance(out, str):
+        return {"error": out}
+    return result_fingerprint(out)
+
+
+def build_record(question, state, metrics, result=None, qid=None):
+    """Corpus record for one pipeline run; `metrics` is RunMetrics.to_dict()."""
+    final_query = (state or {}).get("final_query", "")
+    sql = extract_sql_from_output(final_query) if final_query else ""
+    return {
+        "id": qid,
+        "question": question,
+        "recorded_at": time.time(),
+        "status": metrics["outcome"],
+        "sql": sql,
+        "result": result,
+        "state": json.loads(json.dumps(state or {}, default=str)),
+        "total_seconds": metrics["total_seconds"],
+        "nodes": metrics["nodes"],
+        "llm": metrics["llm"],
+        "llm_calls": metrics["llm_calls"],
+        "models": metrics.get("models", {}),
+        "prompts": prompt_versions(),
+    }
+
+
+def capture(question, qid=None, execute=True):
+    """Run one question through graph_main and return its corpus record."""
+    with metrics_run(question) as run:
+        try:
+            state = graph_main.invoke({"user_query": question}, config=run.config())
+        except Exception as e:
+            run.outcome = f"error:{type(e).__name__}"
+            state = {"error": str(e)}
+        else:
+            run.outcome = "ok" if "SELECT" in state.get("final_query", "").upper() else "no_sql"
+        metrics = run.to_dict()
+    record = build_record(question, state, metrics, qid=qid)
+    if execute and record["status"] == "ok":
+        record["result"] = execute_fingerprint(record["sql"])
+    return record
+
+
+def append_records(records, path):
+    with open(path, "a", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+def record_live(question, state, run):
+    """
+    Append an app run to REPLAY_RECORD_PATH (the result is fingerprinted at replay
+    time). Runs answered from a SQL template are skipped: they exercise no agents.
+    """
+    if REPLAY_RECORD_PATH and not state.get("sql_template"):
+        append_records([build_record(question, state, run.to_dict())], REPLAY_RECORD_PATH)
+
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _tokens(llm):
+    return sum(v["prompt_tokens"] + v["completion_tokens"] for v in llm.values())
+
+
+def _result_status(old, new):
+    if "error" in new and "error" in old:
+        return "both_error"
+    if "error" in new:
+        return "new_error"
+    if "error" in old:
+        return "fixed"
+    return "equal" if old == new else "different"
+
+
+def compare(old, new):
+    """Comparison of a recorded run with its replay."""
+    same_sql = bool(old["sql"]) and bool(new["sql"]) and normalize_sql(old["sql"]) == normalize_sql(new["sql"])
+    old_result = execute_fingerprint(old["sql"])
+    new_result = old_result if same_sql else execute_fingerprint(new["sql"])
+    nodes = {}
+    for node in sorted(set(old["nodes"]) | set(new["nodes"])):
+        before = old["nodes"].get(node, {}).get("seconds", 0.0)
+        after = new["nodes"].get(node, {}).get("seconds", 0.0)
+        nodes[node] = {"before": round(before, 4), "after": round(after, 4), "delta": round(after - before, 4)}
+    llm = {}
+    for chain in sorted(set(old["llm"]) | set(new["llm"])):
+        a, b = old["llm"].get(chain, {}), new["llm"].get(chain, {})
+        llm[chain] = {
+            "calls_delta": b.get("calls", 0) - a.get("calls", 0),
+            "tokens_delta": (b.get("prompt_tokens", 0) + b.get("completion_tokens", 0))
+                            - (a.get("prompt_tokens", 0) + a.get("completion_tokens", 0)),
+        }
+    return {
+        "id": old.get("id"),
+        "question": old["question"],
+        "status_before": old["status"],
+        "status_after": new["status"],
+        "sql_changed": not same_sql,
+        "sql_before": old["sql"],
+        "sql_after": new["sql"],
+        "result": _result_status(old_result, new_result),
+        # Data drift since recording: the recorded SQL no longer returns what it did
+        "data_changed": bool(old.get("result")) and "error" not in old_result and old["result"] != old_result,
+        "seconds_before": old["total_seconds"],
+        "seconds_after": new["total_seconds"],
+        "nodes": nodes,
+        "llm_calls_delta": new["llm_calls"] - old["llm_calls"],
+        "tokens_delta": _tokens(new["llm"]) - _tokens(old["llm"]),
+        "llm": llm,
+    }
+
+
+def summarize(corpus, comparisons, current_prompts, current_models, tolerance=REPLAY_LATENCY_TOLERANCE):
+    """Aggregate the comparisons and list the regressions."""
+    if not comparisons:
+        return {"questions": 0, "regressions": []}
+    before = statistics.median(c["seconds_before"] for c in comparisons)
+    after = statistics.median(c["seconds_after"] for c in comparisons)
+    nodes = {}
+    for c in comparisons:
+        for node, d in c["nodes"].items():
+            agg = nodes.setdefault(node, {"before": [], "after": []})
+            agg["before"].append(d["before"])
+            agg["after"].append(d["after"])
+    recorded_prompts, recorded_models = {}, {}
+    for record in corpus:
+        recorded_prompts.update(record.get("prompts", {}))
+        recorded_models.update(record.get("models", {}))
+    results = {}
+    for c in comparisons:
+        results[c["result"]] = results.get(c["result"], 0) + 1
+
+    regressions = [
+        {"id": c["id"], "question": c["question"], "reason": f"result {c['result']}"}
+        for c in comparisons if c["result"] in ("different", "new_error")
+    ]
+    if after > before * (1 + tolerance):
+        regressions.append({"reason": f"median latency {before:.3f}s -> {after:.3f}s (> {tolerance:.0%})"})
+    return {
+        "questions": len(comparisons),
+        "results": results,
+        "sql_changed": sum(c["sql_changed"] for c in comparisons),
+        "data_changed": sum(c["data_changed"] for c in comparisons),
+        "median_seconds": {"before": round(before, 4), "after": round(after, 4)},
+        "node_mean_seconds": {
+            node: {"before": round(statistics.mean(v["before"]), 4), "after": round(statistics.mean(v["after"]), 4),
+                   "delta": round(statistics.mean(v["after"]) - statistics.mean(v["before"]), 4)}
+            for node, v in nodes.items()
+        },
+        "llm_calls_delta": sum(c["llm_calls_delta"] for c in comparisons),
+        "tokens_delta": sum(c["tokens_delta"] for c in comparisons),
+        "prompts_changed": sorted(k for k, v in current_prompts.items() if recorded_prompts.get(k, v) != v),
+        "models_changed": {chain: [recorded_models.get(chain), model] for chain, model in current_models.items()
+                           if recorded_models.get(chain, model) != model},
+        "regressions": regressions,
+    }
+
+
+def replay(corpus, tolerance=REPLAY_LATENCY_TOLERANCE):
+    """Rerun a recorded corpus; returns (summary, per-question comparisons)."""
+    comparisons, models = [], {}
+    for i, old in enumerate(corpus, 1):
+        new = capture(old["question"], qid=old.get("id"), execute=False)
+        models.update(new["models"])
+        comparisons.append(compare(old, new))
+        c = comparisons[-1]
+        print(f"🔁 {i}/{len(corpus)} {c['result']:<10} sql {'changed' if c['sql_changed'] else 'same':<7} "
+              f"{c['seconds_before']:.2f}s -> {c['seconds_after']:.2f}s  {old['question'][:60]}")
+    return summarize(corpus, comparisons, prompt_versions(), models, tolerance), comparisons
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record a question corpus or replay it against the current pipeline")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rec = sub.add_parser("record", help="run questions and record their runs")
+    rec.add_argument("questions", help=".txt (one question per line) or .jsonl with a 'question' field")
+    rec.add_argument("-o", "--output", default="replay_corpus.jsonl", help="corpus file (appended)")
+    rep = sub.add_parser("replay", help="rerun a recorded corpus and compare")
+    rep.add_argument("corpus", help="corpus written by `record` or REPLAY_RECORD_PATH")
+    rep.add_argument("--report", default=None, help="write the summary and per-question comparisons here")
+    rep.add_argument("--latency-tolerance", type=float, default=REPLAY_LATENCY_TOLERANCE,
+                     help="allowed relative growth of the median run time")
+    for p in (rec, rep):
+        p.add_argument("--llm-cache", default="off", choices=["off", "memory", "disk"],
+                       help="LLM reply cache while running (off measures the real model calls)")
+    args = parser.parse_args(argv)
+    llm_cache.llm_memo = llm_cache.ChainMemo(mode=args.llm_cache)
+    sql_templates.SQL_TEMPLATES = False
+
+    if args.command == "record":
+        records = []
+        for i, (qid, question) in enumerate(load_questions(args.questions), 1):
+            records.append(capture(question, qid=qid))
+            append_records(records[-1:], args.output)
+            print(f"📼 {i}: {records[-1]['status']} in {records[-1]['total_seconds']:.2f}s  {question[:60]}")
+        return records
+
+    summary, comparisons = replay(load_corpus(args.corpus), args.latency_tolerance)
+    print(json.dumps(summary, indent=2))
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "questions": comparisons}, f, indent=2, default=str)
+    if summary["regressions"]:
+        print(f"❌ {len(summary['regressions'])} regression(s)")
+    return summary
+
+
+if __name__ == "__main__":
+    summary = main()
+    sys.exit(1 if isinstance(summary, dict) and summary["regressions"] else 0)
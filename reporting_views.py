@@ -0,0 +1,249 @@
+"""
+Build and refresh denormalized reporting views for the common join paths.
+
+    python reporting_views.py                      # create missing views, refresh the others
+    python reporting_views.py --views rv_sales     # limit the run
+    python reporting_views.py --every 60           # refresh every 60 minutes until stopped
+
+Each view in REPORTING_VIEWS is a fact table LEFT JOINed to its dimension
+tables (optionally pre-aggregated). On Postgres it is a MATERIALIZED VIEW,
+refreshed CONCURRENTLY when it has a unique key; elsewhere it is rebuilt as a
+plain table. A dimension is only joined when its join key is unique, so a view
+never duplicates fact rows. Built views are registered in the KB as preferred
+tables for their route, with the column descriptions of the source tables.
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, inspect, select, text
+
+import db
+from column_index import untrimmed_tables
+from kb_store import KB_PATH, KnowledgeBase, write_kb
+
+
+# view name -> definition. Joins are (dimension table, key column); the key is looked up in
+# the fact table or an earlier dimension. "group_by"/"measures" make a pre-aggregated view.
+REPORTING_VIEWS = {
+    "rv_sales": {
+        "route": "sales",
+        "fact": "sales_data",
+        "joins": [("profit_center_hierarchy", "profit_center_code"), ("brand_master", "brand_id"),
+                  ("key_figure_metric_map", "key_figure")],
+        "indexes": ["year_month", "profit_center_code", "brand_id", "key_figure", "version"],
+    },
+    "rv_sales_monthly": {
+        "route": "sales",
+        "fact": "sales_data",
+        "joins": [("profit_center_hierarchy", "profit_center_code"), ("brand_master", "brand_id"),
+                  ("key_figure_metric_map", "key_figure")],
+        "group_by": ["year_month", "version", "key_figure", "metric", "brand_id", "brand_name", "currency"],
+        "measures": {"value": "sum"},
+        "indexes": ["year_month", "brand_id", "metric"],
+    },
+    "rv_income_expense": {
+        "route": "expense",
+        "fact": "income_expense_reporting",
+        "joins": [("profit_center_hierarchy", "profit_center_code"), ("brand_master", "brand_id"),
+                  ("cost_center_hierarchy", "cost_center_code"), ("cost_element_hierarchy", "cost_element_code"),
+                  ("functional_area_hierarchy", "functional_area_id"), ("key_figure_metric_map", "key_figure")],
+        "indexes": ["year_month", "profit_center_code", "cost_center_code", "cost_element_code",
+                    "functional_area_id", "key_figure"],
+    },
+}
+META_TABLE = "reporting_view_meta"
+
+
+def _meta_table(metadata):
+    return Table(
+        META_TABLE, metadata,
+        Column("name", String(128), primary_key=True),
+        Column("definition", String(32)),
+        Column("rows", Integer),
+        Column("refreshed_at", Float),
+    )
+
+
+def _unique(conn, table, key):
+    """True if `key` identifies at most one row of `table` (so joining it cannot fan out)."""
+    dup = conn.execute(text(
+        f"SELECT {key} FROM {table} WHERE {key} IS NOT NULL GROUP BY {key} HAVING COUNT(*) > 1 LIMIT 1"
+    )).first()
+    return dup is None
+
+
+def build_select(conn, spec):
+    """
+    (sql, columns, unique_key, skipped) for a view definition. columns maps each
+    output column to (source table, source column); skipped lists joins left out.
+    """
+    insp = inspect(conn)
+    fact = spec["fact"]
+    columns = {c["name"]: (fact, c["name"]) for c in insp.get_columns(fact)}
+    owner = {name: "f" for name in columns}
+    select_list = [f"f.{name}" for name in columns]
+    joins, skipped = [], []
+    for i, (table, key) in enumerate(spec.get("joins", []), 1):
+        dim_columns = [c["name"] for c in insp.get_columns(table)]
+        if key not in owner or key not in dim_columns:
+            skipped.append(f"{table}: join key {key} not found")
+            continue
+        if not _unique(conn, table, key):
+            skipped.append(f"{table}: {key} is not unique")
+            continue
+        alias = f"d{i}"
+        joins.append(f"LEFT JOIN {table} {alias} ON {alias}.{key} = {owner[key]}.{key}")
+        for name in dim_columns:
+            if name not in columns:
+                columns[name] = (table, name)
+                owner[name] = alias
+                select_list.append(f"{alias}.{name}")
+    sql = f"SELECT {', '.join(select_list)} FROM {fact} f " + " ".join(joins)
+    pk = insp.get_pk_constraint(fact).get("constrained_columns") or None
+
+    if spec.get("group_by"):
+        group = [g for g in spec["group_by"] if g in columns]
+        measures = {m: agg for m, agg in spec.get("measures", {}).items() if m in columns}
+        aggregated = {g: columns[g] for g in group}
+        aggregated.update({m: columns[m] for m in measures})
+        sql = (f"SELECT {', '.join(group + [f'{agg.upper()}({m}) AS {m}' for m, agg in measures.items()])} "
+               f"FROM ({sql}) detail GROUP BY {', '.join(group)}")
+        return sql, aggregated, group, skipped
+    return sql, columns, pk, skipped
+
+
+def _definition(sql, unique_key, indexes):
+    return hashlib.sha256(json.dumps([sql, unique_key, indexes]).encode("utf-8")).hexdigest()[:16]
+
+
+def _create(conn, name, sql, unique_key, indexes):
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {name}"))
+        conn.execute(text(f"CREATE MATERIALIZED VIEW {name} AS {sql} WITH DATA"))
+    else:
+        # Other databases get a plain table, swapped in by rename
+        conn.execute(text(f"DROP TABLE IF EXISTS {name}__new"))
+        conn.execute(text(f"CREATE TABLE {name}__new AS {sql}"))
+        conn.execute(text(f"DROP TABLE IF EXISTS {name}"))
+        conn.execute(text(f"ALTER TABLE {name}__new RENAME TO {name}"))
+    if unique_key:
+        conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_{name} ON {name} ({', '.join(unique_key)})"))
+    for col in indexes:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{name}_{col} ON {name} ({col})"))
+
+
+def refresh(name, engine=None, force=False):
+    """
+    Create `name` if it is missing or its definition changed, otherwise refresh its
+    data. Returns a summary dict including the columns for KB registration.
+    """
+    engine = engine if engine is not None else db.engine
+    spec = REPORTING_VIEWS[name]
+    metadata = MetaData()
+    meta = _meta_table(metadata)
+    start = time.perf_counter()
+    with engine.begin() as conn:
+        metadata.create_all(conn)
+        sql, columns, unique_key, skipped = build_select(conn, spec)
+        # The unique index already serves lookups on its leading column
+        leading = (unique_key or [None])[0]
+        indexes = [c for c in spec.get("indexes", []) if c in columns and c != leading]
+        definition = _definition(sql, unique_key, indexes)
+        previous = conn.execute(select(meta.c.definition).where(meta.c.name == name)).scalar()
+        insp = inspect(conn)
+        exists = insp.has_table(name) or (
+            conn.dialect.name == "postgresql" and name in insp.get_materialized_view_names()
+        )
+
+        if force or not exists or previous != definition or conn.dialect.name != "postgresql":
+            _create(conn, name, sql, unique_key, indexes)
+            status = "created" if previous != definition or not exists else "rebuilt"
+        else:
+            concurrently = "CONCURRENTLY " if unique_key else ""
+            conn.execute(text(f"REFRESH MATERIALIZED VIEW {concurrently}{name}"))
+            status = "refreshed"
+        rows = conn.execute(text(f"SELECT COUNT(*) FROM {name}")).scalar()
+        conn.execute(meta.delete().where(meta.c.name == name))
+        conn.execute(meta.insert(), [{"name": name, "definition": definition, "rows": rows,
+                                      "refreshed_at": time.time()}])
+    return {"view": name, "status": status, "rows": rows, "seconds": round(time.perf_counter() - start, 2),
+            "columns": columns, "skipped_joins": skipped, "aggregated": bool(spec.get("group_by"))}
+
+
+def kb_entry(summary, kb=None):
+    """KB entry for a built view; column descriptions are taken from the source tables' entries."""
+    spec = REPORTING_VIEWS[summary["view"]]
+    kb = kb or {}
+    used = {table for table, _ in summary["columns"].values()}
+    sources = [t for t in [spec["fact"]] + [t for t, _ in spec.get("joins", [])] if t in used]
+    descriptions = {}
+    for col, (table, source_col) in summary["columns"].items():
+        desc = (kb.get(table) or {}).get("columns", {}).get(source_col, f"{source_col} from {table}")
+        if col in spec.get("measures", {}):
+            desc = f"{spec['measures'][col].upper()} of {desc}"
+        descriptions[col] = desc
+    grain = (f" pre-aggregated by {', '.join(c for c in spec['group_by'] if c in summary['columns'])}"
+             if summary["aggregated"] else "")
+    return {
+        "table_description": (
+            f"PREFERRED reporting view: {spec['fact']} already joined to {', '.join(sources[1:]) or 'no dimensions'}"
+            f"{grain}. Use this single table instead of joining those tables yourself whenever all the needed "
+            f"columns are in it."
+        ),
+        "columns": descriptions,
+        "derived": {"kind": "reporting_view", "route": spec["route"], "preferred": True, "sources": sources},
+    }
+
+
+def register(summaries, kb_path=KB_PATH):
+    """Add or update the view entries in the KB; returns the new KB version."""
+    kb = KnowledgeBase(kb_path).as_dict() if os.path.exists(kb_path) else {}
+    for summary in summaries:
+        kb[summary["view"]] = kb_entry(summary, kb)
+    version = write_kb(kb, kb_path)
+    wide = untrimmed_tables(KnowledgeBase(kb_path))
+    if wide:
+        print(f"⚠️ Column ranking no longer trims {wide}: the join keys cover every column")
+    return version
+
+
+def refresh_all(names=None, force=False, kb_path=KB_PATH, engine=None):
+    """Refresh every view in `names` (default all) and register the results in the KB."""
+    results = {"views": [], "failed": {}}
+    for name in names or REPORTING_VIEWS:
+        try:
+            summary = refresh(name, engine, force)
+        except Exception as e:
+            print(f"❌ {name}: {type(e).__name__}: {e}")
+            results["failed"][name] = f"{type(e).__name__}: {e}"
+            continue
+        for note in summary["skipped_joins"]:
+            print(f"   ⚠️ {name}: skipped {note}")
+        print(f"📦 {name}: {summary['status']} ({summary['rows']:,} rows in {summary['seconds']}s)")
+        results["views"].append(summary)
+    if results["views"] and kb_path:
+        results["kb_version"] = register(results["views"], kb_path)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build or refresh the reporting views")
+    parser.add_argument("--views", nargs="*", default=None, help="views to refresh (default: all)")
+    parser.add_argument("--force", action="store_true", help="drop and recreate instead of refreshing")
+    parser.add_argument("--kb-path", default=KB_PATH, help="KB file to register the views in")
+    parser.add_argument("--every", type=float, default=0, help="keep refreshing every N minutes")
+    args = parser.parse_args(argv)
+
+    while True:
+        results = refresh_all(args.views, args.force, args.kb_path)
+        print(json.dumps({k: v for k, v in results.items() if k != "views"}, indent=2))
+        if not args.every:
+            return results
+        time.sleep(args.every * 60)
+
+
+if __name__ == "__main__":
+    main()
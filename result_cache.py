@@ -0,0 +1,254 @@
+"""
+In-process cache of SQL results keyed on the normalized final SQL.
+
+Results are kept as Arrow tables (low-cardinality text columns dictionary
+encoded) under a memory budget with LRU eviction. Each entry remembers the
+data version of every table it reads; when a table's version changes the
+entries reading it are dropped. Versions come from pg_stat_user_tables
+modification counters, from RESULT_CACHE_VERSION_SQL, or are bumped by calling
+invalidate() from a refresh hook. Versions are re-checked at most every
+RESULT_CACHE_CHECK_SECONDS, so repeated queries in between do not touch the
+database.
+"""
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation
+from functools import lru_cache
+
+import sqlglot
+from sqlalchemy import text
+from sqlglot import exp
+from sqlglot.errors import SqlglotError
+
+import db
+
+
+# Memory budget for cached results (0 disables the cache)
+RESULT_CACHE_MAX_MB = float(os.getenv("RESULT_CACHE_MAX_MB", "256"))
+# Larger results are streamed to the user but not cached
+RESULT_CACHE_MAX_ROWS = int(os.getenv("RESULT_CACHE_MAX_ROWS", "200000"))
+# Seconds between data version checks for a table
+RESULT_CACHE_CHECK_SECONDS = float(os.getenv("RESULT_CACHE_CHECK_SECONDS", "30"))
+# Entries older than this are dropped even if no version change was seen
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "3600"))
+# Query returning (table_name, version) rows; "" uses pg_stat_user_tables on Postgres
+RESULT_CACHE_VERSION_SQL = os.getenv("RESULT_CACHE_VERSION_SQL", "")
+
+# Any insert/update/delete bumps the counters; TRUNCATE and VACUUM FULL change the filenode
+PG_VERSION_SQL = """
+SELECT relname, concat_ws(':', n_tup_ins, n_tup_upd, n_tup_del, pg_relation_filenode(relid))
+FROM pg_stat_user_tables
+"""
+
+
+def _strip_comments(node):
+    node.comments = None
+    return node
+
+
+def _canonical_number(node):
+    if isinstance(node, exp.Literal) and not node.is_string:
+        try:
+            value = Decimal(node.this).normalize()
+        except InvalidOperation:
+            return node
+        return exp.Literal.number(format(value, "f"))
+    return node
+
+
+def _canonical_aliases(tree):
+    """Rename table aliases to t1, t2... in order of appearance; skipped when an alias is reused."""
+    aliases = [t.alias for t in tree.find_all(exp.Table) if t.alias]
+    if not aliases or len(set(a.lower() for a in aliases)) != len(aliases):
+        return tree
+    mapping = {alias.lower(): f"t{i}" for i, alias in enumerate(aliases, 1)}
+    for table in tree.find_all(exp.Table):
+        if table.alias:
+            table.set("alias", exp.TableAlias(this=exp.to_identifier(mapping[table.alias.lower()])))
+    for column in tree.find_all(exp.Column):
+        if column.table and column.table.lower() in mapping:
+            column.set("table", exp.to_identifier(mapping[column.table.lower()]))
+    return tree
+
+
+# Parsing costs milliseconds; the same SQL text is usually looked up repeatedly
+@lru_cache(maxsize=1024)
+def normalize_sql(sql: str) -> str:
+    """
+    Canonical SQL text used as the cache key: comments and formatting removed,
+    unquoted identifiers lower-cased, table aliases renamed, numeric literals
+    normalized ('1.50' == '1.5'). Falls back to whitespace folding if the SQL
+    does not parse.
+    """
+    try:
+        tree = sqlglot.parse_one(sql, read="postgres")
+        tree = tree.transform(_strip_comments).transform(_canonical_number)
+        return _canonical_aliases(tree).sql(dialect="postgres", normalize=True)
+    except SqlglotError:
+        sql = re.sub(r"--[^\n]*|/\*.*?\*/", " ", sql, flags=re.S)
+        return re.sub(r"\s+", " ", sql).strip().rstrip(";").strip()
+
+
+@lru_cache(maxsize=1024)
+def referenced_tables(sql: str) -> frozenset:
+    """Lower-cased names of the tables a query reads (CTE names excluded); None if it does not parse."""
+    try:
+        tree = sqlglot.parse_one(sql, read="postgres")
+    except SqlglotError:
+        return None
+    ctes = {cte.alias.lower() for cte in tree.find_all(exp.CTE)}
+    return frozenset(t.name.lower() for t in tree.find_all(exp.Table) if t.name and t.name.lower() not in ctes)
+
+
+def database_versions(engine=None) -> dict:
+    """{table: version} from RESULT_CACHE_VERSION_SQL or pg_stat_user_tables; {} when unavailable."""
+    engine = engine if engine is not None else db.engine
+    query = RESULT_CACHE_VERSION_SQL or (PG_VERSION_SQL if engine.dialect.name == "postgresql" else "")
+    if not query:
+        return {}
+    with db.read_only(engine, op="data_versions") as conn:
+        return {str(name).lower(): str(version) for name, version in conn.execute(text(query))}
+
+
+def _to_arrow(frame):
+    """DataFrame -> (Arrow table with dictionary-encoded repetitive text, original schema)."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    schema = table.schema
+    for i, field in enumerate(schema):
+        if pa.types.is_string(field.type) and table.num_rows:
+            column = table.column(i)
+            if pc.count_distinct(column).as_py() <= table.num_rows // 2:
+                table = table.set_column(i, field.name, pc.dictionary_encode(column))
+    return table, schema
+
+
+class _Entry:
+    def __init__(self, table, schema, versions, created_at):
+        self.table = table
+        self.schema = schema
+        self.versions = versions
+        self.created_at = created_at
+        self.nbytes = table.nbytes
+
+
+class ResultCache:
+    """
+    LRU cache of query results. lookup() returns (DataFrame, None) on a hit, or
+    (None, pending) on a miss; pass `pending` and the result to store() once the
+    query succeeds. `versions` is a callable returning {table: data version}.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024, max_rows=RESULT_CACHE_MAX_ROWS,
+                 check_seconds=RESULT_CACHE_CHECK_SECONDS, ttl=RESULT_CACHE_TTL, versions=database_versions):
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.check_seconds = check_seconds
+        self.ttl = ttl
+        self.versions = versions
+        self._entries = OrderedDict()   # normalized sql -> _Entry
+        self._known = {}                # table -> version last seen
+        self._checked_at = 0.0
+        self._bumps = {}                # table -> manual invalidation counter
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _current_versions(self, tables, force=False):
+        """Data versions of `tables`, re-read from the database at most every check_seconds."""
+        now = time.time()
+        if force or now - self._checked_at > self.check_seconds:
+            try:
+                latest = self.versions()
+            except Exception as e:
+                print(f"⚠️ Could not read table versions, relying on the cache TTL: {e}")
+                latest = self._known
+            with self._lock:
+                changed = {t for t, v in latest.items() if self._known.get(t, v) != v}
+                self._known, self._checked_at = latest, now
+                if changed:
+                    self._drop_tables(changed)
+        with self._lock:
+            return {t: (self._known.get(t), self._bumps.get(t, 0)) for t in tables}
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.nbytes
+
+    def _drop_tables(self, tables):
+        for key, entry in list(self._entries.items()):
+            if tables & set(entry.versions):
+                self._drop(key)
+
+    def lookup(self, sql):
+        if not self.enabled:
+            return None, None
+        key = normalize_sql(sql)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            if time.time() - entry.created_at <= self.ttl and self._current_versions(entry.versions) == entry.versions:
+                with self._lock:
+                    if key in self._entries:
+                        self._entries.move_to_end(key)
+                    self.hits += 1
+                frame = entry.table.cast(entry.schema).to_pandas()
+                frame.attrs["cached"] = True
+                return frame, None
+            with self._lock:
+                self._drop(key)
+        tables = referenced_tables(sql)
+        with self._lock:
+            self.misses += 1
+        if tables is None:
+            return None, None
+        # Versions are taken before the query runs, so a write during execution invalidates it
+        return None, (key, self._current_versions(tables, force=True))
+
+    def store(self, pending, frame):
+        """Cache `frame` for a lookup() miss; results over max_rows or the budget are skipped."""
+        if pending is None or frame is None or len(frame) > self.max_rows:
+            return
+        key, versions = pending
+        table, schema = _to_arrow(frame)
+        if table.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = _Entry(table, schema, versions, time.time())
+            self.bytes += table.nbytes
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, tables=None):
+        """
+        Refresh hook: call after loading data. Drops entries reading any of
+        `tables`, or every entry when called without arguments.
+        """
+        with self._lock:
+            if tables is None:
+                self._entries.clear()
+                self.bytes = 0
+                return
+            tables = {t.lower() for t in tables}
+            for t in tables:
+                self._bumps[t] = self._bumps.get(t, 0) + 1
+            self._drop_tables(tables)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries),
+                "megabytes": round(self.bytes / 1024 / 1024, 2)}
+
+
+result_cache = ResultCache()
@@ -4,22 +4,34 @@ import re
 from dotenv import load_dotenv
 import streamlit as st
 
-from groq import Groq
-from langchain_groq import ChatGroq
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnableMap
+from llm_cache import memoized
+from startup import lazy
+from fast_router import ROUTES, ROUTER_CONFIDENCE_THRESHOLD, fast_router
 
 load_dotenv()
-api_key=st.secrets["GROQ_API_KEY"]
-##os.environ["GROQ_API_KEY"] = os.getenv("GROQ_API_KEY")
 
-model = ChatGroq(
-    model="openai/gpt-oss-20b",
-    api_key=api_key,
-    temperature=0,
-    max_tokens=None
-)
+# "hybrid": local router, LLM below the confidence threshold; "local": never call the LLM; "llm": always
+ROUTER_MODE = os.getenv("ROUTER_MODE", "hybrid")
+
+
+def _build_model():
+    # Imported here so the Groq client stack loads on first use, not at import
+    from langchain_groq import ChatGroq
+    api_key=st.secrets["GROQ_API_KEY"]
+    ##os.environ["GROQ_API_KEY"] = os.getenv("GROQ_API_KEY")
+
+    return ChatGroq(
+        model="openai/gpt-oss-20b",
+        api_key=api_key,
+        temperature=0,
+        max_tokens=None
+    )
+
+
+model = lazy("groq_model", _build_model)
 
 template = ChatPromptTemplate.from_messages([
     ("system", """
@@ -49,17 +61,15 @@ User question:
 chain = (
     RunnableMap({"question": lambda x: x["question"]})
     | template
-    | model
+    | memoized(model, "chain_router")
     | StrOutputParser()
-)
+).with_config(run_name="chain_router")
 
-def agent_2(q: str) -> list:
+def _parse_routes(raw: str) -> list:
     """
-    Determine which agents can answer the question.
-    Returns a Python list of agent names, e.g., ["dim"].
-    Strips any <think> blocks from LLM output.
+    Strip any <think> blocks from the router output and parse the JSON list of agents.
     """
-    raw = chain.invoke({"question": q}).replace('```', '').strip()
+    raw = raw.replace('```', '').strip()
 
     # Remove <think> blocks
     cleaned = re.sub(r"<think>.*?</think>", "", raw, flags=re.DOTALL).strip()
@@ -73,3 +83,56 @@ def agent_2(q: str) -> list:
         agents = []
 
     return agents
+
+
+def _local_routes(q: str):
+    """
+    Local routes and whether they are confident enough to skip the LLM router.
+    """
+    routes, confidence = fast_router.route(q)
+    if ROUTER_MODE == "local" or (ROUTER_MODE == "hybrid" and confidence >= ROUTER_CONFIDENCE_THRESHOLD):
+        print(f"⚡ Routed locally (confidence {confidence:.2f})")
+        return routes, True
+    return routes, False
+
+
+def _llm_routes(q: str, agents: list, fallback: list) -> list:
+    """
+    Keep the known agent names from the LLM router output and log them as a training
+    example; fall back to the local routes when nothing usable came back.
+    """
+    agents = [r for r in ROUTES if r in agents]
+    if not agents:
+        print("⚠️ Router output unusable, using local routes " + str(fallback))
+        return fallback
+    fast_router.record(q, agents)
+    return agents
+
+
+def agent_2(q: str) -> list:
+    """
+    Determine which agents can answer the question.
+    Returns a non-empty Python list of agent names, e.g., ["dim"].
+    """
+    routes, confident = _local_routes(q)
+    if confident:
+        return routes
+    try:
+        raw = chain.invoke({"question": q})
+    except Exception as e:
+        print(f"⚠️ Router LLM failed ({e}), using local routes")
+        return routes
+    return _llm_routes(q, _parse_routes(raw), routes)
+
+
+async def aagent_2(q: str) -> list:
+    """Async variant of agent_2."""
+    routes, confident = _local_routes(q)
+    if confident:
+        return routes
+    try:
+        raw = await chain.ainvoke({"question": q})
+    except Exception as e:
+        print(f"⚠️ Router LLM failed ({e}), using local routes")
+        return routes
+    return _llm_routes(q, _parse_routes(raw), routes)
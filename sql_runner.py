@@ -0,0 +1,208 @@
+import io
+import os
+import tempfile
+from contextlib import ExitStack
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from db import aread_only, read_only  # shared pooled engines
+from result_cache import result_cache
+from workload import captured
+
+# Rows fetched per round trip from the server-side cursor
+SQL_FETCH_CHUNK_ROWS = int(os.getenv("SQL_FETCH_CHUNK_ROWS", "5000"))
+# Rows kept in memory for on-screen display
+SQL_PREVIEW_ROWS = int(os.getenv("SQL_PREVIEW_ROWS", "1000"))
+# Hard cap on rows streamed to the download file (0 = no cap)
+SQL_MAX_ROWS = int(os.getenv("SQL_MAX_ROWS", "1000000"))
+
+@captured("run_sql")
+def run_sql(query: str, use_cache=True):
+    """
+    Run SQL query safely with proper error handling, in a read-only transaction
+    on a pooled connection (rolled back and returned to the pool on errors).
+    Repeated queries are answered from result_cache while their tables are unchanged.
+    Returns either a DataFrame or an error message.
+    """
+    try:
+        cached, pending = result_cache.lookup(query) if use_cache else (None, None)
+        if cached is not None:
+            return cached
+        with read_only() as conn:
+            df = pd.read_sql(text(query), conn)
+        result_cache.store(pending, df)
+        return df
+    except SQLAlchemyError as e:
+        return f"❌ SQLAlchemy error: {str(e.__cause__ or e)}"
+    except Exception as e:
+        return f"❌ Unexpected error: {str(e)}"
+
+
+@captured("arun_sql")
+async def arun_sql(query: str, async_engine=None, use_cache=True):
+    """
+    Async variant of run_sql on an AsyncEngine (asyncpg by default).
+    The transaction is rolled back automatically if the query fails.
+    """
+    try:
+        # The version check is a short catalog query, run at most every RESULT_CACHE_CHECK_SECONDS
+        cached, pending = result_cache.lookup(query) if use_cache else (None, None)
+        if cached is not None:
+            return cached
+        async with aread_only(async_engine) as conn:
+            df = await conn.run_sync(lambda sync_conn: pd.read_sql(text(query), sync_conn))
+        result_cache.store(pending, df)
+        return df
+    except SQLAlchemyError as e:
+        return f"❌ SQLAlchemy error: {str(e.__cause__ or e)}"
+    except Exception as e:
+        return f"❌ Unexpected error: {str(e)}"
+
+
+class StreamedResult:
+    """
+    Outcome of execute_streaming: an in-memory preview of the first rows plus
+    the full result spooled to a CSV or Parquet file on disk.
+    """
+
+    def __init__(self, preview, path, fmt, total_rows, truncated, cached=False):
+        self.preview = preview
+        self.path = path
+        self.fmt = fmt
+        self.total_rows = total_rows
+        self.truncated = truncated
+        self.cached = cached
+
+    def read_bytes(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    @property
+    def size(self):
+        """Bytes of the spooled file."""
+        return os.path.getsize(self.path) if self.path and os.path.exists(self.path) else 0
+
+    def preview_bytes(self):
+        """The preview rows in the spool's format (download fallback for large results)."""
+        if self.fmt == "parquet":
+            buffer = io.BytesIO()
+            self.preview.to_parquet(buffer, index=False)
+            return buffer.getvalue()
+        return self.preview.to_csv(index=False).encode("utf-8")
+
+    def cleanup(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _Spool:
+    """Appends DataFrame chunks to a CSV or Parquet file."""
+
+    def __init__(self, path, fmt):
+        self.path = path
+        self.fmt = fmt
+        self._writer = None
+        self._schema = None
+        self._started = False
+
+    def write(self, chunk):
+        if self.fmt == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.Table.from_pandas(chunk, schema=self._schema, preserve_index=False)
+            if self._writer is None:
+                self._schema = table.schema
+                self._writer = pq.ParquetWriter(self.path, self._schema)
+            self._writer.write_table(table)
+        else:
+            chunk.to_csv(self.path, mode="a" if self._started else "w", header=not self._started, index=False)
+        self._started = True
+
+    def close(self, columns):
+        if self._writer is not None:
+            self._writer.close()
+        elif not self._started:
+            # Empty result: still produce a valid file with the column header
+            self.write(pd.DataFrame(columns=columns))
+            if self._writer is not None:
+                self._writer.close()
+
+
+def _cached_chunks(df, chunk_rows):
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield df.iloc[start:start + chunk_rows]
+
+
+@captured("execute_streaming")
+def execute_streaming(query: str, fmt="csv", preview_rows=SQL_PREVIEW_ROWS, max_rows=SQL_MAX_ROWS,
+                      chunk_rows=SQL_FETCH_CHUNK_ROWS, on_chunk=None, spool_dir=None, use_cache=True):
+    """
+    Run a query through a server-side cursor, fetching `chunk_rows` at a time.
+    Only the first `preview_rows` stay in memory; every chunk is appended to a
+    spool file so memory stays flat regardless of result size. `on_chunk(rows_so_far,
+    preview)` is called after each chunk for progressive display. Stops after
+    `max_rows` rows. Results up to RESULT_CACHE_MAX_ROWS are kept in result_cache
+    and later spooled from there without touching the database.
+    Returns a StreamedResult, or an error message string like run_sql.
+    """
+    suffix = ".parquet" if fmt == "parquet" else ".csv"
+    fd, path = tempfile.mkstemp(prefix="query_results_", suffix=suffix, dir=spool_dir)
+    os.close(fd)
+    spool = _Spool(path, fmt)
+    preview = None
+    total = 0
+    truncated = False
+    columns = []
+
+    try:
+        cached, pending = result_cache.lookup(query) if use_cache else (None, None)
+        # Chunks collected for the result cache while the result is small enough
+        kept = [] if pending is not None else None
+        with ExitStack() as stack:
+            if cached is not None:
+                chunks = _cached_chunks(cached, chunk_rows)
+            else:
+                conn = stack.enter_context(read_only(stream_results=True, max_row_buffer=chunk_rows))
+                chunks = pd.read_sql(text(query), conn, chunksize=chunk_rows)
+            for chunk in chunks:
+                columns = list(chunk.columns)
+                if kept is not None and total + len(chunk) <= result_cache.max_rows:
+                    kept.append(chunk)
+                else:
+                    kept = None
+                if max_rows and total + len(chunk) > max_rows:
+                    chunk = chunk.iloc[: max_rows - total]
+                    truncated = True
+                total += len(chunk)
+                spool.write(chunk)
+
+                if preview is None:
+                    preview = chunk.head(preview_rows).copy()
+                elif len(preview) < preview_rows:
+                    preview = pd.concat([preview, chunk.head(preview_rows - len(preview))])
+                if on_chunk:
+                    on_chunk(total, preview)
+                if truncated:
+                    break
+        spool.close(columns)
+        if preview is None:
+            preview = pd.DataFrame(columns=columns)
+        if kept is not None and not truncated:
+            result_cache.store(pending, pd.concat(kept, ignore_index=True) if kept else preview)
+        return StreamedResult(preview, path, fmt, total, truncated, cached=cached is not None)
+    except SQLAlchemyError as e:
+        _discard(spool, columns)
+        return f"❌ SQLAlchemy error: {str(e.__cause__ or e)}"
+    except Exception as e:
+        _discard(spool, columns)
+        return f"❌ Unexpected error: {str(e)}"
+
+
+def _discard(spool, columns):
+    try:
+        spool.close(columns)
+    except Exception:
+        pass  # the spool is removed anyway
+    if os.path.exists(spool.path):
+        os.remove(spool.path)
@@ -0,0 +1,264 @@
+"""
+Verified SQL templates: reuse the SQL of a confirmed question for later
+questions of the same shape with different entity values or dates.
+
+When a question's SQL has run successfully, the entity values it mentions (from
+the entity dictionary) and its months and years are looked up among the SQL's
+literals, and each one found becomes a named slot ({{0:brand_id}}, {{1:ym}},
+...). Mentioned values that do not appear in the SQL stay pinned to the
+template. A later question with the same shape (entities, dates and every
+remaining word except filler, so "by month" and "by year" or "profit center"
+and "cost center" never share a template), the same pinned values and a
+value for every slot column gets the
+stored SQL with its own values filled in, so pipeline.sql_template can skip
+the router, agent, filter, generation and validation calls.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from sqlglot.dialects.dialect import Dialect
+from sqlglot.tokens import TokenType
+
+from kb_store import kb
+from question_cache import _canonical_dates
+
+
+# "0" disables template matching and learning
+SQL_TEMPLATES = os.getenv("SQL_TEMPLATES", "1") != "0"
+# Persistent store for verified templates ("" keeps them in memory only)
+SQL_TEMPLATE_PATH = os.getenv("SQL_TEMPLATE_PATH", "sql_templates.sqlite")
+SQL_TEMPLATE_MAX_ENTRIES = int(os.getenv("SQL_TEMPLATE_MAX_ENTRIES", "2000"))
+# Dialect used to find the literals of the generated SQL
+SQL_TEMPLATE_DIALECT = os.getenv("SQL_TEMPLATE_DIALECT", "postgres")
+
+# Words left out of the shape; grain ("month", "year"), conjunctions and entity nouns are kept
+FILLER_WORDS = {
+    "a", "an", "the", "me", "please", "show", "give", "get", "list", "tell", "find", "what", "is", "are",
+    "was", "were", "can", "you", "i", "want", "for", "of", "in", "on", "at", "during",
+}
+SLOT_RE = re.compile(r"\{\{(\d+):(\w+)\}\}")
+YEAR_RE = re.compile(r"(19|20)\d{2}")
+SENTINEL_RE = re.compile(r"zzslot(\d+)zz")
+# Graph state reused from the run the template was learned from
+BASE_KEYS = ("router_out", "dim_out", "sales_out", "expense_out", "filtered_col")
+
+
+def _renderings(slot):
+    """{name: text} forms in which a slot value can appear in the SQL; entities have one per column."""
+    if slot["kind"] == "month":
+        year, month = slot["value"].split("-")
+        return {"ym": f"{year}-{month}", "ymc": f"{year}{month}", "yms": f"{year}/{month}"}
+    if slot["kind"] == "year":
+        return {"y": slot["value"]}
+    values = {}
+    for _, column, value in sorted(slot["locations"], key=lambda loc: (loc[1], loc[0])):
+        values.setdefault(column, value)
+    return values
+
+
+def question_shape(question, mentions):
+    """
+    (skeleton, slots) of a question, given entity_linker mentions. Entity values
+    become <entity> tokens, months <month> and years <year>; slots lists their
+    values (entities first, then dates, each in order of appearance).
+    """
+    slots, parts, last = [], [], 0
+    for start, end, locations in mentions:
+        parts += [question[last:start], f" zzslot{len(slots)}zz "]
+        slots.append({"kind": "entity", "value": question[start:end], "locations": locations})
+        last = end
+    parts.append(question[last:])
+
+    out = []
+    for tok in re.findall(r"\d{4}-\d{2}|[a-z0-9_]+", _canonical_dates("".join(parts).lower())):
+        sentinel = SENTINEL_RE.fullmatch(tok)
+        if sentinel:
+            out.append("<entity>")
+        elif re.fullmatch(r"\d{4}-\d{2}", tok):
+            slots.append({"kind": "month", "value": tok})
+            out.append("<month>")
+        elif YEAR_RE.fullmatch(tok):
+            slots.append({"kind": "year", "value": tok})
+            out.append("<year>")
+        elif tok not in FILLER_WORDS:
+            out.append(tok)
+    return " ".join(out), slots
+
+
+def lift(sql, slots, dialect=SQL_TEMPLATE_DIALECT):
+    """
+    (template, lifted slot indexes): the SQL with every slot value found in its
+    string and number literals replaced by a placeholder. Returns (None, set())
+    when two slots share a rendering, since they could not be told apart.
+    """
+    forms = {}
+    for i, slot in enumerate(slots):
+        for name, text in _renderings(slot).items():
+            if text.lower() in forms and forms[text.lower()][0] != i:
+                return None, set()
+            forms.setdefault(text.lower(), (i, name))
+    if not forms:
+        return None, set()
+    alternatives = "|".join(re.escape(t) for t in sorted(forms, key=len, reverse=True))
+    pattern = re.compile(rf"(?<![A-Za-z0-9])({alternatives})(?![A-Za-z0-9])", re.I)
+    lifted = set()
+
+    def placeholder(m):
+        i, name = forms[m.group().lower()]
+        lifted.add(i)
+        return f"{{{{{i}:{name}}}}}"
+
+    pieces, last = [], 0
+    for tok in Dialect.get_or_raise(dialect).tokenize(sql):
+        if tok.token_type == TokenType.STRING:
+            new = pattern.sub(placeholder, tok.text)
+            raw = "'" + new.replace("'", "''") + "'"
+        elif tok.token_type == TokenType.NUMBER and pattern.fullmatch(tok.text):
+            new = raw = pattern.sub(placeholder, tok.text)
+        else:
+            continue
+        if new != tok.text:
+            pieces += [sql[last:tok.start], raw]
+            last = tok.end + 1
+    pieces.append(sql[last:])
+    return "".join(pieces), lifted
+
+
+def fill(template, slots):
+    """SQL for a template with the slot values of a new question (see fits)."""
+    return SLOT_RE.sub(lambda m: _renderings(slots[int(m.group(1))])[m.group(2)].replace("'", "''"), template)
+
+
+def fits(entry, slots):
+    """True if a question's slots match the entry's pinned values and fill all of its placeholders."""
+    placeholders = [(int(i), name) for i, name in SLOT_RE.findall(entry["template"])]
+    if len(slots) <= max([int(i) for i in entry["pinned"]] + [i for i, _ in placeholders]):
+        return False
+    if any(slots[int(i)]["value"].lower() != v for i, v in entry["pinned"].items()):
+        return False
+    return all(name in _renderings(slots[i]) for i, name in placeholders)
+
+
+class TemplateStore:
+    """
+    Verified templates grouped by question skeleton. All entries are kept in
+    memory, written through to an optional SQLite file, and dropped when the KB
+    version changes.
+    """
+
+    def __init__(self, path=SQL_TEMPLATE_PATH, max_entries=SQL_TEMPLATE_MAX_ENTRIES, kb_version=None,
+                 enabled=SQL_TEMPLATES):
+        self.path = path
+        self.max_entries = max_entries
+        self._fixed_version = kb_version
+        self.kb_version = kb_version or kb.version
+        self.enabled = enabled
+        self._entries = {}  # key -> entry dict
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if self.path:
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS sql_templates ("
+                    "key TEXT PRIMARY KEY, kb_version TEXT, skeleton TEXT, pinned TEXT, question TEXT, "
+                    "template TEXT, state TEXT, created_at REAL, last_access REAL)"
+                )
+                # SQL built against an older KB may use tables or columns that changed
+                conn.execute("DELETE FROM sql_templates WHERE kb_version != ?", (self.kb_version,))
+                for key, skeleton, pinned, question, template, state, last_access in conn.execute(
+                    "SELECT key, skeleton, pinned, question, template, state, last_access FROM sql_templates"
+                ):
+                    self._entries[key] = {"key": key, "skeleton": skeleton, "pinned": json.loads(pinned),
+                                          "question": question, "template": template,
+                                          "state": json.loads(state), "last_access": last_access}
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _check_version(self):
+        """Drop every template when the KB version changed since they were stored."""
+        version = self._fixed_version or kb.version
+        if version == self.kb_version:
+            return
+        with self._lock:
+            self._entries.clear()
+            self.kb_version = version
+        if self.path:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM sql_templates WHERE kb_version != ?", (version,))
+
+    def learn(self, question, state, sql, mentions):
+        """
+        Store the confirmed `sql` of `question` as a template; returns its key, or
+        None when nothing in the question could be lifted into a slot.
+        """
+        if not self.enabled or state.get("sql_template"):
+            return None
+        self._check_version()
+        skeleton, slots = question_shape(question, mentions)
+        if not slots:
+            return None
+        template, lifted = lift(sql, slots)
+        if not lifted:
+            return None
+        pinned = {str(i): s["value"].lower() for i, s in enumerate(slots) if i not in lifted}
+        key = skeleton + "\x00" + json.dumps(pinned, sort_keys=True)
+        base = json.loads(json.dumps({k: state[k] for k in BASE_KEYS if k in state}, default=str))
+        now = time.time()
+        with self._lock:
+            self._entries[key] = {"key": key, "skeleton": skeleton, "pinned": pinned, "question": question,
+                                  "template": template, "state": base, "last_access": now}
+            evicted = sorted(self._entries, key=lambda k: self._entries[k]["last_access"])[:-self.max_entries]
+            for k in evicted:
+                del self._entries[k]
+        if self.path:
+            with self._connect() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sql_templates VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, self.kb_version, skeleton, json.dumps(pinned), question, template, json.dumps(base),
+                     now, now),
+                )
+                conn.executemany("DELETE FROM sql_templates WHERE key = ?", [(k,) for k in evicted])
+        print(f"📐 Stored SQL template for '{skeleton}' ({len(lifted)} slot(s))")
+        return key
+
+    def match(self, question, mentions):
+        """Graph state answering `question` from a stored template, or None."""
+        if not self.enabled:
+            return None
+        self._check_version()
+        skeleton, slots = question_shape(question, mentions)
+        with self._lock:
+            entry = next((e for e in self._entries.values() if e["skeleton"] == skeleton and fits(e, slots)), None)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry["last_access"] = time.time()
+            self.hits += 1
+        sql = fill(entry["template"], slots)
+        filters = []
+        for slot in slots:
+            # One filter per column, as entity_linker.link reports them
+            first = {}
+            for table, column, value in slot.get("locations", []):
+                first.setdefault(column, ["table name:" + table, "column_name:" + column, "filter_value:" + value])
+            filters.extend(first.values())
+        return {**entry["state"], "filter_extractor": ["no"], "fuzz_match": filters, "sql_query": sql,
+                "validation_issues": [], "final_query": sql, "sql_template": entry["key"]}
+
+    def forget(self, key):
+        """Drop a template whose filled SQL failed."""
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.path:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM sql_templates WHERE key = ?", (key,))
+
+    def stats(self):
+        self._check_version()
+        return {"hits": self.hits, "misses": self.misses, "templates": len(self._entries)}
@@ -0,0 +1,244 @@
+import re
+import sqlglot
+from sqlglot import exp
+from sqlglot.errors import ParseError
+from sqlglot.optimizer.scope import Scope, traverse_scope
+
+
+# Words the LLM sometimes picks as aliases ("sales_data or") that break the query
+RESERVED_ALIASES = {
+    "or", "and", "as", "not", "in", "is", "by", "to", "do", "end", "all", "any",
+    "case", "select", "from", "table", "user", "desc", "asc", "null", "true", "false",
+}
+
+
+def extract_sql_from_output(output: str) -> str:
+    """
+    Extracts only the SQL query from an LLM response.
+    Handles cases with ```sql fences or extra text.
+    """
+    if not output:
+        return ""
+
+    # Look for SQL inside ```sql ... ```
+    match = re.search(r"```sql\s+(.*?)```", output, re.DOTALL | re.IGNORECASE)
+    if match:
+        return match.group(1).strip()
+
+    # Look for SQL inside generic ``` ... ```
+    match = re.search(r"```(.*?)```", output, re.DOTALL)
+    if match:
+        return match.group(1).strip()
+
+    # If no fences, return the raw output (assume it's already SQL)
+    return output.strip()
+
+
+def build_catalog(kb: dict) -> dict:
+    """
+    Build {table_name: set(column_names)} (lower-cased) from the knowledge base.
+    """
+    catalog = {}
+    for table, entry in kb.items():
+        columns = entry.get("columns", {}) if isinstance(entry, dict) else {}
+        if isinstance(columns, dict):
+            names = columns.keys()
+        else:
+            names = [c[0] if isinstance(c, (list, tuple)) else c for c in columns]
+        catalog[table.lower()] = {str(n).lower() for n in names}
+    return catalog
+
+
+def _alias_identifier(node):
+    alias = node.args.get("alias")
+    return alias.this if isinstance(alias, exp.TableAlias) else alias
+
+
+def _check_reserved_aliases(tree):
+    """Unquoted table and column aliases that are reserved words."""
+    issues = []
+    for node in tree.find_all(exp.Table, exp.Subquery, exp.Alias):
+        ident = _alias_identifier(node)
+        if not isinstance(ident, exp.Identifier) or ident.quoted or ident.name.lower() not in RESERVED_ALIASES:
+            continue
+        if isinstance(node, exp.Table):
+            issues.append(f"Table {node.name} uses reserved word '{ident.name}' as alias")
+        elif isinstance(node, exp.Subquery):
+            issues.append(f"Subquery uses reserved word '{ident.name}' as alias")
+        else:
+            issues.append(f"Reserved word '{ident.name}' used as alias")
+    return issues
+
+
+def _reserved_alias_hint(sql):
+    """For SQL that does not parse: a reserved word right after a FROM/JOIN table ("sales_data or")."""
+    pattern = r"\b(?:FROM|JOIN)\s+([A-Za-z_][\w.]*)\s+(?:AS\s+)?(\w+)\b"
+    return [f"Table {m.group(1)} uses reserved word '{m.group(2)}' as alias"
+            for m in re.finditer(pattern, sql, re.IGNORECASE) if m.group(2).lower() in RESERVED_ALIASES]
+
+
+def _own_aggregates(node, select):
+    """Aggregate calls under `node` that belong to `select` (not windowed, not in a subquery)."""
+    for agg in node.find_all(exp.AggFunc):
+        if agg.find_ancestor(exp.Select) is not select:
+            continue
+        if isinstance(agg.find_ancestor(exp.Window, exp.Select), exp.Window):
+            continue
+        yield agg
+
+
+def _check_columns(scope: Scope, catalog, all_aliases):
+    issues = []
+    sources = scope.sources
+    catalog_sources = {
+        alias: src.name.lower()
+        for alias, src in sources.items()
+        if isinstance(src, exp.Table) and src.name.lower() in catalog
+    }
+    only_catalog = len(catalog_sources) == len(sources)
+    select_aliases = set()
+    if isinstance(scope.expression, exp.Select):
+        select_aliases = {p.alias.lower() for p in scope.expression.expressions if p.alias}
+
+    for col in scope.columns:
+        name = col.name.lower()
+        if name == "*":
+            continue
+        if col.table:
+            if col.table in catalog_sources:
+                table = catalog_sources[col.table]
+                if name not in catalog[table]:
+                    issues.append(f"Column {col.table}.{col.name} does not exist in table {table}")
+            elif col.table not in sources and col.table not in all_aliases:
+                issues.append(f"Column {col.sql()} references unknown table or alias '{col.table}'")
+        elif only_catalog and sources:
+            known = set().union(*(catalog[t] for t in catalog_sources.values()))
+            if name not in known and name not in select_aliases:
+                issues.append(f"Column {col.name} does not exist in {sorted(set(catalog_sources.values()))}")
+    return issues
+
+
+def _check_join_keys(scope: Scope, catalog):
+    issues = []
+    select = scope.expression
+    if not isinstance(select, exp.Select):
+        return issues
+    catalog_sources = {
+        alias: src.name.lower()
+        for alias, src in scope.sources.items()
+        if isinstance(src, exp.Table) and src.name.lower() in catalog
+    }
+    for join in select.args.get("joins") or []:
+        on = join.args.get("on")
+        if on is None:
+            if not join.args.get("using") and (join.args.get("kind") or "").upper() != "CROSS":
+                issues.append(f"Join to {join.this.sql()} has no join condition (cross join)")
+            continue
+        for eq in on.find_all(exp.EQ):
+            for side in (eq.left, eq.right):
+                if isinstance(side, exp.Column) and side.table in catalog_sources:
+                    table = catalog_sources[side.table]
+                    if side.name.lower() not in catalog[table]:
+                        issues.append(f"Join key {side.sql()} is not a column of {table}")
+    return issues
+
+
+def _check_grouping(select: exp.Select):
+    issues = []
+    where = select.args.get("where")
+    if where is not None and any(True for _ in _own_aggregates(where, select)):
+        issues.append("Aggregate function used in WHERE; move it to HAVING or a subquery")
+
+    group = select.args.get("group")
+    group_exprs = list(group.expressions) if group is not None else []
+    if group is not None and any(True for _ in _own_aggregates(group, select)):
+        issues.append("Aggregate function used in GROUP BY")
+
+    for agg in _own_aggregates(select, select):
+        outer = agg.find_ancestor(exp.AggFunc)
+        if outer is not None and outer.find_ancestor(exp.Select) is select:
+            issues.append(f"Nested aggregate {outer.sql()}; use a subquery")
+
+    projections = select.expressions
+    has_agg = any(any(True for _ in _own_aggregates(p, select)) for p in projections)
+    if not has_agg and group is None:
+        return issues
+
+    grouped_sql = set()
+    grouped_cols = set()
+    for g in group_exprs:
+        if isinstance(g, exp.Literal) and g.is_int:
+            idx = int(g.this) - 1
+            if 0 <= idx < len(projections):
+                g = projections[idx].unalias()
+        grouped_sql.add(g.sql().lower())
+        for c in g.find_all(exp.Column):
+            grouped_cols.add(c.name.lower())
+
+    def is_grouped(node):
+        if node.sql().lower() in grouped_sql:
+            return True
+        if any(True for _ in _own_aggregates(node, select)):
+            # Columns in an aggregate's FILTER (WHERE ...) or WITHIN GROUP (ORDER BY ...) are aggregated too
+            cols = [c for c in node.find_all(exp.Column)
+                    if not c.find_ancestor(exp.AggFunc, exp.Filter, exp.WithinGroup)
+                    and c.find_ancestor(exp.Select) is select]
+        else:
+            cols = [c for c in node.find_all(exp.Column) if c.find_ancestor(exp.Select) is select]
+        return all(c.name.lower() in grouped_cols for c in cols)
+
+    for p in projections:
+        if isinstance(p.unalias(), exp.Star):
+            issues.append("SELECT * combined with aggregation or GROUP BY")
+            continue
+        if p.alias and p.alias.lower() in grouped_cols:
+            continue
+        if not is_grouped(p.unalias()):
+            issues.append(f"Column {p.sql()} must appear in GROUP BY or be aggregated")
+
+    having = select.args.get("having")
+    if having is not None and not is_grouped(having.this):
+        issues.append("HAVING references columns that are neither grouped nor aggregated")
+    return issues
+
+
+def validate_sql(sql: str, catalog: dict) -> list:
+    """
+    Run deterministic checks on generated SQL against the KB catalog.
+    Returns a list of human-readable issues; an empty list means the query passed.
+    """
+    if not sql or not sql.strip():
+        return ["No SQL query found"]
+
+    try:
+        statements = [s for s in sqlglot.parse(sql, read="postgres") if s is not None]
+    except ParseError as e:
+        return _reserved_alias_hint(sql) + [f"SQL parse error: {e}"]
+    if len(statements) != 1:
+        return [f"Expected exactly one SQL statement, found {len(statements)}"]
+
+    tree = statements[0]
+    if not isinstance(tree, exp.Query):
+        return ["Statement is not a SELECT query"]
+    issues = _check_reserved_aliases(tree)
+    cte_names = {cte.alias.lower() for cte in tree.find_all(exp.CTE)}
+    for table in tree.find_all(exp.Table):
+        name = table.name.lower()
+        if name and name not in catalog and name not in cte_names:
+            issues.append(f"Table {table.name} does not exist in the knowledge base")
+
+    try:
+        scopes = traverse_scope(tree)
+    except Exception as e:
+        return issues + [f"Could not resolve query scopes: {e}"]
+    all_aliases = set()
+    for scope in scopes:
+        all_aliases.update(scope.sources)
+    for scope in scopes:
+        issues.extend(_check_columns(scope, catalog, all_aliases))
+        issues.extend(_check_join_keys(scope, catalog))
+        if isinstance(scope.expression, exp.Select):
+            issues.extend(_check_grouping(scope.expression))
+
+    # Preserve order, drop duplicates reported by several scopes
+    return list(dict.fromkeys(issues))
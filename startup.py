@@ -0,0 +1,148 @@
+"""
+Lazy construction of expensive module-level objects (LLM clients, engines,
+compiled graphs) and a small cold-start profiler.
+
+    python startup.py              # slowest imports behind `import pipeline`
+    python startup.py --warm       # ... plus the time to build each lazy object
+
+Set LAZY_INIT=0 to build everything at import time as before.
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+
+LAZY_INIT = os.getenv("LAZY_INIT", "1") != "0"
+
+_registry = {}    # name -> Lazy
+_init_times = {}  # name -> seconds spent building
+
+
+class Lazy:
+    """
+    Stand-in for an object built by `factory` on first use. Attribute access,
+    calls, indexing and membership tests are forwarded to the built object.
+    """
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._value = None
+        self._built = False
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if not self._built:
+            with self._lock:
+                if not self._built:
+                    start = time.perf_counter()
+                    self._value = self._factory()
+                    _init_times[self._name] = time.perf_counter() - start
+                    self._built = True
+        return self._value
+
+    @property
+    def built(self):
+        return self._built
+
+    def __getattr__(self, attr):
+        return getattr(self._get(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self._get()(*args, **kwargs)
+
+    def __getitem__(self, key):
+        return self._get()[key]
+
+    def __contains__(self, key):
+        return key in self._get()
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __len__(self):
+        return len(self._get())
+
+    def __repr__(self):
+        state = "built" if self._built else "not built"
+        return f"<Lazy {self._name} ({state})>"
+
+
+def lazy(name, factory):
+    """
+    Return a Lazy proxy for `factory()`, or the built object right away when
+    LAZY_INIT=0. Build times are recorded either way (see init_times).
+    """
+    proxy = Lazy(name, factory)
+    _registry[name] = proxy
+    if not LAZY_INIT:
+        return proxy._get()
+    return proxy
+
+
+def init_times():
+    """Seconds spent building each lazy object so far."""
+    return dict(_init_times)
+
+
+def warm_up(names=None):
+    """Build the registered lazy objects (all by default) and return their build times."""
+    for name, proxy in list(_registry.items()):
+        if names is None or name in names:
+            proxy._get()
+    return init_times()
+
+
+def profile_imports(module="pipeline", top=15):
+    """
+    Import `module` in a fresh interpreter with -X importtime and return the
+    slowest top-level packages as [(package, seconds)] (summed over their
+    submodules), plus the total import time.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.getcwd(),
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    packages = {}
+    total = 0.0
+    for line in proc.stderr.splitlines():
+        m = re.match(r"import time:\s+(\d+) \|\s+\d+ \|\s*(\S+)", line)
+        if not m:
+            continue
+        self_us, name = int(m.group(1)), m.group(2)
+        total += self_us / 1e6
+        root = name.split(".")[0]
+        packages[root] = packages.get(root, 0.0) + self_us / 1e6
+    ranked = sorted(packages.items(), key=lambda kv: kv[1], reverse=True)[:top]
+    return ranked, total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report where Text2SQL cold-start time goes")
+    parser.add_argument("--module", default="pipeline", help="module to import (default: pipeline)")
+    parser.add_argument("--top", type=int, default=15, help="number of packages to list")
+    parser.add_argument("--warm", action="store_true", help="also build every lazy model, engine and graph")
+    args = parser.parse_args(argv)
+
+    ranked, total = profile_imports(args.module, args.top)
+    print(f"⏱️ import {args.module}: {total:.2f}s")
+    for package, seconds in ranked:
+        print(f"   {package:<30} {seconds * 1000:8.1f}ms")
+
+    if args.warm:
+        sys.path.insert(0, os.getcwd())
+        start = time.perf_counter()
+        __import__(args.module)
+        print(f"⏱️ import in-process: {time.perf_counter() - start:.2f}s")
+        for name, seconds in warm_up().items():
+            print(f"   build {name:<24} {seconds * 1000:8.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Capture of every SQL statement executed by sql_runner: one JSON line per
+execution with its timing, row count, error and whether it was served from the
+result cache. index_advisor.py reads this log.
+"""
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+
+from instrumentation import current_run
+
+
+# JSON-lines file receiving one record per executed query ("" disables capture)
+WORKLOAD_LOG_PATH = os.getenv("WORKLOAD_LOG_PATH", "sql_workload.jsonl")
+
+_write_lock = threading.Lock()
+
+
+def record_query(sql, seconds, rows=None, error=None, source="run_sql", cached=False, path=None):
+    """Append one executed query to the workload log."""
+    path = WORKLOAD_LOG_PATH if path is None else path
+    if not path:
+        return
+    run = current_run()
+    record = {
+        "ts": time.time(),
+        "run_id": run.run_id if run is not None else None,
+        "source": source,
+        "sql": sql,
+        "seconds": round(seconds, 6),
+        "rows": rows,
+        "error": error,
+        "cached": cached,
+    }
+    with _write_lock:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+
+
+def load_workload(path=WORKLOAD_LOG_PATH, include_cached=False, include_errors=False):
+    """Records from the workload log; cache hits and failed queries are skipped by default."""
+    if not path or not os.path.exists(path):
+        return []
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("cached") and not include_cached:
+                continue
+            if record.get("error") and not include_errors:
+                continue
+            records.append(record)
+    return records
+
+
+def _record_outcome(source, query, start, out):
+    if isinstance(out, str):
+        record_query(query, time.perf_counter() - start, error=out, source=source)
+        return
+    rows = getattr(out, "total_rows", None)
+    if rows is None and hasattr(out, "__len__"):
+        rows = len(out)
+    cached = bool(getattr(out, "cached", False) or getattr(out, "attrs", {}).get("cached"))
+    record_query(query, time.perf_counter() - start, rows=rows, source=source, cached=cached)
+
+
+def captured(source):
+    """
+    Decorator for query functions taking the SQL as first argument and returning
+    a result or an error string (run_sql, arun_sql, execute_streaming). Every call
+    is appended to the workload log; logging failures never affect the query.
+    """
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(query, *args, **kwargs):
+                start = time.perf_counter()
+                out = await fn(query, *args, **kwargs)
+                try:
+                    _record_outcome(source, query, start, out)
+                except OSError as e:
+                    print(f"⚠️ Could not write the workload log: {e}")
+                return out
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(query, *args, **kwargs):
+            start = time.perf_counter()
+            out = fn(query, *args, **kwargs)
+            try:
+                _record_outcome(source, query, start, out)
+            except OSError as e:
+                print(f"⚠️ Could not write the workload log: {e}")
+            return out
+        return wrapper
+    return decorator